@@ -1,22 +1,44 @@
 # --- Imports ---
 
 # Standard library imports
+import array
+import base64
 import collections
 from typing import Optional
 import logging
 import os
+import sys
 
 # Third party imports
 import regex
 import pickle
 
 # Local application imports
+from byte_table import ByteTableDecoder
 from helpers import setup_logger
+from incremental_tokens import IncrementalDecoder, IncrementalTokenCounter
 
 # --- Setup ---
 error_logger = setup_logger('tokenizer_error_logger', 'tokenizer-error.log', logging.ERROR)
 audit_logger = setup_logger('tokenizer_audit_logger', 'tokenizer-audit.log', logging.INFO)
 
+# Pre-tokenization pattern of the `cl100k_base` encoding, the default for tiktoken-format rank files
+CL100K_PAT_STR = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+| ?[^\s\p{L}\p{N}]++[\r\n]*+|\s++$|\s*[\r\n]|\s+(?!\S)|\s"""
+
+# Number of distinct words whose encodings are cached per tokenizer
+WORD_CACHE_SIZE = int(os.getenv("TOKENIZER_CACHE_SIZE", "65536"))
+
+# Pre-tokenizer versions, stored in each model: 1 splits text with `pat_str` only (models
+# trained before versioning); 2 also re-splits words longer than `max_word_length`
+# characters (e.g. a whole fenced code block) with `BASE_WORD_PAT_STR`, then at that length
+PRETOKENIZER_VERSION = 2
+
+# Maximum word length for newly trained models; 0 trains version 1 models
+WORD_MAX_LENGTH = int(os.getenv("PRETOKENIZER_MAX_LENGTH", "256"))
+
+# Plain word pattern (the first group of the default `PAT_STR`), used to re-split long words
+BASE_WORD_PAT_STR = r"""'s|'t|'re|'ve|'m|'ll|'d| ?[\p{L}]+| ?[\p{N}]+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+
 # --- Tokenizer class ---
 class Tokenizer:
     """
@@ -35,11 +57,26 @@ class Tokenizer:
 
     _pat : regex.Pattern
         A compiled regex pattern.
+
+    pretokenizer_version : int
+        How text is split into words, see `PRETOKENIZER_VERSION`.
+
+    max_word_length : int or None
+        Longest word (characters) before it is re-split (version 2).
+
+    base_pat_str : str or None
+        The pattern long words are re-split with (version 2).
+
+    _cache : dict
+        Recently encoded words and their tokens (not pickled).
+
+    _byte_table : ByteTableDecoder
+        Flat byte table for batch decoding, built on first use (not pickled).
     """
 
     # -- Constructor --
 
-    def __init__(self, *, pat_str: str, mergeable_ranks: dict[bytes, int]) -> None:
+    def __init__(self, *, pat_str: str, mergeable_ranks: dict[bytes, int], max_word_length: Optional[int] = None, base_pat_str: str = BASE_WORD_PAT_STR) -> None:
         """
         Initialize the Tokenizer class.
 
@@ -50,12 +87,42 @@ class Tokenizer:
 
         mergeable_ranks : dict
             A dictionary containing mergeable ranks.
+
+        max_word_length : int, optional
+            Re-split longer words (pre-tokenizer version 2); None splits with `pat_str` only (version 1).
+
+        base_pat_str : str, optional
+            The pattern long words are re-split with.
         """
 
         self.pat_str = pat_str
         self.mergeable_ranks = mergeable_ranks
         self._decoder = {token: token_bytes for token_bytes, token in mergeable_ranks.items()}
         self._pat = regex.compile(pat_str)
+        self.pretokenizer_version = PRETOKENIZER_VERSION if max_word_length else 1
+        self.max_word_length = max_word_length or None
+        self.base_pat_str = base_pat_str if max_word_length else None
+        self._base_pat = regex.compile(base_pat_str) if max_word_length else None
+        self._cache = {}
+        self._byte_table = None
+
+    # -- Pickling methods --
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state.pop("_cache", None)
+        state.pop("_byte_table", None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._cache = {}
+        self._byte_table = None
+        if "pretokenizer_version" not in state: # Models saved before pre-tokenizer versioning
+            self.pretokenizer_version = 1
+            self.max_word_length = None
+            self.base_pat_str = None
+            self._base_pat = None
 
     # -- Encoding and decoding methods --
 
@@ -69,16 +136,56 @@ class Tokenizer:
         Returns:
             list[int]: A list of tokens.
         """
-        words = self._pat.findall(text)
         tokens = []
-        for word in words:
-            if isinstance(word, tuple):
-                word = ''.join(word)
-            word_bytes = word.encode("utf-8")
-            word_tokens = bpe_encode(self.mergeable_ranks, word_bytes)
-            tokens.extend(word_tokens)
+        for word in self.pretokenize(text):
+            tokens.extend(self.encode_word(word))
         return tokens
 
+    def count(self, text: str) -> int:
+        """
+        Counts the tokens of a text.
+
+        Args:
+            text (str): The input text.
+
+        Returns:
+            int: The number of tokens `encode` returns.
+        """
+        return len(self.encode(text))
+
+    def pretokenize(self, text: str) -> list[str]:
+        """
+        Splits text into words (pre-tokens) using the pattern.
+
+        Args:
+            text (str): The input text.
+
+        Returns:
+            list[str]: The words, in order.
+        """
+        return pretokenize(text, self._pat, self.max_word_length, self._base_pat)
+
+    def encode_word(self, word: str) -> list[int]:
+        """
+        Encodes a single word (pre-token) to tokens.
+
+        Args:
+            word (str): A word returned by `pretokenize`.
+
+        Returns:
+            list[int]: A list of tokens.
+        """
+        tokens = self._cache.get(word)
+        if tokens is None:
+            tokens = bpe_encode(self.mergeable_ranks, word.encode("utf-8"))
+            if len(self._cache) >= WORD_CACHE_SIZE:
+                try:
+                    del self._cache[next(iter(self._cache))] # Evict the oldest entry
+                except (KeyError, RuntimeError, StopIteration): # Another thread changed the cache meanwhile
+                    pass
+            self._cache[word] = tokens
+        return list(tokens)
+
     def decode(self, tokens: list[int]) -> str:
         """
         Decodes tokens to text.
@@ -103,6 +210,44 @@ class Tokenizer:
         """
         return b"".join(self._decoder.get(token, b"") for token in tokens)
 
+    def decode_batch(self, sequences) -> list[str]:
+        """
+        Decodes many token sequences to text through a flat byte table.
+
+        Faster than `decode` per sequence for large id buffers, and vectorized
+        when NumPy is installed; the output is identical.
+
+        Args:
+            sequences (Iterable): Token id lists, `array.array` or NumPy arrays.
+
+        Returns:
+            list[str]: The decoded text of each sequence.
+        """
+        if self._byte_table is None:
+            self._byte_table = ByteTableDecoder.from_tokenizer(self)
+        return self._byte_table.decode_batch(sequences)
+
+    def incremental_decoder(self) -> IncrementalDecoder:
+        """
+        Creates a decoder for ids that arrive in chunks (e.g. streamed or replayed ids).
+
+        Returns:
+            IncrementalDecoder: Emits text deltas, holding back characters split across chunks.
+        """
+        return IncrementalDecoder(self)
+
+    def incremental_counter(self, holdback: int = 2) -> IncrementalTokenCounter:
+        """
+        Creates a token counter for text that arrives in pieces (e.g. a streamed reply).
+
+        Args:
+            holdback (int): Trailing words that stay provisional until more text arrives.
+
+        Returns:
+            IncrementalTokenCounter: Counts each piece without re-encoding the text before it.
+        """
+        return IncrementalTokenCounter(self, holdback)
+
     # -- Serialization methods --
 
     def save_model(self, file_path: str) -> None:
@@ -117,6 +262,20 @@ class Tokenizer:
 
         audit_logger.info(f'Tokenizer model saved to {file_path}')
 
+    def to_frontend_model(self) -> dict:
+        """
+        Export the model for the browser tokenizer (`FrontendBPETokenizer` in static/SimpleBytePairEncoding.js).
+
+        Returns:
+            dict: `mergeable_ranks` (hex-encoded token bytes -> rank) and `pat_str`,
+            plus `max_word_length` and `base_pat_str` for pre-tokenizer version 2.
+        """
+        model = {"mergeable_ranks": {token.hex(): rank for token, rank in self.mergeable_ranks.items()}, "pat_str": self.pat_str}
+        if self.max_word_length:
+            model["max_word_length"] = self.max_word_length
+            model["base_pat_str"] = self.base_pat_str
+        return model
+
     @staticmethod
     def load_model(file_path: str):
         """
@@ -131,6 +290,33 @@ class Tokenizer:
         with open(file_path, 'rb') as f:
             return pickle.load(f)
 
+    @staticmethod
+    def load_tiktoken_bpe(file_path: str, pat_str: Optional[str] = None):
+        """
+        Load a tiktoken-format rank file (one base64 token and its rank per line).
+
+        The ranks are used by the same encoder as trained models, so counts
+        match what upstream models bill (e.g. with `cl100k_base.tiktoken`).
+
+        Args:
+            file_path (str): The path to the rank file.
+            pat_str (str, optional): The pre-tokenization pattern. Defaults to `CL100K_PAT_STR`.
+
+        Returns:
+            Tokenizer: The loaded tokenizer.
+        """
+        mergeable_ranks = {}
+        with open(file_path, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                token, rank = line.split()
+                mergeable_ranks[base64.b64decode(token)] = int(rank)
+
+        audit_logger.info(f'Loaded {len(mergeable_ranks)} ranks from {file_path}')
+
+        return Tokenizer(pat_str=pat_str or CL100K_PAT_STR, mergeable_ranks=mergeable_ranks)
+
     # -- Validation and training methods --
 
     def validate(self, data, verbose=False):
@@ -160,7 +346,7 @@ class Tokenizer:
         return failing_cases
 
     @staticmethod
-    def train(training_data: str, vocab_size: int, pat_str: str):
+    def train(training_data: str, vocab_size: int, pat_str: str, max_word_length: Optional[int] = None):
         """
         Train a Byte Pair Encoding tokenizer on given data.
 
@@ -168,15 +354,16 @@ class Tokenizer:
             training_data (str): The input data for training.
             vocab_size (int): The maximum size of the vocabulary.
             pat_str (str): A pattern string.
+            max_word_length (int, optional): Re-split longer words, at training and encode time.
 
         Returns:
             Tokenizer: The trained tokenizer.
         """
-        mergeable_ranks = bpe_train(data=training_data, vocab_size=vocab_size, pat_str=pat_str)
+        mergeable_ranks = bpe_train(data=training_data, vocab_size=vocab_size, pat_str=pat_str, max_word_length=max_word_length)
 
-        audit_logger.info(f'Training completed. Vocabulary size: {len(mergeable_ranks)}')
+        audit_logger.info(f'Training completed. Vocabulary size: {len(mergeable_ranks)}, max word length: {max_word_length}')
 
-        return Tokenizer(pat_str=pat_str, mergeable_ranks=mergeable_ranks)
+        return Tokenizer(pat_str=pat_str, mergeable_ranks=mergeable_ranks, max_word_length=max_word_length)
 
 # --- Tokenizer service class ---
 
@@ -198,30 +385,80 @@ class TokenizerService:
     pat_str : str
         A pattern string used to split the input data into words.
 
+    max_word_length : int
+        Longest word when training a new model, see `WORD_MAX_LENGTH`.
+
+    socket_path : str
+        The tokenizer daemon socket (default: the `TOKENIZER_SOCKET` environment variable), or empty.
+
     tokenizer : Tokenizer
-        The trained tokenizer instance.
+        The trained tokenizer instance, or a `SidecarTokenizer` using the daemon
+        at `socket_path` when one is set (see tokenizer_daemon.py).
     """
 
     # -- Constructor --
             
-    def __init__(self, model_path: str, training_data: Optional[str] = None, vocab_size: Optional[int] = None, pat_str: Optional[str] = None):
+    def __init__(self, model_path: str, training_data: Optional[str] = None, vocab_size: Optional[int] = None, pat_str: Optional[str] = None, max_word_length: Optional[int] = None, socket_path: Optional[str] = None):
         self.model_path = model_path
         self.train_data = training_data
         self.vocab_size = vocab_size
         self.pat_str = pat_str
+        self.max_word_length = max_word_length if max_word_length is not None else WORD_MAX_LENGTH
+        self.socket_path = socket_path if socket_path is not None else os.getenv("TOKENIZER_SOCKET", "")
         self.tokenizer = None
 
         if not os.path.exists(self.model_path):
             self.__check_model_arguments()
             self.__train_model()
 
-        self.__load_model()
+        if self.socket_path:
+            # The in-process model is only loaded if the daemon cannot be used
+            self.tokenizer = self.__connect_daemon(self.__load_model)
+        else:
+            self.tokenizer = self.__load_model()
 
         if self.tokenizer is None:
             msg = "Tokenizer could not be loaded. Please see the logs for more information."
             error_logger.error(msg)
             raise FileNotFoundError(msg)
         
+    @classmethod
+    def from_rank_file(cls, ranks_path: str, pat_str: Optional[str] = None, socket_path: Optional[str] = None):
+        """
+        Create a service around a tiktoken-format rank file instead of a trained model.
+
+        Parameters
+        ----------
+        ranks_path : str
+            Path to the rank file.
+
+        pat_str : str, optional
+            The pre-tokenization pattern, see `Tokenizer.load_tiktoken_bpe`.
+
+        socket_path : str, optional
+            The tokenizer daemon socket, as for the constructor.
+
+        Returns
+        -------
+        TokenizerService
+            The service, with `tokenizer` loaded.
+        """
+        if not os.path.exists(ranks_path):
+            msg = f"Rank file not found: {ranks_path}"
+            error_logger.error(msg)
+            raise FileNotFoundError(msg)
+
+        service = cls.__new__(cls)
+        service.model_path = ranks_path
+        service.train_data = None
+        service.vocab_size = None
+        service.pat_str = pat_str
+        service.max_word_length = None
+        service.socket_path = socket_path if socket_path is not None else os.getenv("TOKENIZER_SOCKET", "")
+        load = lambda: Tokenizer.load_tiktoken_bpe(ranks_path, pat_str)
+        service.tokenizer = service.__connect_daemon(load, pat_str) if service.socket_path else load()
+        return service
+
     # -- Tokenizer service utilities --
 
     def __check_model_arguments(self):
@@ -247,7 +484,7 @@ class TokenizerService:
         ValueError
             If the tokenizer validation fails.
         """
-        tokenizer = Tokenizer.train(self.train_data, self.vocab_size, self.pat_str)
+        tokenizer = Tokenizer.train(self.train_data, self.vocab_size, self.pat_str, self.max_word_length)
 
         test_data = self.get_test_data()
 
@@ -258,10 +495,36 @@ class TokenizerService:
         
         tokenizer.save_model(self.model_path)
 
-    def __load_model(self):
+    def __connect_daemon(self, load_local, pat_str: Optional[str] = None):
+        """
+        Create a client of the tokenizer daemon at `socket_path` for this service's model.
+
+        Parameters
+        ----------
+        load_local : Callable[[], Tokenizer]
+            Loads the in-process tokenizer, used when the daemon is unavailable.
+
+        pat_str : str, optional
+            The pattern a rank file is loaded with; trained models carry their own.
+
+        Returns
+        -------
+        SidecarTokenizer
+            The client tokenizer.
+        """
+        from tokenizer_daemon import SidecarTokenizer, TokenizerClient, model_id # The daemon module builds on this one
+
+        return SidecarTokenizer(TokenizerClient(self.socket_path), load_local, model_id(self.model_path, pat_str))
+
+    def __load_model(self) -> Tokenizer:
         """
         Load the tokenizer model from the specified path.
 
+        Returns
+        -------
+        Tokenizer
+            The validated tokenizer.
+
         Raises
         -------
         FileNotFoundError
@@ -273,12 +536,13 @@ class TokenizerService:
             raise FileNotFoundError(msg)
         
         with open(self.model_path, 'rb') as f:
-            self.tokenizer = pickle.load(f)
+            tokenizer = pickle.load(f)
 
-        if self.tokenizer.validate(self.get_test_data()): # If any validation errors are returned, raise an error
+        if tokenizer.validate(self.get_test_data()): # If any validation errors are returned, raise an error
             msg = "Tokenizer validation failed. See tokenizer error logs for more information."
             error_logger.error(msg)
             raise ValueError(msg)
+        return tokenizer
 
     @staticmethod
     def get_test_data():
@@ -322,30 +586,115 @@ def bpe_encode(mergeable_ranks: dict[bytes, int], input: bytes) -> list[int]:
         list[int]: A list of tokens.
     """
     
-    # Split input into individual bytes
-    parts = [bytes([b]) for b in input]
-    while True:
-        min_idx = None
-        min_rank = None
-        # Find the pair with the lowest rank
-        for i, pair in enumerate(zip(parts[:-1], parts[1:])):
-            rank = mergeable_ranks.get(pair[0] + pair[1])
-            if rank is not None and (min_rank is None or rank < min_rank):
-                min_idx = i
-                min_rank = rank
+    if len(input) < 2:
+        return [mergeable_ranks[input]] if input else []
+
+    # Parts are kept as boundaries into `input`, with the rank of each adjacent pair
+    # cached, so a merge only re-ranks its two neighbours (see tiktoken's byte_pair_merge)
+    no_rank = sys.maxsize
+    get_rank = mergeable_ranks.get
+    starts = list(range(len(input) + 1))
+    ranks = [get_rank(input[i:i + 2], no_rank) for i in range(len(input) - 1)]
+
+    while ranks:
+        # Find the (leftmost) pair with the lowest rank
+        min_idx = min(range(len(ranks)), key=ranks.__getitem__)
 
         # If no pair was found, break the loop
-        if min_rank is None:
+        if ranks[min_idx] == no_rank:
             break
 
-        # Merge the pair with the lowest rank
-        parts = parts[:min_idx] + [parts[min_idx] + parts[min_idx + 1]] + parts[min_idx + 2 :]
+        # Merge the pair with the lowest rank and re-rank its neighbours
+        del starts[min_idx + 1]
+        del ranks[min_idx]
+        if min_idx < len(ranks):
+            ranks[min_idx] = get_rank(input[starts[min_idx]:starts[min_idx + 2]], no_rank)
+        if min_idx > 0:
+            ranks[min_idx - 1] = get_rank(input[starts[min_idx - 1]:starts[min_idx + 1]], no_rank)
 
     # Convert parts to tokens using the mergeable ranks
-    tokens = [mergeable_ranks[part] for part in parts]
+    tokens = [mergeable_ranks[input[start:end]] for start, end in zip(starts[:-1], starts[1:])]
     return tokens
 
-def bpe_train(data: str, vocab_size: int, pat_str: str) -> dict[bytes, int]:
+def token_id_width(tokens: list[int]) -> int:
+    """
+    Picks the smallest unsigned integer width that holds every token id.
+
+    Args:
+        tokens (list[int]): Token ids.
+
+    Returns:
+        int: 2 (uint16) or 4 (uint32) bytes per id.
+    """
+    return 2 if not tokens or max(tokens) < 1 << 16 else 4
+
+def pack_token_ids(tokens: list[int], width: int) -> bytes:
+    """
+    Packs token ids as little-endian unsigned integers.
+
+    Args:
+        tokens (list[int]): Token ids.
+        width (int): Bytes per id, 2 or 4 (see `token_id_width`).
+
+    Returns:
+        bytes: `len(tokens) * width` bytes.
+    """
+    packed = array.array("H" if width == 2 else "I", tokens)
+    if packed.itemsize != width:
+        raise ValueError(f"Unsupported token id width: {width}")
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+def unpack_token_ids(data: bytes, width: int) -> list[int]:
+    """
+    Unpacks little-endian token ids, see `pack_token_ids`.
+
+    Args:
+        data (bytes): The packed ids.
+        width (int): Bytes per id, 2 or 4.
+
+    Returns:
+        list[int]: The token ids.
+    """
+    packed = array.array("H" if width == 2 else "I")
+    if packed.itemsize != width:
+        raise ValueError(f"Unsupported token id width: {width}")
+    packed.frombytes(data)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tolist()
+
+def pretokenize(text: str, pat: regex.Pattern, max_word_length: Optional[int] = None, base_pat: Optional[regex.Pattern] = None) -> list[str]:
+    """
+    Splits text into words with a pattern, re-splitting words that are too long.
+
+    Args:
+        text (str): The input text.
+        pat (regex.Pattern): The compiled pattern.
+        max_word_length (int, optional): Longest word in characters; None keeps every match whole.
+        base_pat (regex.Pattern, optional): The pattern long words are re-split with first.
+
+    Returns:
+        list[str]: The words, in order; they join back to `text`.
+    """
+    words = [''.join(word) if isinstance(word, tuple) else word for word in pat.findall(text)]
+    if not max_word_length:
+        return words
+
+    bounded = []
+    for word in words:
+        if len(word) <= max_word_length:
+            bounded.append(word)
+            continue
+        for piece in (base_pat.findall(word) if base_pat is not None else [word]):
+            if len(piece) <= max_word_length:
+                bounded.append(piece)
+            else:
+                bounded.extend(piece[i:i + max_word_length] for i in range(0, len(piece), max_word_length))
+    return bounded
+
+def bpe_train(data: str, vocab_size: int, pat_str: str, max_word_length: Optional[int] = None, base_pat_str: str = BASE_WORD_PAT_STR) -> dict[bytes, int]:
     """
     Trains a Byte Pair Encoding tokenizer on given data.
 
@@ -353,6 +702,8 @@ def bpe_train(data: str, vocab_size: int, pat_str: str) -> dict[bytes, int]:
         data (str): The input data for training.
         vocab_size (int): The maximum size of the vocabulary.
         pat_str (str): A pattern string.
+        max_word_length (int, optional): Re-split longer words, see `pretokenize`.
+        base_pat_str (str, optional): The pattern long words are re-split with.
 
     Returns:
         dict: A dictionary containing mergeable ranks.
@@ -373,7 +724,8 @@ def bpe_train(data: str, vocab_size: int, pat_str: str) -> dict[bytes, int]:
 
     # Split data into words and then into individual bytes
     words: list[list[bytes]] = [
-        [bytes([b]) for b in ''.join(word).encode("utf-8")] for word in regex.findall(pat_str, data)
+        [bytes([b]) for b in word.encode("utf-8")]
+        for word in pretokenize(data, regex.compile(pat_str), max_word_length, regex.compile(base_pat_str))
     ]
 
     # Continue until we reach the desired vocabulary size
@@ -1,6 +1,9 @@
 import os
-import regex
+import argparse
 from chatbot import ChatBotClass
+from tokenizer_init import DEFAULT_PAT_STR, get_vocab_size
+from batch import BatchRunner, load_batch_items
+from helpers import get_default_system_message
 from dotenv import load_dotenv
 
 def create_chatbot():
@@ -10,7 +13,7 @@ def create_chatbot():
     # Defaults
     model_path = os.getenv("MODEL_PATH", "pair.pkl")
     training_data_path = os.getenv("TRAINING_DATA_PATH", "sample-training-data.log")
-    pat_str = os.getenv("PAT_STR", r"""('s|'t|'re|'ve|'m|'ll|'d| ?[\p{L}]+| ?[\p{N}]+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+)|(```[\s\S]*?```)|(`[^`]*`)|(\[[^\]]*\]\([^)]*\))""")
+    pat_str = os.getenv("PAT_STR", DEFAULT_PAT_STR)
 
     if not os.path.exists(model_path):
         # Read training data if it exists
@@ -19,20 +22,45 @@ def create_chatbot():
             with open(training_data_path, "r") as file:
                 training_data = file.read()
 
-        vocab_size = len(regex.findall(pat_str, training_data)) * 2
-
-        # Round to the nearest multiple of 256
-        if vocab_size % 256 < 128:
-            vocab_size -= vocab_size % 256 # Round down
-        else:
-            vocab_size += 256 - vocab_size % 256 # Round up
+        vocab_size = get_vocab_size(training_data, pat_str)
 
         return ChatBotClass(model_path, training_data_path, vocab_size, pat_str)
     else:
         return ChatBotClass(model_path)
 
+def run_batch(chatbot, args):
+    system_message = get_default_system_message()
+    if args.system:
+        with open(args.system, "r") as file:
+            system_message = file.read()
+
+    runner = BatchRunner(
+        chatbot.tokenizer,
+        chatbot.setup_openai_api_client(),
+        system_message,
+        concurrency=args.concurrency,
+        rate_limit=args.rate_limit
+    )
+    summary = runner.run(load_batch_items(args.batch, args.template), args.output)
+    print(f"Batch complete: {summary['succeeded']} succeeded, {summary['failed']} failed, {summary['skipped']} skipped (already done). Results in {args.output}")
+
 def main():
+    parser = argparse.ArgumentParser(description="pAIr chat assistant.")
+    parser.add_argument("--stream", action="store_true", default=None, help="Stream replies as they are generated")
+    parser.add_argument("--batch", nargs="+", metavar="INPUT", help="Run prompts from JSONL files or plain files (globs allowed) non-interactively")
+    parser.add_argument("--output", default="batch-results.jsonl", help="Batch results file (JSONL); an existing file is resumed")
+    parser.add_argument("--template", default="{content}", help="Prompt template for plain batch files, with {content} and {path}")
+    parser.add_argument("--system", help="File with the system message for batch prompts (default: the built-in one)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Batch prompts in flight at once")
+    parser.add_argument("--rate-limit", type=float, help="Maximum batch requests started per second")
+    args = parser.parse_args()
+
     chatbot = create_chatbot()
+    if args.batch:
+        run_batch(chatbot, args)
+        return
+    if args.stream is not None:
+        chatbot.stream = args.stream
     chatbot.set_system_message_default()
     chatbot.chat_main_process()
 
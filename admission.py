@@ -0,0 +1,208 @@
+# admission.py
+
+# --- Imports ---
+
+# Standard library imports
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from typing import Optional
+
+# Local application imports
+from upstream_client import percentile
+
+# --- Exceptions ---
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request cannot be admitted to a lane.
+
+    Attributes
+    ----------
+    status_code : int
+        429 when the wait queue is full, 503 when the request waited too long.
+
+    retry_after : int
+        Suggested seconds before retrying.
+    """
+
+    def __init__(self, lane: str, status_code: int, retry_after: int, reason: str):
+        super().__init__(f"{lane}: {reason}")
+        self.lane = lane
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+# --- Lane class ---
+
+class Lane:
+    """
+    A bounded number of in-flight requests with a bounded FIFO wait queue.
+
+    A request is admitted at once while fewer than `max_in_flight` are running
+    and nobody is waiting; otherwise it waits in the queue for a slot. When the
+    queue is full it is rejected immediately (429), and when it has waited
+    `max_wait` seconds it gives up (503). Both carry a Retry-After estimate from
+    the lane's recent service times. Limits are per process (uvicorn worker).
+
+    Attributes
+    ----------
+    name : str
+        The lane name, used in metrics.
+
+    max_in_flight : int
+        Concurrent requests; 0 disables admission control for the lane.
+
+    max_queue : int
+        Requests allowed to wait for a slot.
+
+    max_wait : float
+        Seconds a request may wait before it is rejected.
+    """
+
+    # -- Constructor --
+
+    def __init__(self, name: str, max_in_flight: int, max_queue: int, max_wait: float, window: int = 1000):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self._waiters = deque() # Futures of queued requests, oldest first
+        self._waits = deque(maxlen=window) # Seconds spent queued, admitted requests only
+        self._service_time = None # Moving average of seconds holding a slot
+        self._counters = {"admitted": 0, "queued": 0, "rejected_full": 0, "rejected_timeout": 0, "max_queue_depth": 0}
+
+    @classmethod
+    def from_env(cls, name: str, max_in_flight: int, max_queue: int, max_wait: float) -> "Lane":
+        """Create a lane whose defaults can be overridden by `ADMISSION_<NAME>_CONCURRENCY`, `_QUEUE` and `_TIMEOUT`."""
+        prefix = f"ADMISSION_{name.upper()}"
+        return cls(
+            name,
+            int(os.getenv(f"{prefix}_CONCURRENCY", str(max_in_flight))),
+            int(os.getenv(f"{prefix}_QUEUE", str(max_queue))),
+            float(os.getenv(f"{prefix}_TIMEOUT", str(max_wait)))
+        )
+
+    # -- Admission --
+
+    async def acquire(self) -> None:
+        """
+        Take a slot, waiting in the queue if needed.
+
+        Raises
+        ------
+        AdmissionRejected
+            When the queue is full or the wait times out.
+        """
+        if self.max_in_flight <= 0:
+            return
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            self._admitted(0.0)
+            return
+        if len(self._waiters) >= self.max_queue:
+            self._counters["rejected_full"] += 1
+            raise AdmissionRejected(self.name, 429, self.retry_after(), "too many requests queued")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        self._counters["queued"] += 1
+        self._counters["max_queue_depth"] = max(self._counters["max_queue_depth"], len(self._waiters))
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # A slot was handed over just as the wait ended
+                if isinstance(e, asyncio.CancelledError):
+                    self.release()
+                    raise
+            else:
+                future.cancel()
+                self._waiters.remove(future)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self._counters["rejected_timeout"] += 1
+                raise AdmissionRejected(self.name, 503, self.retry_after(), "timed out waiting for capacity") from None
+        self._admitted(time.monotonic() - start)
+
+    def release(self, service_time: Optional[float] = None) -> None:
+        """
+        Give a slot back, handing it straight to the oldest waiter if any.
+
+        Parameters
+        ----------
+        service_time : float, optional
+            Seconds the slot was held, used for Retry-After estimates.
+        """
+        if self.max_in_flight <= 0:
+            return
+        if service_time is not None:
+            self._service_time = service_time if self._service_time is None else 0.9 * self._service_time + 0.1 * service_time
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None) # The slot passes on; `in_flight` is unchanged
+                return
+        self.in_flight -= 1
+
+    def retry_after(self) -> int:
+        """Estimate the seconds until a new request could be served: the queue ahead, drained at the lane's rate."""
+        service_time = self._service_time if self._service_time is not None else 1.0
+        return max(1, min(60, math.ceil(service_time * (len(self._waiters) + 1) / max(1, self.max_in_flight))))
+
+    def stats(self) -> dict:
+        """Return queue depth, slot usage, counters and wait percentiles (seconds) for monitoring."""
+        waits = sorted(self._waits)
+        stats = dict(self._counters)
+        stats.update({
+            "in_flight": self.in_flight,
+            "queue_depth": len(self._waiters),
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "service_time": self._service_time,
+            "wait": {
+                "count": len(waits),
+                "p50": percentile(waits, 50),
+                "p95": percentile(waits, 95),
+                "p99": percentile(waits, 99)
+            }
+        })
+        return stats
+
+    def _admitted(self, waited: float) -> None:
+        self._counters["admitted"] += 1
+        self._waits.append(waited)
+
+# --- Admission controller class ---
+
+class AdmissionController:
+    """
+    Routes requests to lanes by path, so slow endpoints cannot starve fast ones.
+
+    Attributes
+    ----------
+    lanes : dict[str, Lane]
+        The lanes, by name.
+
+    routes : dict[str, str]
+        Request path -> lane name; other paths are not limited.
+    """
+
+    # -- Constructor --
+
+    def __init__(self, lanes: list[Lane], routes: dict[str, str]):
+        self.lanes = {lane.name: lane for lane in lanes}
+        self.routes = routes
+
+    def lane_for(self, path: str) -> Optional[Lane]:
+        """Return the lane that limits `path`, or None."""
+        name = self.routes.get(path)
+        return self.lanes[name] if name else None
+
+    def stats(self) -> dict:
+        """Return the stats of every lane."""
+        return {name: lane.stats() for name, lane in self.lanes.items()}
@@ -2,45 +2,157 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-from fastapi import FastAPI, Request, UploadFile, File, Form, Body, HTTPException
+from fastapi import FastAPI, Request, UploadFile, File, Form, Body, HTTPException, Query
 from tokenizer_init import initialize_tokenizer
 
 initialize_tokenizer() # Initialize the tokenizer here to ensure the model is trained/exists for chatbot service.
 
 from pydantic import BaseModel
+import base64
+import json
 import os
+import time
+import uuid
+from collections import OrderedDict
 from chatbot_service import ChatBotService
 from typing import List, Optional
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
-from SimpleBytePairEncoding import TokenizerService
+from fastapi.responses import JSONResponse, Response
+from SimpleBytePairEncoding import Tokenizer, TokenizerService, pack_token_ids, token_id_width
+from image_pipeline import ImagePipeline
+from completion_cache import get_completion_cache
+from compaction import get_history_compactor
+from upstream_client import get_upstream_client
+from session_store import get_session_store
+from admission import AdmissionController, AdmissionRejected, Lane
+from starlette.concurrency import run_in_threadpool
+from static_assets import StaticAssets
+from prompt_builder import get_prefix_cache
 
-# Tokenizer for counting tokens (independent of chatbot session)
-tokenizer_count_service = None
 app = FastAPI()
 
-# Serve static files (frontend)
-app.mount("/static", StaticFiles(directory="static"), name="static")
-app.mount("/shared", StaticFiles(directory="shared"), name="shared")
+# --- Static files (frontend) ---
+# Files are precompressed at startup and served with ETags. The page references
+# them by fingerprinted URLs, which browsers cache forever. The browser tokenizer
+# model is exported from MODEL_PATH and rebuilt (with a new URL) when it is retrained.
+static_assets = StaticAssets({"/static": "static", "/shared": "shared"})
 
-@app.get("/")
-async def root():
-    return FileResponse("static/index.html")
+def build_frontend_model() -> bytes:
+    tokenizer = Tokenizer.load_model(os.getenv("MODEL_PATH", "pair.pkl"))
+    return json.dumps(tokenizer.to_frontend_model(), separators=(",", ":")).encode("utf-8")
 
-# Initialize the chatbot service (adjust model_path and API key as needed)
-chatbot = ChatBotService(
-    model_path=os.getenv("MODEL_PATH", "pair.pkl"),
-    openai_api_key=os.environ["OPENAI_API_KEY"]
-)
+static_assets.add_generated("/shared/tokenizer.json", build_frontend_model, "application/json", sources=[os.getenv("MODEL_PATH", "pair.pkl")])
+static_assets.get("/shared/tokenizer.json")
+
+@app.api_route("/", methods=["GET", "HEAD"])
+async def root(request: Request):
+    return static_assets.page_response(request, "/static/index.html")
+
+@app.api_route("/static/{path:path}", methods=["GET", "HEAD"])
+async def static_endpoint(request: Request, path: str):
+    return static_assets.response(request, f"/static/{path}")
+
+@app.api_route("/shared/{path:path}", methods=["GET", "HEAD"])
+async def shared_endpoint(request: Request, path: str):
+    return static_assets.response(request, f"/shared/{path}")
+
+# --- Chat sessions ---
+# Each browser gets its own session, identified by a cookie. With SESSION_STORE set,
+# sessions are persisted so any worker (or a restarted process) can resume them.
+SESSION_COOKIE = "pair_session"
+MAX_CACHED_SESSIONS = int(os.getenv("MAX_CACHED_SESSIONS", "256"))
+
+session_store = get_session_store()
+chatbots = OrderedDict() # Sessions held by this worker, least recently used first
+
+def get_chatbot(session_id: str) -> ChatBotService:
+    chatbot = chatbots.get(session_id)
+    if chatbot is None:
+        chatbot = ChatBotService(
+            model_path=os.getenv("MODEL_PATH", "pair.pkl"),
+            openai_api_key=os.environ["OPENAI_API_KEY"],
+            session_id=session_id,
+            store=session_store,
+            tokenizer=tokenizer_count_service.tokenizer
+        )
+        chatbots[session_id] = chatbot
+        evict_chatbots(keep=session_id)
+    else:
+        chatbots.move_to_end(session_id)
+    return chatbot
+
+def evict_chatbots(keep: str) -> None:
+    # A session whose lock is held has a turn in flight; dropping it would let the next
+    # request build a second ChatBotService (with its own lock) for the same session
+    while len(chatbots) > MAX_CACHED_SESSIONS:
+        idle = next((session_id for session_id, chatbot in chatbots.items() if session_id != keep and not chatbot.lock.locked()), None)
+        if idle is None:
+            break
+        del chatbots[idle]
 
-# Initialize the tokenizer for counting tokens (independent of chatbot session)
-tokenizer_count_service = TokenizerService(
-    model_path=os.getenv("MODEL_PATH", "pair.pkl"),
-    training_data=None,
-    vocab_size=None,
-    pat_str=None
+@app.middleware("http")
+async def session_middleware(request: Request, call_next):
+    session_id = request.cookies.get(SESSION_COOKIE)
+    request.state.session_id = session_id or uuid.uuid4().hex
+    response = await call_next(request)
+    if request.state.session_id != session_id:
+        response.set_cookie(SESSION_COOKIE, request.state.session_id, httponly=True, samesite="lax")
+    return response
+
+# --- Admission control ---
+# Requests are admitted per lane, before their bodies are read: a burst of slow /chat
+# calls queues (or is turned away with 429/503 and Retry-After) in its own lane, while
+# token counts and history stay responsive in the light lane. Limits are per worker.
+admission = AdmissionController(
+    lanes=[
+        Lane.from_env("chat", max_in_flight=8, max_queue=32, max_wait=30),
+        Lane.from_env("light", max_in_flight=64, max_queue=256, max_wait=5)
+    ],
+    routes={
+        "/chat": "chat",
+        "/token_count": "light",
+        "/history": "light",
+        "/set_system": "light",
+        "/reset_session": "light"
+    }
 )
 
+@app.middleware("http")
+async def admission_middleware(request: Request, call_next):
+    lane = admission.lane_for(request.url.path)
+    if lane is None:
+        return await call_next(request)
+    try:
+        await lane.acquire()
+    except AdmissionRejected as e:
+        return JSONResponse(
+            {"error": "Server busy", "lane": e.lane, "reason": e.reason, "retry_after": e.retry_after},
+            status_code=e.status_code,
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    start = time.monotonic()
+    try:
+        return await call_next(request)
+    finally:
+        lane.release(time.monotonic() - start)
+
+# Initialize the tokenizer for counting tokens, shared by all chat sessions. With
+# TOKEN_COUNT_RANKS_PATH set (e.g. cl100k_base.tiktoken), counts match what the upstream model bills.
+if os.getenv("TOKEN_COUNT_RANKS_PATH"):
+    tokenizer_count_service = TokenizerService.from_rank_file(
+        ranks_path=os.environ["TOKEN_COUNT_RANKS_PATH"],
+        pat_str=os.getenv("TOKEN_COUNT_PAT_STR")
+    )
+else:
+    tokenizer_count_service = TokenizerService(
+        model_path=os.getenv("MODEL_PATH", "pair.pkl"),
+        training_data=None,
+        vocab_size=None,
+        pat_str=None
+    )
+
+# Downscales and encodes uploaded images off the event loop
+image_pipeline = ImagePipeline()
+
 class MessageRequest(BaseModel):
     message: str
     context_files: Optional[List[str]] = None  # List of file paths (relative or absolute)
@@ -50,137 +162,218 @@ class SystemMessageRequest(BaseModel):
 
 @app.post("/chat")
 async def chat_endpoint(
+    request: Request,
     message: str = Form(...),
     context_files: Optional[List[UploadFile]] = File(None),
     images: Optional[List[UploadFile]] = File(None),
     web_search_options: Optional[str] = Form(None),
     trim_history: bool = Form(False)
 ):
-    file_contents, context_file_token_counts, total_context_tokens = [], [], 0
+    chatbot = get_chatbot(request.state.session_id)
+
+    file_contents, file_names, context_file_token_counts, total_context_tokens = [], [], [], 0
     if context_files:
         for upload in context_files:
             content = (await upload.read()).decode("utf-8", errors="replace")
             file_contents.append(content)
-            tokens = tokenizer_count_service.tokenizer.encode(content)
+            file_names.append(upload.filename)
+            token_count = tokenizer_count_service.tokenizer.count(content)
             context_file_token_counts.append({
                 "filename": upload.filename,
-                "token_count": len(tokens)
+                "token_count": token_count
+            })
+            total_context_tokens += token_count
+
+    image_datas, image_token_counts, total_image_tokens = [], [], 0
+    if images:
+        uploads = [
+            {"filename": img.filename, "content": await img.read(), "content_type": img.content_type}
+            for img in images
+        ]
+        image_datas = await image_pipeline.process_many(uploads)
+        for img in image_datas:
+            image_token_counts.append({
+                "filename": img["filename"],
+                "token_count": img["tokens"]
             })
-            total_context_tokens += len(tokens)
+            total_image_tokens += img["tokens"]
 
-    user_message_tokens = tokenizer_count_service.tokenizer.encode(message)
-    total_tokens = total_context_tokens + len(user_message_tokens)
+    if chatbot.retrieval:
+        # Only the best matching chunks, up to the retrieval budget, are sent
+        total_context_tokens = min(total_context_tokens, chatbot.retrieval_token_budget)
+
+    user_message_tokens = tokenizer_count_service.tokenizer.count(message)
+    total_tokens = total_context_tokens + total_image_tokens + user_message_tokens
     
     TOKEN_MAX_LIMIT = chatbot.session.tokenizer.token_limit if hasattr(chatbot.session.tokenizer, 'token_limit') else 1000000
 
-    # Also count previous conversation, if desired (depends on design)
-    history_tokens = chatbot.session.calculate_total_tokens()
-    full_total = total_tokens + history_tokens
-    
-    if full_total > TOKEN_MAX_LIMIT:
+    ws_opts = None
+    if web_search_options:
+        try:
+            ws_opts = json.loads(web_search_options)
+        except Exception:
+            ws_opts = None
+
+    def run_chat():
+        with chatbot.lock:
+            with chatbot.state_lock:
+                chatbot.session.refresh() # Pick up turns handled by other workers
+                # Also count previous conversation, if desired (depends on design)
+                history_tokens = chatbot.session.calculate_total_tokens()
+            if total_tokens + history_tokens > TOKEN_MAX_LIMIT:
+                return None, history_tokens
+            return chatbot.chat(
+                message,
+                context_file_contents=file_contents,
+                context_file_names=file_names,
+                web_search_options=ws_opts,
+                images=image_datas
+            ), history_tokens
+
+    # The upstream call blocks, so it runs in a worker thread to keep the event loop free;
+    # turns of a session run one at a time under its lock, and the history is only read and
+    # changed under its short state lock, so /history and /set_system never wait for the upstream
+    reply, history_tokens = await run_in_threadpool(run_chat)
+    if reply is None:
+        full_total = total_tokens + history_tokens
         # Do NOT allow sending! Return warning and breakdown
         return JSONResponse({
             "error": "Token limit exceeded",
             "token_limit": TOKEN_MAX_LIMIT,
             "total_tokens": full_total,
             "history_tokens": history_tokens,
-            "user_message_tokens": len(user_message_tokens),
+            "user_message_tokens": user_message_tokens,
             "context_file_token_counts": context_file_token_counts,
+            "image_token_counts": image_token_counts,
             "tokens_over": full_total - TOKEN_MAX_LIMIT
         }, status_code=413)
-
-    image_datas = []
-    if images:
-        for img in images:
-            content = await img.read()
-            image_datas.append({
-                "filename": img.filename,
-                "content": content,
-                "content_type": img.content_type
-            })
-
-    import json
-    ws_opts = None
-    if web_search_options:
-        try:
-            ws_opts = json.loads(web_search_options)
-        except Exception:
-            ws_opts = None
-
-    reply = chatbot.chat(
-        message,
-        context_file_contents=file_contents,
-        web_search_options=ws_opts,
-        images=image_datas
-    )
     return {"response": reply}
 
 @app.post("/set_system")
-async def set_system_endpoint(request: SystemMessageRequest):
-    chatbot.set_system_message(request.system_message)
+async def set_system_endpoint(request: Request, body: SystemMessageRequest):
+    chatbot = get_chatbot(request.state.session_id)
+
+    await run_in_threadpool(chatbot.set_system_message, body.system_message) # Store writes and flushes block
     return {"status": "system message set"}
 
 @app.get("/history")
-async def history_endpoint():
+async def history_endpoint(request: Request):
+    chatbot = get_chatbot(request.state.session_id)
+
     # Only return user and system (bot) messages, skip the first system message (system prompt)
-    history = chatbot.get_history()
+    history = await run_in_threadpool(chatbot.get_history) # Loading from the store blocks
     filtered = []
     for idx, msg in enumerate(history):
         if msg["role"] == "system" and idx == 0:
             continue  # skip system prompt
         if msg["role"] in ("user", "system"):
-            msg["tokens"] = len(tokenizer_count_service.tokenizer.encode(msg["content"]))
+            msg["tokens"] = tokenizer_count_service.tokenizer.count(msg["content"])
             filtered.append(msg)
     return {"history": filtered}
 
 # --- PATCH: Add endpoint for resetting the chat session ---
 @app.post("/reset_session")
-async def reset_session():
+async def reset_session(request: Request):
     """
     Resets the current chat session, both on backend and for the client's next chat.
     """
-    global chatbot
-    # Re-instantiate the chatbot session object
-    chatbot = ChatBotService(
-        model_path=os.getenv("MODEL_PATH", "pair.pkl"),
-        openai_api_key=os.environ["OPENAI_API_KEY"]
-    )
+    # Start a fresh session under a new id; the session middleware hands the client the new cookie
+    chatbots.pop(request.state.session_id, None)
+    request.state.session_id = uuid.uuid4().hex
+    get_chatbot(request.state.session_id)
     return {"status": "session reset"}
 
+# Response modes of /token_count, from largest to smallest: token ids as JSON lists,
+# packed little-endian ids (base64 in JSON, or a raw binary body), or counts only
+TOKEN_COUNT_MODES = ("ids", "base64", "binary", "counts")
+
 @app.post("/token_count")
 async def get_token_count_endpoint(
     text: Optional[str] = Form(None),
     files: Optional[List[UploadFile]] = File(None),
-    history: Optional[List[str]] = Form(None)
+    history: Optional[List[str]] = Form(None),
+    mode: str = Query("ids")
 ):
-    """Return token count for text and for each file."""
+    """
+    Return token counts (and, unless `mode=counts`, token ids) for text and for each file.
+
+    With `mode=base64`, ids are packed little-endian integers of `token_width` bytes,
+    base64-encoded. With `mode=binary`, the body is the packed ids of the text followed
+    by each file's; the `X-Token-Width` and `X-Token-Counts` headers give the id width
+    and the number of ids of each part, in that order.
+    """
+    if mode not in TOKEN_COUNT_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of: {', '.join(TOKEN_COUNT_MODES)}")
+
+    encode = tokenizer_count_service.tokenizer.encode
+    text_tokens = encode(text) if text is not None else None
+    file_tokens = []
+    for upload in files or []:
+        try:
+            content = (await upload.read()).decode("utf-8", errors="replace")
+            file_tokens.append((upload.filename, encode(content), None))
+        except Exception as e:
+            file_tokens.append((upload.filename, None, str(e)))
+
+    parts = ([text_tokens] if text_tokens is not None else []) + [tokens for _, tokens, _ in file_tokens if tokens is not None]
+    width = token_id_width([max(tokens) for tokens in parts if tokens])
+
+    if mode == "binary":
+        errors = [f"{filename}: {error}" for filename, _, error in file_tokens if error]
+        if errors:
+            raise HTTPException(status_code=422, detail="; ".join(errors))
+        return Response(
+            content=b"".join(pack_token_ids(tokens, width) for tokens in parts),
+            media_type="application/octet-stream",
+            headers={"X-Token-Width": str(width), "X-Token-Counts": ",".join(str(len(tokens)) for tokens in parts)}
+        )
+
+    def render_ids(tokens):
+        if mode == "base64":
+            return base64.b64encode(pack_token_ids(tokens, width)).decode("ascii")
+        return tokens
+
     result = {}
-    if text is not None:
-        result["text_tokens"] = tokenizer_count_service.tokenizer.encode(text)
-        result["text_token_count"] = len(result["text_tokens"])
+    if mode == "base64":
+        result["token_width"] = width
+    if text_tokens is not None:
+        if mode != "counts":
+            result["text_tokens"] = render_ids(text_tokens)
+        result["text_token_count"] = len(text_tokens)
     if files:
         file_counts = []
-        for upload in files:
-            try:
-                content = (await upload.read()).decode("utf-8", errors="replace")
-                tokens = tokenizer_count_service.tokenizer.encode(content)
-                file_counts.append({
-                    "filename": upload.filename,
-                    "token_count": len(tokens),
-                    "token_ids": tokens
-                })
-            except Exception as e:
-                file_counts.append({
-                    "filename": upload.filename,
-                    "error": str(e)
-                })
+        for filename, tokens, error in file_tokens:
+            if error:
+                file_counts.append({"filename": filename, "error": error})
+                continue
+            file_count = {"filename": filename, "token_count": len(tokens)}
+            if mode != "counts":
+                file_count["token_ids"] = render_ids(tokens)
+            file_counts.append(file_count)
         result["files"] = file_counts
     if history:
         for idx, msg in enumerate(history):
             if msg["role"] == "system" and idx == 0:
                 continue  # skip system prompt
             if msg["role"] in ("user", "system"):
-                msg["tokens"] = len(tokenizer_count_service.tokenizer.encode(msg["content"]))
+                msg["tokens"] = tokenizer_count_service.tokenizer.count(msg["content"])
                 result["history"] = msg
                 result["history_tokens"] = msg["tokens"]
-    return JSONResponse(result)
\ No newline at end of file
+    headers = {"X-Token-Width": str(width)} if mode == "base64" else None
+    return JSONResponse(result, headers=headers)
+
+@app.get("/stats")
+async def stats_endpoint():
+    """Return cache counters, upstream latency, admission queues, history compaction, prompt prefix cache and tokenizer daemon use for monitoring."""
+    completion_cache = get_completion_cache()
+    compactor = get_history_compactor(get_upstream_client(os.environ["OPENAI_API_KEY"]))
+    return {
+        "upstream": get_upstream_client(os.environ["OPENAI_API_KEY"]).stats(),
+        "completion_cache": completion_cache.stats() if completion_cache else None,
+        "image_cache": image_pipeline.stats(),
+        "admission": admission.stats(),
+        "compaction": compactor.stats() if compactor else None,
+        "static_assets": static_assets.stats(),
+        "prompt_prefix_cache": get_prefix_cache().stats(),
+        "tokenizer_daemon": tokenizer_count_service.tokenizer.stats() if tokenizer_count_service.socket_path else None
+    }
\ No newline at end of file
@@ -0,0 +1,231 @@
+# batch.py
+
+# --- Imports ---
+
+# Standard library imports
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+# Local application imports
+from helpers import setup_logger
+
+# --- Setup ---
+error_logger = setup_logger('batch_error_logger', 'batch-error.log', logging.ERROR)
+audit_logger = setup_logger('batch_audit_logger', 'batch-audit.log', logging.INFO)
+
+# --- Rate limiter class ---
+
+class RateLimiter:
+    """
+    A thread-safe limiter that spaces calls evenly at a maximum rate.
+
+    Attributes
+    ----------
+    rate : float
+        Maximum calls per second; 0 or None disables limiting.
+    """
+
+    def __init__(self, rate: Optional[float] = None):
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until the caller may proceed."""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + 1 / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+# --- Batch runner class ---
+
+class BatchRunner:
+    """
+    Runs many independent prompts through the same system message, concurrently.
+
+    Each prompt is sent as its own conversation (system message + prompt).
+    Results are appended to a JSONL file as they complete, so an interrupted
+    run can be resumed: items that already have a successful result are skipped.
+
+    Attributes
+    ----------
+    tokenizer : Tokenizer
+        Used for per-item token counts.
+
+    client : UpstreamClient
+        The shared upstream client.
+
+    system_message : str
+        The system message sent with every prompt.
+
+    concurrency : int
+        Maximum number of prompts in flight.
+
+    rate_limiter : RateLimiter
+        Spaces out request starts.
+    """
+
+    # -- Constructor --
+
+    def __init__(self, tokenizer, client, system_message: str, concurrency: int = 4, rate_limit: Optional[float] = None, model: Optional[str] = None):
+        self.tokenizer = tokenizer
+        self.client = client
+        self.system_message = system_message
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.model = model or os.getenv('GPT_MODEL_NAME', 'gpt-4.1')
+        self._write_lock = threading.Lock()
+
+    # -- Public methods --
+
+    def run(self, items: list[dict], output_path: str) -> dict:
+        """
+        Run every pending item and append its result to `output_path`.
+
+        Parameters
+        ----------
+        items : list[dict]
+            Items with `id` and `prompt` keys, see `load_batch_items`.
+
+        output_path : str
+            The JSONL results file; existing successful results are kept and skipped.
+
+        Returns
+        -------
+        dict
+            Counts of `total`, `skipped`, `succeeded` and `failed` items.
+        """
+        done = completed_ids(output_path)
+        pending = [item for item in items if item["id"] not in done]
+        summary = {"total": len(items), "skipped": len(items) - len(pending), "succeeded": 0, "failed": 0}
+        audit_logger.info(f'Batch started: {len(pending)} pending of {len(items)} item(s)')
+
+        if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            with open(output_path, "rb+") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n") # Terminate a line cut short by an interrupted run
+
+        with open(output_path, "a", encoding="utf-8") as output:
+            def process(item):
+                result = self.run_item(item)
+                with self._write_lock:
+                    output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    output.flush()
+                    summary["failed" if result["error"] else "succeeded"] += 1
+                    print(f'[{summary["succeeded"] + summary["failed"]}/{len(pending)}] {item["id"]}: {"error" if result["error"] else "ok"} ({result["latency"]:.1f}s)')
+
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                list(executor.map(process, pending))
+
+        audit_logger.info(f'Batch finished: {summary}')
+        return summary
+
+    def run_item(self, item: dict) -> dict:
+        """
+        Send one prompt and build its result record.
+
+        Parameters
+        ----------
+        item : dict
+            An item with `id` and `prompt` keys.
+
+        Returns
+        -------
+        dict
+            `id`, `prompt_tokens`, `response`, `response_tokens`, `latency` (seconds) and `error`.
+        """
+        result = {"id": item["id"], "prompt_tokens": self.tokenizer.count(item["prompt"]), "response": None, "response_tokens": 0, "latency": 0.0, "error": None}
+        messages = [
+            {"role": "system", "content": self.system_message},
+            {"role": "user", "content": item["prompt"]}
+        ]
+
+        self.rate_limiter.acquire()
+        start = time.perf_counter()
+        try:
+            response = self.client.chat_completion(model=self.model, messages=messages)
+            result["response"] = response.choices[0].message.content
+            result["response_tokens"] = self.tokenizer.count(result["response"] or "")
+        except Exception as e:
+            result["error"] = str(e)
+            error_logger.error(f'Batch item {item["id"]} failed: {e}\n{traceback.format_exc()}')
+        result["latency"] = time.perf_counter() - start
+        return result
+
+# --- Helper functions ---
+
+def load_batch_items(patterns: list[str], template: str = "{content}") -> list[dict]:
+    """
+    Load prompts from JSONL files and/or plain files.
+
+    A `.jsonl` file holds one item per line, either a JSON object with a
+    `prompt` (and optional `id`) or a JSON string. Any other file becomes one
+    prompt, rendered through `template` with `{content}` and `{path}`.
+
+    Args:
+        patterns (list[str]): File paths or glob patterns.
+        template (str): Template for plain-file prompts.
+
+    Returns:
+        list[dict]: Items with unique `id` and `prompt` keys.
+    """
+    items = []
+    for pattern in patterns:
+        paths = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        for path in paths:
+            if os.path.isdir(path):
+                continue
+            if path.endswith(".jsonl"):
+                with open(path, "r", encoding="utf-8") as f:
+                    for line_number, line in enumerate(f, start=1):
+                        if not line.strip():
+                            continue
+                        record = json.loads(line)
+                        if isinstance(record, str):
+                            record = {"prompt": record}
+                        items.append({"id": str(record.get("id", f"{path}:{line_number}")), "prompt": record["prompt"]})
+            else:
+                with open(path, "r", encoding="utf-8", errors="replace") as f:
+                    items.append({"id": path, "prompt": template.format(content=f.read(), path=path)})
+
+    seen = set()
+    for item in items:
+        if item["id"] in seen:
+            raise ValueError(f"Duplicate batch item id: {item['id']}")
+        seen.add(item["id"])
+    return items
+
+def completed_ids(output_path: str) -> set:
+    """
+    Read the ids of successful results from a previous (possibly partial) run.
+
+    Args:
+        output_path (str): The JSONL results file.
+
+    Returns:
+        set: Ids whose result has no error.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError: # A line cut short by an interrupted run
+                continue
+            if not record.get("error"):
+                done.add(record["id"])
+    return done
@@ -0,0 +1,431 @@
+# benchmarks.py
+#
+# Micro-benchmarks for pAIr's hot paths. Run one with:
+#
+#   python benchmarks.py prompt --messages 1000
+#   python benchmarks.py rank-file --ranks cl100k_base.tiktoken
+#   python benchmarks.py decode --model pair.pkl
+#   python benchmarks.py messages --messages 10000
+#   python benchmarks.py pretokenize --model pair.pkl
+#   python benchmarks.py daemon --model pair.pkl
+#   python benchmarks.py stream --model pair.pkl
+
+# --- Imports ---
+
+# Standard library imports
+import argparse
+import array
+import glob
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+
+# Local application imports
+from byte_table import ByteTableDecoder, np
+from chatbot_service import ChatSession
+from message import MESSAGE_COMPRESS_AGE, Message, compress_old_messages
+from prompt_builder import PrefixCache, PromptBuilder
+from SimpleBytePairEncoding import BASE_WORD_PAT_STR, WORD_MAX_LENGTH, Tokenizer, bpe_train
+from tokenizer_daemon import SidecarTokenizer, TokenizerClient
+from tokenizer_init import DEFAULT_PAT_STR
+
+# --- Helpers ---
+
+def timeit(fn, repeat: int) -> float:
+    """
+    Run `fn` `repeat` times and return the mean seconds per call.
+
+    Args:
+        fn (Callable): The function to time.
+        repeat (int): Number of calls.
+
+    Returns:
+        float: Mean seconds per call.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+def sample_messages(count: int, seed: int = 0) -> list[Message]:
+    """Build a synthetic history of alternating user/assistant messages of varied length."""
+    rng = random.Random(seed)
+    words = "the quick brown fox jumps over a lazy dog while pair programming in python with markdown code".split()
+    messages = []
+    for i in range(count):
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(10, 300)))
+        if i % 7 == 0:
+            text += "\n\n```python\ndef hello():\n    print(\"Hello, World!\")\n```\n"
+        messages.append(Message("user" if i % 2 == 0 else "system", text))
+    return messages
+
+# --- Benchmarks ---
+
+def bench_prompt(args) -> None:
+    """Per-turn request assembly: full copy + JSON encode versus the cached serialized prefix."""
+    history = sample_messages(args.messages)
+    model = "gpt-4.1"
+    user_content = [{"type": "text", "text": "CONTEXT:def f(): pass\nPROMPT:What does this do?"}]
+
+    def full_copy():
+        messages = [m.to_api() for m in history]
+        messages[-1]["content"] = user_content
+        return json.dumps({"model": model, "messages": messages}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    builder = PromptBuilder()
+    for message in history:
+        builder.append(message)
+
+    def incremental():
+        return builder.build_body(model, user_content)
+
+    assert json.loads(full_copy()) == json.loads(incremental()), "Request bodies differ"
+
+    # With MESSAGE_COMPRESSION, old messages sit in compressed blocks: decompressed once and
+    # kept while within the prefix cache budget, or decompressed on every build without it
+    compressed_turns = {}
+    for label, prefix_cache in (("compressed, cached", PrefixCache()), ("compressed, no cache", PrefixCache(0))):
+        compressed = PromptBuilder(prefix_cache)
+        for message in history:
+            compressed.append(message)
+        compressed.compress_prefix(len(history) - MESSAGE_COMPRESS_AGE)
+        assert compressed.build_body(model, user_content) == incremental(), "Request bodies differ"
+
+        def compressed_turn(compressed=compressed):
+            for message in sample_messages(2, seed=len(history)):
+                compressed.append(message)
+            compressed.compress_prefix(compressed.message_count - MESSAGE_COMPRESS_AGE)
+            return compressed.build_body(model, user_content)
+
+        compressed_turns[label] = timeit(compressed_turn, args.repeat)
+
+    def new_turn():
+        # One turn: append the reply and the next user message, then build
+        for message in sample_messages(2, seed=len(history)):
+            builder.append(message)
+        return builder.build_body(model, user_content)
+
+    baseline = timeit(full_copy, args.repeat)
+    cached = timeit(incremental, args.repeat)
+    turn = timeit(new_turn, args.repeat)
+    size = len(incremental())
+    print(f"history: {args.messages} messages, body {size / 1024:.0f} KiB")
+    print(f"  copy + json.dumps      {baseline * 1000:8.3f} ms/turn")
+    print(f"  cached prefix          {cached * 1000:8.3f} ms/turn ({baseline / cached:.1f}x)")
+    print(f"  append 2 + build       {turn * 1000:8.3f} ms/turn")
+    for label, seconds in compressed_turns.items():
+        print(f"  {label:22} {seconds * 1000:8.3f} ms/turn (append 2 + build)")
+
+def load_corpus(paths: list[str]) -> list[str]:
+    """Read benchmark input texts; defaults to the sample chat log and the project's sources."""
+    texts = []
+    for pattern in paths or ["sample-training-data.log", "*.py", "static/*.js"]:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                texts.append(f.read())
+    return texts
+
+def bench_rank_file(args) -> None:
+    """Count throughput with a tiktoken-format rank file (e.g. a 100k+ vocab)."""
+    start = time.perf_counter()
+    tokenizer = Tokenizer.load_tiktoken_bpe(args.ranks, args.pat_str)
+    load_seconds = time.perf_counter() - start
+    texts = load_corpus(args.inputs)
+    total_bytes = sum(len(t.encode("utf-8")) for t in texts)
+
+    def count_all():
+        return sum(len(tokenizer.encode(t)) for t in texts)
+
+    cold = timeit(count_all, 1) # First pass fills the word cache
+    tokens = count_all()
+    warm = timeit(count_all, args.repeat)
+    print(f"vocab: {len(tokenizer.mergeable_ranks)} ranks, loaded in {load_seconds:.2f} s")
+    print(f"input: {len(texts)} texts, {total_bytes / 1024:.0f} KiB, {tokens} tokens ({total_bytes / tokens:.2f} bytes/token)")
+    print(f"  cold cache  {total_bytes / cold / 2**20:8.2f} MiB/s  {tokens / cold:12.0f} tokens/s")
+    print(f"  warm cache  {total_bytes / warm / 2**20:8.2f} MiB/s  {tokens / warm:12.0f} tokens/s")
+
+def bench_decode(args) -> None:
+    """Decode throughput: per-token dict lookups versus the flat byte table."""
+    if args.ranks:
+        tokenizer = Tokenizer.load_tiktoken_bpe(args.ranks)
+    else:
+        tokenizer = Tokenizer.load_model(args.model)
+    sequences = [tokenizer.encode(text) for text in load_corpus(args.inputs)] * args.copies
+    total_tokens = sum(len(tokens) for tokens in sequences)
+    total_bytes = sum(len(tokenizer.decode_bytes(tokens)) for tokens in sequences)
+    print(f"vocab: {len(tokenizer.mergeable_ranks)} ranks; input: {len(sequences)} sequences, {total_tokens} tokens, {total_bytes / 1024:.0f} KiB")
+
+    baseline = timeit(lambda: [tokenizer.decode_bytes(tokens) for tokens in sequences], args.repeat)
+    print(f"  dict lookups           {total_tokens / baseline / 1e6:8.2f} M tokens/s")
+
+    buffers = [array.array("I", tokens) for tokens in sequences]
+    candidates = [("itemgetter, array", False, buffers)]
+    if np is not None:
+        candidates.append(("numpy, batch", True, [np.asarray(tokens, dtype=np.uint32) for tokens in sequences]))
+    for name, use_numpy, inputs in candidates:
+        decoder = ByteTableDecoder.from_tokenizer(tokenizer, use_numpy=use_numpy)
+        assert decoder.decode_bytes_batch(inputs) == [tokenizer.decode_bytes(tokens) for tokens in sequences], "Decoded bytes differ"
+        seconds = timeit(lambda: decoder.decode_bytes_batch(inputs), args.repeat)
+        print(f"  {name:22} {total_tokens / seconds / 1e6:8.2f} M tokens/s ({baseline / seconds:.1f}x)")
+
+def measure(build) -> tuple[object, int]:
+    """
+    Call `build` and return its result with the bytes it left allocated.
+
+    Args:
+        build (Callable): Builds the object to measure.
+
+    Returns:
+        tuple: The result and its retained size in bytes (tracemalloc).
+    """
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+def bench_messages(args) -> None:
+    """Memory of a long history: dict messages versus compact (and compressed) `Message` objects."""
+    # Message contents cut from real text, so compression ratios are realistic. They are kept
+    # encoded and decoded inside each measurement, so every history owns its strings.
+    corpus = "\n".join(load_corpus(args.inputs))
+    rng = random.Random(0)
+    contents = []
+    for _ in range(args.messages):
+        start = rng.randrange(len(corpus))
+        contents.append(corpus[start:start + rng.randint(20, 2000)].encode("utf-8"))
+    roles = ["user" if i % 2 == 0 else "system" for i in range(args.messages)]
+    content_bytes = sum(len(c) for c in contents)
+    print(f"history: {args.messages} messages, {content_bytes / 2**20:.1f} MiB of content")
+
+    def dicts():
+        # The previous representation; `"".join` gives each role its own string, as when read from JSON or a database
+        return deque({"id": f"{i:032x}", "role": "".join(role), "content": content.decode("utf-8"), "tokens": 0} for i, (role, content) in enumerate(zip(roles, contents)))
+
+    def messages():
+        return deque(Message("".join(role), content.decode("utf-8"), 0, f"{i:032x}") for i, (role, content) in enumerate(zip(roles, contents)))
+
+    def compressed():
+        history = messages()
+        compress_old_messages(history)
+        return history
+
+    _, dict_size = measure(dicts)
+    _, message_size = measure(messages)
+    history, compressed_size = measure(compressed)
+    print(f"  dict messages          {dict_size / 2**20:8.2f} MiB")
+    print(f"  Message (slots)        {message_size / 2**20:8.2f} MiB ({1 - message_size / dict_size:.0%} smaller)")
+    print(f"  Message, compressed    {compressed_size / 2**20:8.2f} MiB ({1 - compressed_size / dict_size:.0%} smaller, {sum(m.compressed for m in history)} compressed)")
+
+    # A whole web app session: history plus the serialized prompt in its PromptBuilder
+    tokenizer = Tokenizer.load_model(args.model)
+
+    def session(compression):
+        chat = ChatSession(args.model, tokenizer=tokenizer)
+        chat.compression = compression
+        chat.token_limit = float("inf") # Keep all messages
+        for role, content in zip(roles, contents):
+            chat.add_message(role, content.decode("utf-8"))
+        return chat
+
+    sessions = {compression: measure(lambda: session(compression)) for compression in (False, True)}
+    plain_size = sessions[False][1]
+    for compression, (chat, size) in sessions.items():
+        label = "ChatSession compressed" if compression else "ChatSession"
+        print(f"  {label:22} {size / 2**20:8.2f} MiB ({1 - size / plain_size:.0%} smaller; prompt buffer {chat.prompt.buffer_bytes / 2**20:.2f} MiB, compressed blocks {chat.prompt.compressed_bytes / 2**20:.2f} MiB)")
+
+    start = time.perf_counter()
+    total = sum(len(m.content) for m in history)
+    print(f"  reading all compressed content: {(time.perf_counter() - start) * 1000:.1f} ms ({total / 2**20:.1f} M chars)")
+
+def code_heavy_corpus(paths: list[str], block_chars: int) -> list[str]:
+    """Fenced source files plus pathological runs: a separator line, unspaced CJK text and a long identifier."""
+    texts = [f"Here is my code:\n\n```python\n{text[:block_chars]}\n```\n\nWhat does it do?" for text in load_corpus(paths or ["*.py"])]
+    texts.append("Section\n" + "=" * block_chars + "\n")
+    texts.append("日本語のテキストは単語の間に空白がありません" * (block_chars // 22))
+    texts.append("token = " + "abcdefghij" * (block_chars // 10) + "\n")
+    return texts
+
+def bench_pretokenize(args) -> None:
+    """Encode and train cost on code-heavy input: whole pre-tokens (version 1) versus bounded ones (version 2)."""
+    ranks = (Tokenizer.load_tiktoken_bpe(args.ranks) if args.ranks else Tokenizer.load_model(args.model)).mergeable_ranks
+    texts = code_heavy_corpus(args.inputs, args.block_chars)
+    total_bytes = sum(len(t.encode("utf-8")) for t in texts)
+    # The default pattern matches fences' backticks as punctuation first; a code-first variant keeps blocks whole
+    patterns = {"default": DEFAULT_PAT_STR, "code-first": r"""(```[\s\S]*?```)|(`[^`]*`)|(\[[^\]]*\]\([^)]*\))|""" + BASE_WORD_PAT_STR}
+    print(f"input: {len(texts)} texts, {total_bytes / 1024:.0f} KiB; vocab: {len(ranks)} ranks")
+
+    for name, pat_str in patterns.items():
+        for max_word_length in (None, args.max_word_length):
+            tokenizer = Tokenizer(pat_str=pat_str, mergeable_ranks=ranks, max_word_length=max_word_length)
+            longest = max(len(word) for text in texts for word in tokenizer.pretokenize(text))
+            start = time.perf_counter()
+            tokens = sum(len(tokenizer.encode(text)) for text in texts) # Cold cache: every word is new
+            seconds = time.perf_counter() - start
+            label = f"{name}, v{tokenizer.pretokenizer_version}" + (f" (max {max_word_length})" if max_word_length else "")
+            print(f"  encode {label:28} {seconds * 1000:9.1f} ms  {total_bytes / seconds / 2**20:6.2f} MiB/s  {tokens:7} tokens  longest word {longest}")
+
+    training_data = "".join(texts)
+    for max_word_length in (None, args.max_word_length):
+        start = time.perf_counter()
+        bpe_train(training_data, args.train_vocab, patterns["code-first"], max_word_length)
+        print(f"  train code-first, {args.train_vocab} ranks{f', max {max_word_length}' if max_word_length else ''}: {time.perf_counter() - start:.2f} s")
+
+def bench_stream(args) -> None:
+    """Streaming: incremental decoding and counting versus re-processing everything received so far."""
+    if args.ranks:
+        tokenizer = Tokenizer.load_tiktoken_bpe(args.ranks)
+    else:
+        tokenizer = Tokenizer.load_model(args.model)
+    text = "\n".join(load_corpus(args.inputs))[:args.chars]
+    tokens = tokenizer.encode(text)
+    id_chunks = [tokens[i:i + args.chunk_tokens] for i in range(0, len(tokens), args.chunk_tokens)]
+    text_chunks = [tokenizer.decode(chunk) for chunk in id_chunks] # About what a streamed reply delivers per event
+    print(f"input: {len(text)} characters, {len(tokens)} tokens in {len(id_chunks)} chunks of {args.chunk_tokens}")
+
+    def redecode():
+        received, previous, deltas = [], "", []
+        for chunk in id_chunks:
+            received.extend(chunk)
+            current = tokenizer.decode(received)
+            deltas.append(current[len(previous):])
+            previous = current
+        return "".join(deltas)
+
+    def incremental_decode():
+        decoder = tokenizer.incremental_decoder()
+        return "".join(decoder.feed(chunk) for chunk in id_chunks) + decoder.flush()
+
+    def recount():
+        received = ""
+        for chunk in text_chunks:
+            received += chunk
+            tokenizer.count(received)
+
+    def incremental_count():
+        counter = tokenizer.incremental_counter()
+        for chunk in text_chunks:
+            counter.feed(chunk)
+        return counter.finish()
+
+    assert incremental_decode() == tokenizer.decode(tokens), "Decoded text differs"
+    assert incremental_count() == tokenizer.count("".join(text_chunks)), "Token count differs"
+    for name, full, incremental in (("decode", redecode, incremental_decode), ("count", recount, incremental_count)):
+        full_seconds = timeit(full, args.repeat)
+        incremental_seconds = timeit(incremental, args.repeat)
+        print(f"  {name:8} from start {full_seconds * 1000:9.2f} ms  incremental {incremental_seconds * 1000:8.2f} ms ({full_seconds / incremental_seconds:.0f}x)")
+
+# --- Main ---
+
+def bench_daemon(args) -> None:
+    """Round-trip overhead of the tokenizer daemon versus in-process calls, both with warm caches."""
+    if args.ranks:
+        tokenizer = Tokenizer.load_tiktoken_bpe(args.ranks)
+        source = ["--ranks", args.ranks]
+    else:
+        tokenizer = Tokenizer.load_model(args.model)
+        source = ["--model", args.model]
+    corpus = "\n".join(load_corpus(args.inputs))
+    messages = [corpus[i:i + args.message_chars] for i in range(0, len(corpus), args.message_chars)][:args.messages]
+    print(f"vocab: {len(tokenizer.mergeable_ranks)} ranks; input: {len(messages)} messages of up to {args.message_chars} characters")
+
+    socket_path = os.path.join(tempfile.mkdtemp(), "tokenizer.sock")
+    daemon = subprocess.Popen([sys.executable, "tokenizer_daemon.py", "--socket", socket_path] + source, stdout=subprocess.DEVNULL)
+    try:
+        client = TokenizerClient(socket_path)
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                client.info()
+                break
+            except OSError:
+                if time.monotonic() > deadline or daemon.poll() is not None:
+                    raise
+                time.sleep(0.1)
+        sidecar = SidecarTokenizer(client, lambda: tokenizer)
+
+        assert sidecar.encode_batch(messages) == [tokenizer.encode(message) for message in messages], "Encoded ids differ"
+        candidates = [
+            ("encode, per message", lambda: [tokenizer.encode(m) for m in messages], lambda: [sidecar.encode(m) for m in messages]),
+            ("count, per message", lambda: [tokenizer.count(m) for m in messages], lambda: [sidecar.count(m) for m in messages]),
+            ("encode, one batch", lambda: [tokenizer.encode(m) for m in messages], lambda: sidecar.encode_batch(messages)),
+            ("count, one batch", lambda: [tokenizer.count(m) for m in messages], lambda: sidecar.count_batch(messages))
+        ]
+        print(f"  {'':22} {'in-process':>12} {'daemon':>12} {'overhead':>12}")
+        for name, local, remote in candidates:
+            local_seconds = timeit(local, args.repeat) / len(messages)
+            remote_seconds = timeit(remote, args.repeat) / len(messages)
+            print(f"  {name:22} {local_seconds * 1e6:9.1f} us {remote_seconds * 1e6:9.1f} us {(remote_seconds - local_seconds) * 1e6:+9.1f} us per message")
+        assert sidecar.stats()["local_calls"] == 0, "The daemon was not used"
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description="pAIr micro-benchmarks.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    prompt = subparsers.add_parser("prompt", help=bench_prompt.__doc__)
+    prompt.add_argument("--messages", type=int, default=1000)
+    prompt.add_argument("--repeat", type=int, default=50)
+    prompt.set_defaults(run=bench_prompt)
+
+    rank_file = subparsers.add_parser("rank-file", help=bench_rank_file.__doc__)
+    rank_file.add_argument("--ranks", required=True, help="Path to a tiktoken-format rank file")
+    rank_file.add_argument("--pat-str", help="Pre-tokenization pattern (default: cl100k_base)")
+    rank_file.add_argument("--repeat", type=int, default=5)
+    rank_file.add_argument("inputs", nargs="*", help="Input file globs")
+    rank_file.set_defaults(run=bench_rank_file)
+
+    decode = subparsers.add_parser("decode", help=bench_decode.__doc__)
+    decode.add_argument("--model", default="pair.pkl", help="Path to a trained model")
+    decode.add_argument("--ranks", help="Path to a tiktoken-format rank file (instead of --model)")
+    decode.add_argument("--copies", type=int, default=10, help="Repeat the corpus to make a larger batch")
+    decode.add_argument("--repeat", type=int, default=5)
+    decode.add_argument("inputs", nargs="*", help="Input file globs")
+    decode.set_defaults(run=bench_decode)
+
+    messages = subparsers.add_parser("messages", help=bench_messages.__doc__)
+    messages.add_argument("--messages", type=int, default=10000)
+    messages.add_argument("--model", default="pair.pkl", help="Path to a trained model, for session token counts")
+    messages.add_argument("inputs", nargs="*", help="Input file globs (message contents are cut from these)")
+    messages.set_defaults(run=bench_messages)
+
+    pretokenize = subparsers.add_parser("pretokenize", help=bench_pretokenize.__doc__)
+    pretokenize.add_argument("--model", default="pair.pkl", help="Path to a trained model (its ranks are reused)")
+    pretokenize.add_argument("--ranks", help="Path to a tiktoken-format rank file (instead of --model)")
+    pretokenize.add_argument("--max-word-length", type=int, default=WORD_MAX_LENGTH or 256)
+    pretokenize.add_argument("--block-chars", type=int, default=4000, help="Size of each fenced block and pathological run")
+    pretokenize.add_argument("--train-vocab", type=int, default=320)
+    pretokenize.add_argument("inputs", nargs="*", help="Source file globs to fence (default: *.py)")
+    pretokenize.set_defaults(run=bench_pretokenize)
+
+    daemon = subparsers.add_parser("daemon", help=bench_daemon.__doc__)
+    daemon.add_argument("--model", default="pair.pkl", help="Path to a trained model")
+    daemon.add_argument("--ranks", help="Path to a tiktoken-format rank file (instead of --model)")
+    daemon.add_argument("--messages", type=int, default=500)
+    daemon.add_argument("--message-chars", type=int, default=400, help="Characters per message cut from the corpus")
+    daemon.add_argument("--repeat", type=int, default=5)
+    daemon.add_argument("inputs", nargs="*", help="Input file globs")
+    daemon.set_defaults(run=bench_daemon)
+
+    stream = subparsers.add_parser("stream", help=bench_stream.__doc__)
+    stream.add_argument("--model", default="pair.pkl", help="Path to a trained model")
+    stream.add_argument("--ranks", help="Path to a tiktoken-format rank file (instead of --model)")
+    stream.add_argument("--chars", type=int, default=50000, help="Length of the streamed text")
+    stream.add_argument("--chunk-tokens", type=int, default=4, help="Tokens per streamed chunk")
+    stream.add_argument("--repeat", type=int, default=3)
+    stream.add_argument("inputs", nargs="*", help="Input file globs")
+    stream.set_defaults(run=bench_stream)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
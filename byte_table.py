@@ -0,0 +1,176 @@
+# byte_table.py
+
+# --- Imports ---
+
+# Standard library imports
+import array
+from operator import itemgetter
+from typing import Iterable, Optional
+
+# Third party imports (optional)
+try:
+    import numpy as np
+except ImportError: # NumPy is optional; without it ids are gathered with `operator.itemgetter`
+    np = None
+
+# --- Byte table decoder class ---
+
+class ByteTableDecoder:
+    """
+    Decodes token ids through one contiguous table of token bytes.
+
+    The bytes of token `i` are `table[offsets[i]:offsets[i + 1]]`; ids that are
+    not in the vocabulary have an empty slice, so the output is identical to
+    `Tokenizer.decode_bytes`, which skips them. With NumPy, a whole id buffer
+    (a list, `array.array` or NumPy array) is decoded with vectorized gathers
+    instead of a dictionary lookup per token, and a batch of sequences is
+    decoded in one pass.
+
+    Attributes
+    ----------
+    table : bytes
+        The bytes of every token, in id order.
+
+    offsets : array.array
+        Start of each token in `table`, plus the total length (int64).
+
+    vocab_size : int
+        Number of ids covered by the table (highest id + 1).
+
+    use_numpy : bool
+        Whether the vectorized NumPy path is used.
+    """
+
+    # Typecodes of `array.array` id buffers that cannot hold negative ids
+    UNSIGNED_TYPECODES = frozenset("BHILQ")
+
+    # -- Constructor --
+
+    def __init__(self, decoder: dict[int, bytes], use_numpy: Optional[bool] = None):
+        """
+        Build the table from an id -> bytes mapping (e.g. `Tokenizer._decoder`).
+
+        Parameters
+        ----------
+        decoder : dict[int, bytes]
+            The bytes of each token id.
+
+        use_numpy : bool, optional
+            Force (True) or disable (False) the NumPy path; by default it is used when installed.
+        """
+        if use_numpy and np is None:
+            raise ImportError("NumPy is required for use_numpy=True")
+        self.use_numpy = np is not None if use_numpy is None else use_numpy
+        self.vocab_size = max(decoder, default=-1) + 1
+
+        self.offsets = array.array("q", [0])
+        pieces = []
+        for token in range(self.vocab_size):
+            piece = decoder.get(token, b"")
+            pieces.append(piece)
+            self.offsets.append(self.offsets[-1] + len(piece))
+        self.table = b"".join(pieces)
+
+        if self.use_numpy:
+            self._table = np.frombuffer(self.table, dtype=np.uint8)
+            self._offsets = np.frombuffer(self.offsets, dtype=np.int64)
+            self._pieces = None
+        else:
+            # Per-id slices of the table, gathered with one C-level `itemgetter` call per sequence
+            self._pieces = pieces
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, use_numpy: Optional[bool] = None) -> "ByteTableDecoder":
+        """Build a decoder for a `Tokenizer`'s vocabulary."""
+        return cls(tokenizer._decoder, use_numpy=use_numpy)
+
+    # -- Decoding --
+
+    def decode_bytes(self, tokens) -> bytes:
+        """
+        Decode one id sequence to bytes.
+
+        Parameters
+        ----------
+        tokens : Iterable[int]
+            A list, `array.array` or NumPy array of token ids.
+
+        Returns
+        -------
+        bytes
+            The decoded bytes.
+        """
+        return self.decode_bytes_batch([tokens])[0]
+
+    def decode(self, tokens) -> str:
+        """Decode one id sequence to text, like `Tokenizer.decode`."""
+        return self.decode_bytes(tokens).decode("utf-8", errors="replace")
+
+    def decode_bytes_batch(self, sequences: Iterable) -> list[bytes]:
+        """
+        Decode many id sequences to bytes.
+
+        Parameters
+        ----------
+        sequences : Iterable
+            Id sequences (lists, `array.array` or NumPy arrays).
+
+        Returns
+        -------
+        list[bytes]
+            The decoded bytes of each sequence, in order.
+        """
+        if self.use_numpy:
+            return self._decode_numpy(list(sequences))
+        return [self._decode_array(tokens) for tokens in sequences]
+
+    def decode_batch(self, sequences: Iterable) -> list[str]:
+        """Decode many id sequences to text, like `Tokenizer.decode`."""
+        return [data.decode("utf-8", errors="replace") for data in self.decode_bytes_batch(sequences)]
+
+    # -- Decoding utilities --
+
+    def _decode_numpy(self, sequences: list) -> list[bytes]:
+        """Gather the bytes of all sequences at once, then split them per sequence."""
+        arrays = [np.asarray(tokens).astype(np.int64, copy=False).ravel() for tokens in sequences]
+        if not self.vocab_size:
+            return [b"" for _ in arrays]
+        ids = np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64)
+        token_bounds = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(a) for a in arrays], out=token_bounds[1:])
+
+        # Unknown ids decode to nothing, like `Tokenizer.decode_bytes`
+        known = (ids >= 0) & (ids < self.vocab_size)
+        ids = np.where(known, ids, 0)
+        starts = self._offsets[ids]
+        lengths = np.where(known, self._offsets[ids + 1] - starts, 0)
+
+        byte_bounds = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=byte_bounds[1:])
+        total = int(byte_bounds[-1])
+
+        # Byte j of token k comes from table[starts[k] + j]: shift a running index per token
+        index = np.arange(total, dtype=np.int64)
+        index += np.repeat(starts - byte_bounds[:-1], lengths)
+        data = self._table[index].tobytes()
+
+        sequence_bounds = byte_bounds[token_bounds].tolist()
+        return [data[start:end] for start, end in zip(sequence_bounds[:-1], sequence_bounds[1:])]
+
+    def _decode_array(self, tokens) -> bytes:
+        """Gather the table slices of a sequence (no NumPy)."""
+        unsigned = isinstance(tokens, array.array) and tokens.typecode in self.UNSIGNED_TYPECODES
+        tokens = tokens.tolist() if hasattr(tokens, "tolist") else list(tokens)
+        if len(tokens) < 2:
+            tokens.append(0) # `itemgetter` only returns a tuple for two or more ids
+            return b"".join(self._gather(tokens, unsigned)[:-1])
+        return b"".join(self._gather(tokens, unsigned))
+
+    def _gather(self, tokens: list[int], unsigned: bool) -> tuple:
+        """Look up every id's slice; unknown ids (negative or past the table) map to nothing."""
+        if unsigned or min(tokens) >= 0:
+            try:
+                return itemgetter(*tokens)(self._pieces)
+            except IndexError:
+                pass
+        return tuple(self._pieces[token] if 0 <= token < self.vocab_size else b"" for token in tokens)
@@ -5,23 +5,28 @@ import os
 import traceback
 import logging
 import datetime
+import time
 from typing import Optional
 from collections import deque
 
 # Local application imports
 from SimpleBytePairEncoding import TokenizerService
 from helpers import setup_logger, get_multi_line_input, get_default_system_message
+from upstream_client import get_upstream_client
+from message import MESSAGE_COMPRESSION, Message, compress_old_messages
 
 # Related third party imports
 from dotenv import load_dotenv
-from openai import OpenAI
 from rich import print
+from rich.console import Console
+from rich.live import Live
 from rich.markdown import Markdown
 
 # --- Setup ---
 
 # Set constants
 TOKEN_MAX_LIMIT = 1000000
+STREAM_REFRESH_PER_SECOND = 8 # Upper bound on live re-renders while streaming
 
 # Load environment vars
 load_dotenv()
@@ -30,6 +35,8 @@ load_dotenv()
 chat_logger = setup_logger('chat_logger', 'chat.log', logging.INFO)
 error_logger = setup_logger('error_logger', 'error.log', logging.ERROR)
 
+console = Console()
+
 # --- Main class ---
 class ChatBotClass:
     """
@@ -41,12 +48,15 @@ class ChatBotClass:
         The tokenizer loaded from the trained model.
 
     all_messages : deque
-        A double-ended queue to store all messages in the conversation.
+        A double-ended queue of `Message` objects: the conversation so far.
+
+    stream : bool
+        Whether replies are streamed and rendered progressively.
     """
 
     # -- Constructor --
 
-    def __init__(self, model_path: str, training_data: Optional[str] = None, vocab_size: Optional[int] = None, pat_str: Optional[str] = None):
+    def __init__(self, model_path: str, training_data: Optional[str] = None, vocab_size: Optional[int] = None, pat_str: Optional[str] = None, stream: Optional[bool] = None):
         """Initialize the ChatBotClass with a model file.
         
         Parameters
@@ -62,6 +72,9 @@ class ChatBotClass:
 
         pat_str : str, optional
             A pattern string. Required if the model file does not exist.
+
+        stream : bool, optional
+            Stream replies as they are generated. Defaults to the `CLI_STREAM` environment variable.
         """
         self.model_path = model_path
         self.train_data = training_data
@@ -70,6 +83,7 @@ class ChatBotClass:
         self.tokenizer = TokenizerService(model_path, training_data, vocab_size, pat_str).tokenizer
         
         self.all_messages = deque() # See https://docs.python.org/3/library/collections.html#collections.deque
+        self.stream = stream if stream is not None else os.getenv("CLI_STREAM", "0").lower() in ("1", "true", "yes", "on")
 
     # -- Chat token related methods --
 
@@ -86,8 +100,7 @@ class ChatBotClass:
         int
             Number of tokens in the input text.
         """
-        tokens = self.tokenizer.encode(text)
-        return len(tokens)
+        return self.tokenizer.count(text)
     
     def calculate_total_tokens(self):
         """Calculate the total number of tokens in the conversation.
@@ -97,7 +110,7 @@ class ChatBotClass:
         int
             Total number of tokens in the conversation.
         """
-        return sum([m['tokens'] for m in self.all_messages])
+        return sum(m.tokens for m in self.all_messages)
     
     def return_system_message_tokens(self):
         """Return the number of tokens in the system message.
@@ -107,7 +120,7 @@ class ChatBotClass:
         int
             Number of tokens in the system message.
         """
-        return self.all_messages[-1]['tokens']
+        return self.all_messages[-1].tokens
     
     def manage_token_limit(self, new_message_tokens: int):
         """Manage the token limit by removing messages from the conversation.
@@ -120,7 +133,7 @@ class ChatBotClass:
         total_tokens = self.calculate_total_tokens()
         while total_tokens + new_message_tokens > TOKEN_MAX_LIMIT - self.return_system_message_tokens() and len(self.all_messages) > 1:
             removed_message = self.all_messages.popleft() # See https://en.wikipedia.org/wiki/Double-ended_queue
-            total_tokens -= removed_message['tokens']
+            total_tokens -= removed_message.tokens
         return total_tokens
     
     # -- Chatbot interaction methods --
@@ -138,8 +151,8 @@ class ChatBotClass:
 
         if user_message.lower().startswith('set_system'):
             self.set_system_message()
-            chat_logger.info(f'System: {self.all_messages[-1]["content"]}')
-            print("System message set to:\n", self.all_messages[-1]["content"])
+            chat_logger.info(f'System: {self.all_messages[-1].content}')
+            print("System message set to:\n", self.all_messages[-1].content)
             user_message = None
 
         return user_message
@@ -163,21 +176,80 @@ class ChatBotClass:
         new_message_tokens = self.count_tokens(user_message)
         self.manage_token_limit(new_message_tokens)
 
-        self.all_messages.append({"role": "user", "content": user_message, "tokens": new_message_tokens})
-        messages_to_send = [{"role": m["role"], "content": m["content"]} for m in self.all_messages]
+        self.all_messages.append(Message("user", user_message, new_message_tokens))
+        messages_to_send = [m.to_api() for m in self.all_messages]
 
         generated_text = self.get_response(client, messages_to_send)
-        self.all_messages.append({"role": "system", "content": generated_text, "tokens": self.count_tokens(generated_text)})
+        self.all_messages.append(Message("system", generated_text, self.count_tokens(generated_text)))
+        if MESSAGE_COMPRESSION:
+            compress_old_messages(self.all_messages)
         self.log_message(user_message, generated_text)
         
         return Markdown(generated_text)
      
+    def chatbot_interaction_stream(self, client, user_message):
+        """
+        Stream the chatbot's reply to the terminal, rendering Markdown as it arrives.
+
+        Completed Markdown blocks are printed once; only the block still being
+        written is parsed and re-rendered, at most `STREAM_REFRESH_PER_SECOND`
+        times a second, and block boundaries are found by scanning each line
+        once, so rendering cost stays bounded as the reply grows.
+
+        Parameters
+        ----------
+        client : UpstreamClient
+            The shared upstream client.
+        user_message : str
+            Message sent by the user to the chatbot.
+
+        Returns
+        -------
+        str
+            Text generated by the chatbot.
+        """
+        new_message_tokens = self.count_tokens(user_message)
+        self.manage_token_limit(new_message_tokens)
+
+        self.all_messages.append(Message("user", user_message, new_message_tokens))
+        messages_to_send = [m.to_api() for m in self.all_messages]
+
+        generated_text = ""
+        committed = 0 # Length of the text already printed as finished blocks
+        counter = self.tokenizer.incremental_counter() # Counts the reply as it arrives, instead of re-encoding it at the end
+        scanner = MarkdownBlockScanner()
+        interval = 1 / STREAM_REFRESH_PER_SECOND
+        next_repaint = 0.0
+        console.print(">> ", end="")
+        with Live(console=console, auto_refresh=False, vertical_overflow="visible") as live:
+            for delta in self.get_response_stream(client, messages_to_send):
+                generated_text += delta
+                counter.feed(delta)
+                boundary = scanner.scan(generated_text)
+                if boundary > committed:
+                    live.console.print(Markdown(generated_text[committed:boundary]))
+                    committed = boundary
+                # The unfinished block is only parsed when a repaint is due; a repaint
+                # slower than the interval (a long open code block) delays the next as long
+                now = time.monotonic()
+                if now >= next_repaint:
+                    live.update(Markdown(generated_text[committed:]), refresh=True)
+                    next_repaint = now + max(interval, 2 * (time.monotonic() - now))
+            live.update(Markdown(generated_text[committed:]), refresh=True)
+
+        self.all_messages.append(Message("system", generated_text, counter.finish()))
+        if MESSAGE_COMPRESSION:
+            compress_old_messages(self.all_messages)
+        self.log_message(user_message, generated_text)
+
+        return generated_text
+
     def set_system_message_default(self):
         """
         Set a default system message.
         """
         default_message = get_default_system_message()
-        system_message = {"role": "system", "content": default_message, "tokens": self.count_tokens(default_message)}
+        system_message = Message("system", default_message, self.count_tokens(default_message), prompt=True)
         self.all_messages.append(system_message)
         return system_message
     
@@ -187,10 +259,10 @@ class ChatBotClass:
 
         Returns
         -------
-        dict
-            System message in predefined format.
+        Message
+            The new system message.
         """
-        append = False if input(f"Do you want to append to the current system message?\n{self.all_messages[-1]}\n(y/n): ").lower() == 'n' else True
+        append = False if input(f"Do you want to append to the current system message?\n{self.all_messages[-1].content}\n(y/n): ").lower() == 'n' else True
         print("Enter the system message (press 'ctrl-d' to send):")
         content = get_multi_line_input(">>> ")
         
@@ -198,9 +270,9 @@ class ChatBotClass:
             return self.set_system_message_default()
         
         if append:
-            content = f'{self.all_messages[-1]["content"]}\n\n{content}'
+            content = f'{self.all_messages[-1].content}\n\n{content}'
 
-        system_message = {"role": "system", "content": content, "tokens": self.count_tokens(content)}
+        system_message = Message("system", content, self.count_tokens(content), prompt=True)
 
         # Add system message to the list of messages
         self.all_messages.append(system_message)
@@ -223,27 +295,27 @@ class ChatBotClass:
     # -- OpenAI API methods --
 
     def setup_openai_api_client(self):
-        """Initialize the OpenAI API client with the API key from the environment.
+        """Get the shared upstream client for the API key from the environment.
 
         Returns
         -------
-        client : object
-            An instance of the OpenAI client.
+        client : UpstreamClient
+            The pooled, retrying upstream client.
 
         Raises
         -------
         KeyError
             If 'OPENAI_API_KEY' not found in the environment.
         """
-        return OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+        return get_upstream_client(os.environ['OPENAI_API_KEY'])
     
     def get_response(self, client, messages_to_send):
         """Get the response from the chatbot.
 
         Parameters
         ----------
-        client : object
-            An instance of the OpenAI client.
+        client : UpstreamClient
+            The shared upstream client.
         messages_to_send : list
             List of messages to send to the chatbot.
 
@@ -252,9 +324,28 @@ class ChatBotClass:
         str
             Text generated by the chatbot.
         """
-        response = client.chat.completions.create(model=os.getenv('GPT_MODEL_NAME', 'gpt-4.1'), messages=messages_to_send)
+        response = client.chat_completion(model=os.getenv('GPT_MODEL_NAME', 'gpt-4.1'), messages=messages_to_send)
         return response.choices[0].message.content
 
+    def get_response_stream(self, client, messages_to_send):
+        """Stream the response from the chatbot.
+
+        Parameters
+        ----------
+        client : UpstreamClient
+            The shared upstream client.
+        messages_to_send : list
+            List of messages to send to the chatbot.
+
+        Yields
+        ------
+        str
+            Text deltas generated by the chatbot.
+        """
+        for chunk in client.stream_chat_completion(model=os.getenv('GPT_MODEL_NAME', 'gpt-4.1'), messages=messages_to_send):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
     @staticmethod
     def default_system_message():
         return get_default_system_message()
@@ -272,7 +363,57 @@ class ChatBotClass:
                     continue
                 elif user_message.lower() == 'quit':
                     break
-                response = self.chatbot_interaction(client, user_message)
-                print(">> ", response, end="")
+                if self.stream:
+                    self.chatbot_interaction_stream(client, user_message)
+                else:
+                    response = self.chatbot_interaction(client, user_message)
+                    print(">> ", response, end="")
             except Exception as e:
                 error_logger.error(f'An error occurred: {e}\n{traceback.format_exc()}')
+
+# --- Helper functions ---
+
+class MarkdownBlockScanner:
+    """Find where the finished Markdown blocks of a growing reply end.
+
+    A block is finished at a blank line outside a fenced code block. Each
+    call scans only the lines completed since the previous call, keeping
+    the fence state in between, so a whole reply is scanned once (a long
+    fenced block is not rescanned on every delta).
+
+    Attributes
+    ----------
+    boundary : int
+        Offset just after the last finished block.
+    """
+
+    def __init__(self):
+        self.boundary = 0
+        self.in_fence = False
+        self._scanned = 0 # Offset of the first line not yet complete
+
+    def scan(self, text: str) -> int:
+        """Scan the lines of `text` completed since the last call.
+
+        Parameters
+        ----------
+        text : str
+            The reply received so far (the previous text plus new deltas).
+
+        Returns
+        -------
+        int
+            Offset just after the last finished block.
+        """
+        end = text.rfind("\n", self._scanned) + 1
+        if end == 0:
+            return self.boundary # No new complete line
+        position = self._scanned
+        for line in text[self._scanned:end].splitlines(keepends=True):
+            position += len(line)
+            if line.lstrip().startswith(("```", "~~~")):
+                self.in_fence = not self.in_fence
+            elif not self.in_fence and not line.strip():
+                self.boundary = position
+        self._scanned = end
+        return self.boundary
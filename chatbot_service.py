@@ -1,77 +1,226 @@
 # chatbot_service.py
 
 import os
+import base64
+import threading
+import uuid
 from collections import deque
 from SimpleBytePairEncoding import TokenizerService
-from openai import OpenAI
 from helpers import get_default_system_message
+from compaction import get_history_compactor
+from completion_cache import CompletionCache, get_completion_cache
+from upstream_client import get_upstream_client
+from prompt_builder import PromptBuilder
+from message import MESSAGE_COMPRESS_AGE, MESSAGE_COMPRESSION, Message, compress_old_messages
+from retrieval import ContextIndex
 from typing import List, Optional
 from pydantic import BaseModel
 
-TOKEN_MAX_LIMIT = 1000000
+TOKEN_MAX_LIMIT = int(os.getenv("TOKEN_MAX_LIMIT", "1000000"))
 
 class ChatSession:
     """
     Manages a single chat session with conversation history and token management.
+
+    With a `SessionStore`, the history is loaded lazily from the store on first
+    use, every change is persisted, and `refresh` picks up messages written by
+    other workers. A new session's default system prompt is only persisted
+    with its first write, so requests that only read never create sessions.
+
+    The history is also kept pre-serialized in a `PromptBuilder`, so each turn
+    only encodes the new messages when the request body is built.
+
+    Messages are compact `Message` objects; with `MESSAGE_COMPRESSION` enabled,
+    the content of older messages, and their serialized form in the prompt
+    builder, is compressed in memory.
+
+    Old messages can be replaced by a summary (see `replace_messages` and
+    `HistoryCompactor`); `manage_token_limit` evicts the oldest messages only
+    when the history still exceeds the token limit.
     """
-    def __init__(self, model_path, training_data=None, vocab_size=None, pat_str=None):
-        self.tokenizer = TokenizerService(model_path, training_data, vocab_size, pat_str).tokenizer
+    def __init__(self, model_path, training_data=None, vocab_size=None, pat_str=None, session_id=None, store=None, tokenizer=None):
+        # A shared tokenizer (e.g. loaded from an upstream rank file) avoids loading the model per session
+        self.tokenizer = tokenizer or TokenizerService(model_path, training_data, vocab_size, pat_str).tokenizer
         self.token_limit = TOKEN_MAX_LIMIT
-        self.all_messages = deque()
+        self.session_id = session_id or uuid.uuid4().hex
+        self.store = store
+        self._messages = deque()
+        self._loaded = store is None
+        self._store_position = 0
+        self.prompt = PromptBuilder()
+        self._prompt_stale = False
+        self.compression = MESSAGE_COMPRESSION
+        self._unsaved = [] # Messages not persisted yet: a new session's default system prompt, until its first write
+
+    @property
+    def all_messages(self):
+        if not self._loaded:
+            self._loaded = True
+            self.refresh()
+        return self._messages
+
+    def refresh(self):
+        """Apply events other workers have persisted for this session since the last refresh."""
+        if self.store is None:
+            return
+        self._store_position, events = self.store.load(self.session_id, self._store_position)
+        if not events:
+            return
+        if self._unsaved:
+            # Another worker wrote this session first; its history (and system prompt) wins
+            unsaved = {m.id for m in self._unsaved}
+            self._messages = deque(m for m in self._messages if m.id not in unsaved)
+            self._prompt_stale = True
+            self._unsaved = []
+        known_ids = {m.id for m in self._messages}
+        for event in events:
+            if event["op"] == "add":
+                if event["message"]["id"] not in known_ids:
+                    message = Message.from_dict(event["message"])
+                    self._messages.append(message)
+                    self.prompt.append(message)
+                    known_ids.add(message.id)
+            elif event["op"] == "replace":
+                if event["message"]["id"] not in known_ids and self._replace_span(event["ids"], Message.from_dict(event["message"])):
+                    self._prompt_stale = True
+                    known_ids -= set(event["ids"])
+                    known_ids.add(event["message"]["id"])
+            else:
+                removed = set(event["ids"])
+                self._messages = deque(m for m in self._messages if m.id not in removed)
+                self._prompt_stale = True
+                known_ids -= removed
+        if self.compression:
+            self._compress_old_messages()
 
     def count_tokens(self, text: str) -> int:
-        return len(self.tokenizer.encode(text))
+        return self.tokenizer.count(text)
 
     def calculate_total_tokens(self):
-        return sum([m['tokens'] for m in self.all_messages])
+        return sum(m.tokens for m in self.all_messages)
 
     def manage_token_limit(self, new_message_tokens: int):
         total_tokens = self.calculate_total_tokens()
+        removed_ids = []
         while total_tokens + new_message_tokens > self.token_limit and len(self.all_messages) > 1:
             removed_message = self.all_messages.popleft()
-            total_tokens -= removed_message['tokens']
+            removed_ids.append(removed_message.id)
+            total_tokens -= removed_message.tokens
+            self._prompt_stale = True
+        if self.store is not None:
+            self.store.remove(self.session_id, removed_ids)
         return total_tokens
 
-    def add_message(self, role, content):
+    def replace_messages(self, message_ids, message):
+        """
+        Replace a contiguous span of messages with one message (e.g. a summary of them).
+
+        Returns False, changing nothing, if the span is no longer in the history
+        as given (e.g. trimmed or compacted meanwhile).
+        """
+        if not self._replace_span(message_ids, message):
+            return False
+        self._prompt_stale = True
+        if self.store is not None:
+            self.store.replace(self.session_id, message_ids, message.to_dict())
+        return True
+
+    def _replace_span(self, message_ids, message):
+        messages = list(self.all_messages)
+        start = next((i for i, m in enumerate(messages) if m.id == message_ids[0]), None) if message_ids else None
+        if start is None or [m.id for m in messages[start:start + len(message_ids)]] != list(message_ids):
+            return False
+        self._messages = deque(messages[:start] + [message] + messages[start + len(message_ids):])
+        return True
+
+    def add_message(self, role, content, persist=True, prompt=False):
         tokens = self.count_tokens(content)
         self.manage_token_limit(tokens)
-        self.all_messages.append({"role": role, "content": content, "tokens": tokens})
+        message = Message(role, content, tokens, prompt=prompt)
+        self.all_messages.append(message)
+        self.prompt.append(message)
+        if self.store is not None:
+            if not persist:
+                self._unsaved.append(message)
+            else:
+                for unsaved in self._unsaved:
+                    if unsaved in self._messages:
+                        self.store.append(self.session_id, unsaved.to_dict())
+                self._unsaved = []
+                self.store.append(self.session_id, message.to_dict())
+        if self.compression:
+            self._compress_old_messages()
+
+    def build_request_body(self, model, last_content=None, options=None) -> bytes:
+        messages = self.all_messages
+        if self._prompt_stale:
+            self.prompt.reset(messages)
+            self._prompt_stale = False
+            if self.compression:
+                self.prompt.compress_prefix(len(messages) - MESSAGE_COMPRESS_AGE)
+        return self.prompt.build_body(model, last_content, options)
+
+    def _compress_old_messages(self):
+        # The serialized prompt holds a copy of every message too, so its old span is compressed alongside
+        compress_old_messages(self._messages)
+        if not self._prompt_stale:
+            self.prompt.compress_prefix(len(self._messages) - MESSAGE_COMPRESS_AGE)
 
     def get_messages(self):
-        return [{"role": m["role"], "content": m["content"]} for m in self.all_messages]
+        return [m.to_api() for m in self.all_messages]
 
-    def set_system_message(self, content=None):
+    def set_system_message(self, content=None, persist=True):
         if content is None:
             content = get_default_system_message()
-        self.add_message("system", content)
+        self.add_message("system", content, persist, prompt=True)
+
+    def flush(self):
+        """Block until this session's writes are committed, so the next request reads them on any worker; raises if they failed."""
+        if self.store is not None and not self._unsaved:
+            self.store.flush()
 
     def get_system_message(self):
         for m in reversed(self.all_messages):
-            if m["role"] == "system":
-                return m["content"]
+            if m.role == "system":
+                return m.content
         return None
 
 class ChatBotService:
     """
     Provides chat interaction using OpenAI API and manages chat sessions.
     """
-    def __init__(self, model_path, openai_api_key, **kwargs):
+    def __init__(self, model_path, openai_api_key, retrieval=None, **kwargs):
         self.model_path = model_path
         self.openai_api_key = openai_api_key
         self.session = ChatSession(model_path, **kwargs)
-        self.client = OpenAI(api_key=openai_api_key)
-        # Ensure a system message is set at startup
+        # Retrieval mode sends only the context file chunks most relevant to the prompt
+        self.retrieval = retrieval if retrieval is not None else os.getenv("CONTEXT_RETRIEVAL", "0").lower() in ("1", "true", "yes", "on")
+        self.retrieval_token_budget = int(os.getenv("RETRIEVAL_TOKEN_BUDGET", "4000"))
+        self.context_index = ContextIndex(self.session.tokenizer) if self.retrieval else None
+        self.client = get_upstream_client(openai_api_key) # Shared across sessions, so connections are reused
+        self.cache = get_completion_cache() # None unless COMPLETION_CACHE is enabled
+        self.compactor = get_history_compactor(self.client) # None unless HISTORY_COMPACTION is enabled
+        self.lock = threading.Lock() # Serializes turns of this session across worker threads
+        self.state_lock = threading.RLock() # Guards the history for short reads and writes; never held across an upstream call
+        # Ensure a system message is set at startup; a new session is only persisted on its first write
         if not self.session.get_system_message():
-            self.set_system_message()
+            self.session.set_system_message(persist=False)
 
     def set_system_message(self, content=None):
-        self.session.set_system_message(content)
+        # Only the short state lock, so a turn waiting on the upstream does not delay it
+        with self.state_lock:
+            self.session.refresh()
+            self.session.set_system_message(content)
+        self.session.flush()
 
-    def chat(self, user_message, context_file_contents=None, web_search_options=None, images=None):
-        # If context file contents are provided, concatenate and prepend
+    def chat(self, user_message, context_file_contents=None, web_search_options=None, images=None, context_file_names=None):
+        # If context file contents are provided, concatenate (or retrieve from) and prepend
         context_str = ""
         if context_file_contents:
-            context_str = "\n".join(context_file_contents)
+            if self.retrieval:
+                context_str = self.retrieve_context(user_message, context_file_contents, context_file_names)
+            else:
+                context_str = "\n".join(context_file_contents)
         # For vision: add images as message content parts
         user_content = []
         if context_file_contents:
@@ -80,30 +229,53 @@ class ChatBotService:
             user_content.append({"type": "text", "text": user_message})
         if images:
             for img in images:
-                import base64
-                base64_data = base64.b64encode(img["content"]).decode("utf-8")
+                # Images from ImagePipeline arrive pre-encoded; raw uploads are encoded here
+                url = img.get("data_url")
+                if url is None:
+                    base64_data = base64.b64encode(img["content"]).decode("utf-8")
+                    url = f"data:{img['content_type']};base64,{base64_data}"
                 user_content.append({
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:{img['content_type']};base64,{base64_data}",
-                        "detail": "auto"
+                        "url": url,
+                        "detail": img.get("detail", "auto")
                     }
                 })
-        # Store only the user prompt in history, not the context or images
-        self.session.add_message("user", user_message)
-        messages_to_send = self.session.get_messages()
-        # Overwrite last user message in history
-        if user_content and messages_to_send:
-            messages_to_send[-1]["content"] = user_content
-
-        response = self.client.chat.completions.create(
-            model=os.getenv('GPT_MODEL_NAME', 'gpt-4.1'),
-            messages=messages_to_send,
-            **({"web_search_options": web_search_options} if web_search_options else {})
-        )
-        reply = response.choices[0].message.content
-        self.session.add_message("system", reply)
+        model = os.getenv('GPT_MODEL_NAME', 'gpt-4.1')
+        options = {"web_search_options": web_search_options} if web_search_options else {}
+        with self.state_lock:
+            # Store only the user prompt in history, not the context or images
+            self.session.add_message("user", user_message)
+            # The last user message is sent with its context and images attached
+            body = self.session.build_request_body(model, user_content, options)
+
+        def complete():
+            response = self.client.chat_completion_body(body)
+            return response.choices[0].message.content
+
+        if self.cache is not None:
+            reply = self.cache.get_or_compute(CompletionCache.make_body_key(body), complete)
+        else:
+            reply = complete()
+        with self.state_lock:
+            self.session.add_message("system", reply)
+            if self.compactor is not None:
+                self.compactor.maybe_compact(self.session, self.state_lock)
+        self.session.flush() # Durable before the reply is returned, so the next turn finds it on any worker
         return reply
 
+    def retrieve_context(self, user_message, context_file_contents, context_file_names=None):
+        """Index the attached files (once per content) and join the chunks that best match the prompt, or their leading chunks."""
+        names = context_file_names or [None] * len(context_file_contents)
+        attached = set()
+        for content, name in zip(context_file_contents, names):
+            attached.update(self.context_index.add_file(content, name))
+        self.context_index.trim(keep=attached) # Bound the index by dropping files attached longest ago
+        chunks = self.context_index.select(user_message, self.retrieval_token_budget, restrict_to=attached)
+        return self.context_index.render(chunks)
+
     def get_history(self):
-        return self.session.get_messages()
\ No newline at end of file
+        """Return a snapshot of the history, including turns other workers committed; a turn in flight does not delay it."""
+        with self.state_lock:
+            self.session.refresh()
+            return self.session.get_messages()
\ No newline at end of file
@@ -0,0 +1,238 @@
+# compaction.py
+
+# --- Imports ---
+
+# Standard library imports
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+# Local application imports
+from completion_cache import CompletionCache
+from helpers import setup_logger
+from message import Message
+
+# --- Setup ---
+error_logger = setup_logger('compaction_error_logger', 'compaction-error.log', logging.ERROR)
+
+# Summary messages start with this, so a later compaction can fold them into the next summary
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+SUMMARY_INSTRUCTIONS = (
+    "You compact chat histories. Summarize the conversation below so it can replace it as context: "
+    "keep the user's goals, decisions, facts, names, numbers, code identifiers and open questions, "
+    "drop pleasantries and repetition. Reply with the summary only."
+)
+
+# --- History compactor class ---
+
+class HistoryCompactor:
+    """
+    Replaces old chat history with a model-generated summary before the token limit is reached.
+
+    Once a session's history crosses `threshold` of its token limit, the
+    messages before the `keep_recent` newest, back to the latest system
+    prompt before them (or the start of the history, after trimming), are
+    summarized in the background and replaced by one `system` summary
+    message with its own token count. System prompts are never summarized. Summaries are cached by the
+    exact span they replace (memory and disk, see `CompletionCache`), so a
+    span is only summarized once, even by several workers. Eviction in
+    `ChatSession.manage_token_limit` remains the hard limit.
+
+    Attributes
+    ----------
+    client : UpstreamClient
+        Sends the summary requests.
+
+    model : str
+        The model that writes summaries (default: `HISTORY_COMPACTION_MODEL`, else `GPT_MODEL_NAME`).
+
+    threshold : float
+        Share of the session token limit that triggers compaction.
+
+    keep_recent : int
+        Newest messages that are always kept verbatim.
+
+    min_messages : int
+        Fewest messages worth replacing with a summary.
+
+    max_summary_tokens : int
+        `max_tokens` of the summary request.
+
+    cache : CompletionCache
+        Summaries by span.
+    """
+
+    # -- Constructor --
+
+    def __init__(self, client, model: Optional[str] = None, threshold: Optional[float] = None, keep_recent: Optional[int] = None, min_messages: Optional[int] = None, max_summary_tokens: Optional[int] = None, cache: Optional[CompletionCache] = None, workers: Optional[int] = None):
+        self.client = client
+        self.model = model or os.getenv("HISTORY_COMPACTION_MODEL") or os.getenv("GPT_MODEL_NAME", "gpt-4.1")
+        self.threshold = threshold if threshold is not None else float(os.getenv("HISTORY_COMPACTION_THRESHOLD", "0.75"))
+        self.keep_recent = keep_recent if keep_recent is not None else int(os.getenv("HISTORY_COMPACTION_KEEP", "6"))
+        self.min_messages = min_messages if min_messages is not None else int(os.getenv("HISTORY_COMPACTION_MIN_MESSAGES", "4"))
+        self.max_summary_tokens = max_summary_tokens if max_summary_tokens is not None else int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "512"))
+        self.cache = cache or CompletionCache(cache_dir=os.getenv("HISTORY_SUMMARY_CACHE_DIR", ".summary-cache"))
+
+        self._executor = ThreadPoolExecutor(max_workers=workers or int(os.getenv("HISTORY_COMPACTION_WORKERS", "2")), thread_name_prefix="compaction")
+        self._in_flight = set() # Session ids with a compaction running in this process
+        self._lock = threading.Lock()
+        self._counters = {"scheduled": 0, "applied": 0, "discarded": 0, "failed": 0, "messages_replaced": 0, "tokens_saved": 0}
+
+    # -- Compaction --
+
+    def maybe_compact(self, session, lock) -> Optional[Future]:
+        """
+        Start compacting a session in the background if its history crossed the threshold.
+
+        Call it after a turn, holding `lock`; the summary is applied later
+        under the same lock, and only if the summarized span is still intact.
+
+        Parameters
+        ----------
+        session : ChatSession
+            The session to compact.
+
+        lock : threading.Lock
+            Guards the session's history (`ChatBotService.state_lock`); it is held only briefly, never across a turn's upstream call.
+
+        Returns
+        -------
+        Future or None
+            Resolves to whether a summary was applied, or None if nothing was started.
+        """
+        if session.calculate_total_tokens() < self.threshold * session.token_limit:
+            return None
+        span = self.compactable_span(list(session.all_messages))
+        if len(span) < self.min_messages:
+            return None
+        with self._lock:
+            if session.session_id in self._in_flight:
+                return None
+            self._in_flight.add(session.session_id)
+            self._counters["scheduled"] += 1
+        return self._executor.submit(self._compact, session, lock, span)
+
+    def compactable_span(self, messages: list[Message]) -> list[Message]:
+        """
+        The messages a summary may replace: the run of non-prompt messages that ends where the recent ones begin.
+
+        Parameters
+        ----------
+        messages : list[Message]
+            The history, oldest first.
+
+        Returns
+        -------
+        list[Message]
+            The span, possibly empty.
+        """
+        end = max(0, len(messages) - self.keep_recent)
+        start = end
+        while start > 0 and not messages[start - 1].prompt:
+            start -= 1
+        return messages[start:end]
+
+    def summarize(self, span: list[Message]) -> tuple[str, str]:
+        """
+        Summarize messages, or return the cached summary of the same span.
+
+        Parameters
+        ----------
+        span : list[Message]
+            The messages to summarize, oldest first.
+
+        Returns
+        -------
+        tuple[str, str]
+            The cache key of the span and the summary text.
+        """
+        messages = [
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+            {"role": "user", "content": self.transcript(span)}
+        ]
+        key = CompletionCache.make_key(self.model, messages, {"max_tokens": self.max_summary_tokens})
+
+        def complete():
+            response = self.client.chat_completion(model=self.model, messages=messages, max_tokens=self.max_summary_tokens)
+            return response.choices[0].message.content or ""
+
+        return key, self.cache.get_or_compute(key, complete)
+
+    @staticmethod
+    def transcript(span: list[Message]) -> str:
+        """Render messages as a plain transcript; earlier summaries are marked as such."""
+        lines = []
+        for message in span:
+            content = message.content
+            if content.startswith(SUMMARY_PREFIX):
+                lines.append(f"Earlier summary: {content[len(SUMMARY_PREFIX):]}")
+            else:
+                lines.append(f"{'User' if message.role == 'user' else 'Assistant'}: {content}")
+        return "\n\n".join(lines)
+
+    def stats(self) -> dict:
+        """Return compaction counters, running compactions and summary cache counters for monitoring."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats["in_flight"] = len(self._in_flight)
+        stats["cache"] = self.cache.stats()
+        return stats
+
+    # -- Compaction utilities --
+
+    def _compact(self, session, lock, span: list[Message]) -> bool:
+        try:
+            key, summary = self.summarize(span)
+            content = SUMMARY_PREFIX + summary
+            # The id derives from the span, so workers that compact the same span agree on it
+            message = Message("system", content, session.count_tokens(content), id=key[:32])
+            applied = False
+            if message.tokens < sum(m.tokens for m in span): # Only if it actually saves tokens
+                with lock:
+                    applied = session.replace_messages([m.id for m in span], message)
+            with self._lock:
+                if applied:
+                    self._counters["applied"] += 1
+                    self._counters["messages_replaced"] += len(span)
+                    self._counters["tokens_saved"] += sum(m.tokens for m in span) - message.tokens
+                else:
+                    self._counters["discarded"] += 1 # Too long, or the span changed meanwhile; the summary stays cached
+            return applied
+        except Exception as e:
+            with self._lock:
+                self._counters["failed"] += 1
+            error_logger.error(f"Could not compact session {session.session_id}: {e}")
+            return False
+        finally:
+            with self._lock:
+                self._in_flight.discard(session.session_id)
+
+# --- Shared instance ---
+
+_history_compactor = None
+_history_compactor_lock = threading.Lock()
+
+def get_history_compactor(client) -> Optional[HistoryCompactor]:
+    """
+    Return the process-wide history compactor, or None unless `HISTORY_COMPACTION` is enabled.
+
+    Parameters
+    ----------
+    client : UpstreamClient
+        Sends the summary requests; used when the compactor is first created.
+
+    Returns
+    -------
+    HistoryCompactor or None
+        The shared compactor.
+    """
+    global _history_compactor
+    if os.getenv("HISTORY_COMPACTION", "0").lower() not in ("1", "true", "yes", "on"):
+        return None
+    with _history_compactor_lock:
+        if _history_compactor is None:
+            _history_compactor = HistoryCompactor(client)
+        return _history_compactor
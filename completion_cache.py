@@ -0,0 +1,281 @@
+# completion_cache.py
+
+# --- Imports ---
+
+# Standard library imports
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+# Local application imports
+from helpers import setup_logger
+
+# --- Setup ---
+error_logger = setup_logger('cache_error_logger', 'cache-error.log', logging.ERROR)
+
+# --- Completion cache class ---
+
+class CompletionCache:
+    """
+    A two-tier (memory + disk) cache for chat completion replies.
+
+    Identical concurrent requests are coalesced: the first caller computes the
+    reply while the others wait for its result (single-flight).
+
+    Attributes
+    ----------
+    cache_dir : str
+        Directory of the on-disk tier.
+
+    memory_size : int
+        Maximum number of replies kept in the memory tier.
+
+    max_disk_bytes : int
+        Size budget of the on-disk tier; the oldest entries are evicted first.
+
+    ttl : float
+        Seconds an entry stays valid, in both tiers.
+    """
+
+    # -- Constructor --
+
+    def __init__(self, cache_dir: Optional[str] = None, memory_size: Optional[int] = None, max_disk_bytes: Optional[int] = None, ttl: Optional[float] = None):
+        self.cache_dir = cache_dir or os.getenv("COMPLETION_CACHE_DIR", ".completion-cache")
+        self.memory_size = memory_size if memory_size is not None else int(os.getenv("COMPLETION_CACHE_MEMORY_SIZE", "256"))
+        self.max_disk_bytes = max_disk_bytes if max_disk_bytes is not None else int(os.getenv("COMPLETION_CACHE_MAX_BYTES", str(100 * 1024 * 1024)))
+        self.ttl = ttl if ttl is not None else float(os.getenv("COMPLETION_CACHE_TTL", "86400"))
+
+        self._memory = OrderedDict()
+        self._inflight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0}
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+
+    # -- Keys --
+
+    @staticmethod
+    def make_key(model: str, messages: list, options: Optional[dict] = None) -> str:
+        """
+        Hash the model name, message list and request options into a cache key.
+
+        Parameters
+        ----------
+        model : str
+            The upstream model name.
+
+        messages : list
+            The messages sent upstream.
+
+        options : dict, optional
+            Any further request options (e.g. web search options).
+
+        Returns
+        -------
+        str
+            A hex digest identifying the request.
+        """
+        payload = json.dumps({"model": model, "messages": messages, "options": options or {}}, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def make_body_key(body: bytes) -> str:
+        """
+        Hash a serialized request body (model, messages and options) into a cache key.
+
+        Parameters
+        ----------
+        body : bytes
+            The JSON request body, see `PromptBuilder.build_body`.
+
+        Returns
+        -------
+        str
+            A hex digest identifying the request.
+        """
+        return hashlib.sha256(body).hexdigest()
+
+    # -- Lookup and storage --
+
+    def get(self, key: str) -> Optional[str]:
+        """Return a cached reply, checking memory then disk, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, reply = entry
+                if now - created <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self._counters["memory_hits"] += 1
+                    return reply
+                del self._memory[key]
+
+        entry = self._read_disk(key)
+        if entry is not None and now - entry["created"] <= self.ttl:
+            with self._lock:
+                self._remember(key, entry["created"], entry["reply"])
+                self._counters["disk_hits"] += 1
+            return entry["reply"]
+
+        return None
+
+    def set(self, key: str, reply: str) -> None:
+        """Store a reply in both tiers."""
+        created = time.time()
+        with self._lock:
+            self._remember(key, created, reply)
+        self._write_disk(key, created, reply)
+
+    def get_or_compute(self, key: str, compute: Callable[[], str]) -> str:
+        """
+        Return the cached reply for `key`, computing it at most once.
+
+        Parameters
+        ----------
+        key : str
+            The cache key, see `make_key`.
+
+        compute : Callable[[], str]
+            Produces the reply on a miss. Errors are raised to every waiting
+            caller and nothing is cached.
+
+        Returns
+        -------
+        str
+            The reply.
+        """
+        reply = self.get(key)
+        if reply is not None:
+            return reply
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+                self._counters["misses"] += 1
+            else:
+                self._counters["coalesced"] += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            reply = compute()
+            self.set(key, reply)
+            future.set_result(reply)
+            return reply
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and tier sizes for monitoring."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats["hits"] = stats["memory_hits"] + stats["disk_hits"]
+            stats["memory_entries"] = len(self._memory)
+            stats["disk_bytes"] = self._disk_bytes
+        return stats
+
+    # -- Cache utilities --
+
+    def _remember(self, key: str, created: float, reply: str) -> None:
+        """Insert into the memory tier; callers must hold `_lock`."""
+        self._memory[key] = (created, reply)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            error_logger.error(f'Could not read completion cache entry {key}: {e}')
+            return None
+
+    def _write_disk(self, key: str, created: float, reply: str) -> None:
+        path = self._path(key)
+        data = json.dumps({"created": created, "reply": reply}).encode("utf-8")
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with self._disk_lock:
+                previous = os.path.getsize(path) if os.path.exists(path) else 0
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path) # Atomic, so concurrent readers never see partial entries
+                self._disk_bytes += len(data) - previous
+                if self._disk_bytes > self.max_disk_bytes:
+                    self._evict_disk()
+        except OSError as e:
+            error_logger.error(f'Could not write completion cache entry {key}: {e}')
+
+    def _disk_entries(self):
+        """Yield (path, size, mtime) for every on-disk entry."""
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _evict_disk(self) -> None:
+        """Remove expired entries, then the oldest ones, until under budget; callers must hold `_disk_lock`."""
+        now = time.time()
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.max_disk_bytes * 0.9 # Leave headroom so eviction doesn't run on every write
+        for path, size, mtime in entries:
+            if total <= target and now - mtime <= self.ttl:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        self._disk_bytes = total
+
+# --- Shared instance ---
+
+_completion_cache = None
+_completion_cache_lock = threading.Lock()
+
+def get_completion_cache() -> Optional[CompletionCache]:
+    """
+    Return the process-wide completion cache, or None unless `COMPLETION_CACHE` is enabled.
+
+    Returns
+    -------
+    CompletionCache or None
+        The shared cache instance.
+    """
+    global _completion_cache
+    if os.getenv("COMPLETION_CACHE", "0").lower() not in ("1", "true", "yes", "on"):
+        return None
+    with _completion_cache_lock:
+        if _completion_cache is None:
+            _completion_cache = CompletionCache()
+        return _completion_cache
@@ -0,0 +1,239 @@
+# image_pipeline.py
+
+# --- Imports ---
+
+# Standard library imports
+import asyncio
+import base64
+import hashlib
+import io
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+# Local application imports
+from helpers import setup_logger
+
+# Third party imports (optional)
+try:
+    from PIL import Image, ImageOps
+except ImportError: # Pillow is in requirements.txt; without it images are forwarded unchanged (warned at startup)
+    Image = None
+    ImageOps = None
+
+# --- Setup ---
+error_logger = setup_logger('image_error_logger', 'image-error.log', logging.ERROR)
+
+# Vision token accounting, see https://platform.openai.com/docs/guides/images-vision#calculating-costs
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_TILE_SIZE = 512
+IMAGE_HIGH_DETAIL_MAX_SIDE = 2048
+IMAGE_HIGH_DETAIL_SHORT_SIDE = 768
+
+# Worst case for high detail (2048x768 -> 4x2 tiles), used when dimensions are unknown
+IMAGE_MAX_TOKENS = IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * 8
+
+# EXIF tag of the camera orientation; images are transposed upright before they are measured
+EXIF_ORIENTATION = 0x0112
+
+# --- Image pipeline class ---
+
+class ImagePipeline:
+    """
+    Downscales, recompresses and base64-encodes uploaded images in a worker pool.
+
+    Encoded data URLs are cached by content hash, so re-sending the same
+    screenshot costs a dictionary lookup instead of a decode/resize/encode pass.
+
+    Attributes
+    ----------
+    max_dimension : int
+        Longest allowed image side in pixels; larger images are downscaled.
+
+    quality : int
+        JPEG quality used when recompressing opaque images.
+
+    detail : str
+        The vision `detail` level sent upstream ("low", "high" or "auto").
+
+    cache_size : int
+        Maximum number of encoded images kept in the cache.
+    """
+
+    # -- Constructor --
+
+    def __init__(self, max_dimension: Optional[int] = None, quality: Optional[int] = None, detail: Optional[str] = None, cache_size: Optional[int] = None, workers: Optional[int] = None):
+        self.max_dimension = max_dimension or int(os.getenv("IMAGE_MAX_DIMENSION", "2048"))
+        self.quality = quality or int(os.getenv("IMAGE_QUALITY", "85"))
+        self.detail = detail or os.getenv("IMAGE_DETAIL", "auto")
+        self.cache_size = cache_size if cache_size is not None else int(os.getenv("IMAGE_CACHE_SIZE", "128"))
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers or int(os.getenv("IMAGE_WORKERS", "2")),
+            thread_name_prefix="image-pipeline"
+        )
+        self.hits = 0
+        self.misses = 0
+        if Image is None:
+            error_logger.error("Pillow is not installed: images are forwarded without downscaling or recompression (pip install pillow)")
+
+    # -- Public methods --
+
+    def process(self, content: bytes, content_type: Optional[str] = None, filename: Optional[str] = None) -> dict:
+        """
+        Prepare one image for the upstream API, using the cache when possible.
+
+        Parameters
+        ----------
+        content : bytes
+            The raw uploaded image bytes.
+
+        content_type : str, optional
+            The uploaded MIME type, used when the image cannot be decoded.
+
+        filename : str, optional
+            The uploaded file name, carried through for reporting.
+
+        Returns
+        -------
+        dict
+            `filename`, `content_type`, `data_url`, `detail`, `width`, `height`, `size` and `tokens`.
+        """
+        key = self._cache_key(content)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return {**cached, "filename": filename}
+            self.misses += 1
+
+        result = self._encode(content, content_type)
+
+        with self._lock:
+            self._cache[key] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return {**result, "filename": filename}
+
+    async def process_many(self, images: list[dict]) -> list[dict]:
+        """
+        Process uploaded images concurrently without blocking the event loop.
+
+        Parameters
+        ----------
+        images : list[dict]
+            Dicts with `content`, `content_type` and `filename` keys.
+
+        Returns
+        -------
+        list[dict]
+            Processed images in the same order, see `process`.
+        """
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*[
+            loop.run_in_executor(self._executor, self.process, img["content"], img.get("content_type"), img.get("filename"))
+            for img in images
+        ])
+
+    def stats(self) -> dict:
+        """Return cache hit/miss counters, and whether images are downscaled (Pillow installed), for monitoring."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._cache), "pillow": Image is not None}
+
+    @staticmethod
+    def estimate_tokens(width: Optional[int], height: Optional[int], detail: str = "auto") -> int:
+        """
+        Estimate the prompt tokens the upstream model bills for an image.
+
+        Parameters
+        ----------
+        width : int, optional
+            Image width in pixels, or None if unknown.
+
+        height : int, optional
+            Image height in pixels, or None if unknown.
+
+        detail : str
+            The vision detail level.
+
+        Returns
+        -------
+        int
+            Estimated token count.
+        """
+        if detail == "low":
+            return IMAGE_BASE_TOKENS
+        if not width or not height:
+            return IMAGE_MAX_TOKENS
+
+        # Fit within 2048x2048, then scale the shortest side down to 768
+        scale = min(1.0, IMAGE_HIGH_DETAIL_MAX_SIDE / max(width, height))
+        width, height = width * scale, height * scale
+        scale = min(1.0, IMAGE_HIGH_DETAIL_SHORT_SIDE / min(width, height))
+        width, height = width * scale, height * scale
+
+        tiles = math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE)
+        return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+    # -- Image pipeline utilities --
+
+    def _cache_key(self, content: bytes) -> str:
+        digest = hashlib.sha256(content).hexdigest()
+        return f"{digest}:{self.max_dimension}:{self.quality}"
+
+    def _encode(self, content: bytes, content_type: Optional[str]) -> dict:
+        """
+        Downscale and recompress an image, falling back to the original bytes.
+
+        Animated images, undecodable images and images that would grow when
+        recompressed are forwarded as uploaded.
+        """
+        width = height = None
+        if Image is not None:
+            try:
+                with Image.open(io.BytesIO(content)) as img:
+                    width, height = img.size
+                    if not getattr(img, "is_animated", False):
+                        content, content_type, width, height = self._recompress(img, content, content_type)
+            except Exception as e:
+                error_logger.error(f'Image could not be processed, forwarding original: {e}')
+
+        base64_data = base64.b64encode(content).decode("utf-8")
+        return {
+            "content_type": content_type,
+            "data_url": f"data:{content_type};base64,{base64_data}",
+            "detail": self.detail,
+            "width": width,
+            "height": height,
+            "size": len(content),
+            "tokens": self.estimate_tokens(width, height, self.detail)
+        }
+
+    def _recompress(self, img, content: bytes, content_type: Optional[str]):
+        # The original bytes are only reused when they show the image as measured: not rotated or flipped by EXIF
+        upright = img.getexif().get(EXIF_ORIENTATION, 1) == 1
+        img = ImageOps.exif_transpose(img)
+        resized = max(img.size) > self.max_dimension
+        if resized:
+            img.thumbnail((self.max_dimension, self.max_dimension), Image.LANCZOS)
+
+        buffer = io.BytesIO()
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            img.save(buffer, format="PNG", optimize=True)
+            new_content_type = "image/png"
+        else:
+            img.convert("RGB").save(buffer, format="JPEG", quality=self.quality, optimize=True)
+            new_content_type = "image/jpeg"
+
+        encoded = buffer.getvalue()
+        if not resized and upright and len(encoded) >= len(content):
+            return content, content_type, img.width, img.height
+        return encoded, new_content_type, img.width, img.height
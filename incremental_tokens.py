@@ -0,0 +1,172 @@
+# incremental_tokens.py
+
+# --- Imports ---
+
+# Standard library imports
+import codecs
+from itertools import repeat
+from typing import Iterable
+
+# --- Incremental decoder class ---
+
+class IncrementalDecoder:
+    """
+    Decodes token ids as they arrive, emitting text deltas.
+
+    A multi-byte UTF-8 character can be split across tokens (and across
+    chunks of ids), so the bytes of an incomplete character are held back
+    until the rest arrives instead of being replaced. Each id is looked up
+    and decoded once, so decoding a sequence chunk by chunk costs the same
+    as decoding it whole. The deltas and `flush` join to exactly what
+    `Tokenizer.decode` returns for all the ids.
+
+    Attributes
+    ----------
+    tokens : int
+        Number of ids decoded so far.
+
+    errors : str
+        How invalid bytes are handled (`replace`, as in `Tokenizer.decode`).
+    """
+
+    # -- Constructor --
+
+    def __init__(self, tokenizer, errors: str = "replace"):
+        """
+        Parameters
+        ----------
+        tokenizer : Tokenizer
+            The tokenizer whose ids are decoded.
+
+        errors : str, optional
+            The error handler of the UTF-8 decoder.
+        """
+        self.errors = errors
+        self.tokens = 0
+        self._decoder = tokenizer._decoder
+        self._utf8 = codecs.getincrementaldecoder("utf-8")(errors)
+
+    # -- Decoding --
+
+    def feed(self, tokens: Iterable[int]) -> str:
+        """
+        Decode the next ids.
+
+        Args:
+            tokens (Iterable[int]): The ids that arrived; unknown ids are skipped, as in `Tokenizer.decode_bytes`.
+
+        Returns:
+            str: The new text; it ends before an incomplete character.
+        """
+        tokens = list(tokens)
+        self.tokens += len(tokens)
+        return self._utf8.decode(b"".join(map(self._decoder.get, tokens, repeat(b""))))
+
+    def flush(self) -> str:
+        """
+        End the sequence: decode what is still held back (an incomplete character becomes U+FFFD) and reset.
+
+        Returns:
+            str: The remaining text, usually empty.
+        """
+        text = self._utf8.decode(b"", final=True)
+        self.reset()
+        return text
+
+    def reset(self) -> None:
+        """Start a new sequence, dropping any held back bytes."""
+        self.tokens = 0
+        self._utf8.reset()
+
+    @property
+    def pending(self) -> int:
+        """Number of bytes held back as the start of an incomplete character."""
+        return len(self._utf8.getstate()[0])
+
+# --- Incremental token counter class ---
+
+class IncrementalTokenCounter:
+    """
+    Counts the tokens of text that arrives in pieces (e.g. a streamed reply).
+
+    The text is never re-encoded from the start: words (pre-tokens) that
+    more text can no longer change are counted once and dropped, and only
+    the last `holdback` words are re-split and re-counted on the next
+    piece. With the default patterns a match depends on at most the next
+    couple of words (e.g. `'` + `r` becomes `'re`, trailing spaces give one
+    to the next word), so the final count equals `Tokenizer.count` of the
+    whole text; patterns whose matches can span unbounded text (a fenced
+    code alternative tried before plain words) need a larger `holdback`.
+
+    Attributes
+    ----------
+    holdback : int
+        Trailing words that stay provisional until more text arrives.
+
+    committed : int
+        Tokens of the words that are final.
+    """
+
+    # -- Constructor --
+
+    def __init__(self, tokenizer, holdback: int = 2):
+        """
+        Parameters
+        ----------
+        tokenizer : Tokenizer
+            The tokenizer to count with.
+
+        holdback : int, optional
+            Trailing words that stay provisional (at least 1).
+        """
+        self.tokenizer = tokenizer
+        self.holdback = max(1, holdback)
+        self.committed = 0
+        self._pending = "" # Text of the provisional words
+        self._pending_tokens = 0
+
+    # -- Counting --
+
+    def feed(self, text: str) -> int:
+        """
+        Add the next piece of text.
+
+        Args:
+            text (str): The text that arrived.
+
+        Returns:
+            int: The token count of all the text so far (the last words are provisional).
+        """
+        if not text:
+            return self.count
+        self._pending += text
+        words = self.tokenizer.pretokenize(self._pending)
+        if len(words) > self.holdback:
+            final, words = words[:-self.holdback], words[-self.holdback:]
+            self.committed += sum(len(self.tokenizer.encode_word(word)) for word in final)
+            self._pending = "".join(words)
+        self._pending_tokens = sum(len(self.tokenizer.encode_word(word)) for word in words)
+        return self.count
+
+    def finish(self) -> int:
+        """
+        End the text: the provisional words become final.
+
+        Returns:
+            int: The token count of the whole text.
+        """
+        self.committed += self._pending_tokens
+        self._pending = ""
+        self._pending_tokens = 0
+        return self.committed
+
+    def reset(self) -> None:
+        """Start counting a new text."""
+        self.committed = 0
+        self._pending = ""
+        self._pending_tokens = 0
+
+    @property
+    def count(self) -> int:
+        """The token count of the text so far."""
+        return self.committed + self._pending_tokens
@@ -0,0 +1,291 @@
+# loadtest.py
+#
+# Drives the webapp's /chat, /history and /token_count endpoints with realistic
+# payloads and reports latency percentiles and throughput. Pair it with
+# stub_server.py to measure the app without spending API credit:
+#
+#   python stub_server.py --port 8001 &
+#   OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=stub uvicorn app:app --port 8000 &
+#   python loadtest.py --url http://127.0.0.1:8000 --duration 30 --concurrency 16 --max-p95 2.0
+
+# --- Imports ---
+
+# Standard library imports
+import argparse
+import glob
+import http.cookiejar
+import json
+import os
+import random
+import struct
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Local application imports
+from upstream_client import percentile
+
+# --- Payloads ---
+
+def load_prompts(log_path: str) -> list[str]:
+    """
+    Extract user messages from a chat log (lines starting with '> ').
+
+    Args:
+        log_path (str): Path to a chat log such as `sample-training-data.log`.
+
+    Returns:
+        list[str]: The user messages, including multi-line ones.
+    """
+    prompts, current = [], None
+    with open(log_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith(">> "):
+                if current:
+                    prompts.append("".join(current).strip())
+                current = None
+            elif line.startswith("> "):
+                if current:
+                    prompts.append("".join(current).strip())
+                current = [line[2:]]
+            elif current is not None:
+                current.append(line)
+    if current:
+        prompts.append("".join(current).strip())
+    return [p for p in prompts if p] or ["Hello!"]
+
+def load_context_files(pattern: str, limit: int = 8) -> list[tuple[str, bytes]]:
+    """Read up to `limit` files matching `pattern` to upload as context."""
+    files = []
+    for path in sorted(glob.glob(pattern))[:limit]:
+        with open(path, "rb") as f:
+            files.append((os.path.basename(path), f.read()))
+    return files
+
+def make_png(width: int, height: int) -> bytes:
+    """Build an uncompressed-ish RGB PNG of the given size, without third party libraries."""
+    def png_chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    row = b"\x00" + bytes(random.randrange(256) for _ in range(width * 3))
+    raw = row * height
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + png_chunk(b"IDAT", zlib.compress(raw, 6))
+        + png_chunk(b"IEND", b"")
+    )
+
+def encode_multipart(fields: list[tuple[str, str]], files: list[tuple[str, str, bytes, str]]) -> tuple[bytes, str]:
+    """
+    Encode form fields and files as multipart/form-data.
+
+    Args:
+        fields (list): (name, value) pairs.
+        files (list): (field name, file name, content, content type) tuples.
+
+    Returns:
+        tuple: The body and its Content-Type header value.
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields:
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode("utf-8")
+            + value.encode("utf-8") + b"\r\n"
+        )
+    for name, filename, content, content_type in files:
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'.encode("utf-8")
+            + content + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode("utf-8"))
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+# --- Load generator ---
+
+class LoadTest:
+    """
+    A closed-loop load generator for the webapp.
+
+    Attributes
+    ----------
+    url : str
+        Base URL of the running app.
+
+    mix : dict
+        Relative weights of the `chat`, `history` and `token_count` scenarios.
+
+    results : dict
+        Per-scenario lists of (latency seconds, HTTP status) samples.
+    """
+
+    def __init__(self, url: str, prompts: list[str], context_files: list[tuple[str, bytes]], mix: dict, file_rate: float, image_rate: float, timeout: float):
+        self.url = url.rstrip("/")
+        self.prompts = prompts
+        self.context_files = context_files
+        self.mix = mix
+        self.file_rate = file_rate
+        self.image_rate = image_rate
+        self.timeout = timeout
+        self.images = [make_png(320, 240), make_png(1280, 960)]
+        self.results = {name: [] for name in mix}
+        self._lock = threading.Lock()
+
+    # -- Scenarios --
+
+    def _attachments(self, rng: random.Random) -> list[tuple[str, str, bytes, str]]:
+        files = []
+        if self.context_files and rng.random() < self.file_rate:
+            for filename, content in rng.sample(self.context_files, k=min(2, len(self.context_files))):
+                files.append(("context_files", filename, content, "text/plain"))
+        if rng.random() < self.image_rate:
+            files.append(("images", "screenshot.png", rng.choice(self.images), "image/png"))
+        return files
+
+    def chat(self, rng: random.Random):
+        body, content_type = encode_multipart([("message", rng.choice(self.prompts))], self._attachments(rng))
+        return urllib.request.Request(f"{self.url}/chat", data=body, headers={"Content-Type": content_type}, method="POST")
+
+    def history(self, rng: random.Random):
+        return urllib.request.Request(f"{self.url}/history", method="GET")
+
+    def token_count(self, rng: random.Random):
+        files = [f for f in self._attachments(rng) if f[0] == "context_files"]
+        files = [("files", filename, content, ctype) for _, filename, content, ctype in files]
+        body, content_type = encode_multipart([("text", rng.choice(self.prompts))], files)
+        return urllib.request.Request(f"{self.url}/token_count", data=body, headers={"Content-Type": content_type}, method="POST")
+
+    # -- Execution --
+
+    def _request(self, scenario: str, rng: random.Random, opener: urllib.request.OpenerDirector) -> None:
+        request = getattr(self, scenario)(rng)
+        start = time.perf_counter()
+        try:
+            with opener.open(request, timeout=self.timeout) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except Exception:
+            status = 0 # Connection error or timeout
+        latency = time.perf_counter() - start
+        with self._lock:
+            self.results[scenario].append((latency, status))
+
+    def _worker(self, seed: int, deadline: float, remaining: list) -> None:
+        rng = random.Random(seed)
+        scenarios, weights = zip(*self.mix.items())
+        # Each worker is one browser: it keeps its session cookie, so its history grows turn by turn
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        while time.perf_counter() < deadline:
+            with self._lock:
+                if remaining[0] is not None:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+            self._request(rng.choices(scenarios, weights)[0], rng, opener)
+
+    def run(self, concurrency: int, duration: float, requests: int = None) -> float:
+        """Run the test and return the elapsed wall-clock time in seconds."""
+        start = time.perf_counter()
+        deadline = start + duration
+        remaining = [requests]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for seed in range(concurrency):
+                executor.submit(self._worker, seed, deadline, remaining)
+        return time.perf_counter() - start
+
+    def report(self, elapsed: float) -> dict:
+        """Summarize latency percentiles, throughput and errors per scenario."""
+        report = {"elapsed": elapsed, "scenarios": {}}
+        everything = []
+        for scenario, samples in self.results.items():
+            latencies = sorted(latency for latency, _ in samples)
+            everything.extend(latencies)
+            report["scenarios"][scenario] = summarize(latencies, elapsed)
+            report["scenarios"][scenario]["errors"] = sum(1 for _, status in samples if not 200 <= status < 300)
+            report["scenarios"][scenario]["statuses"] = {str(s): sum(1 for _, status in samples if status == s) for s in sorted({status for _, status in samples})}
+        report["total"] = summarize(sorted(everything), elapsed)
+        report["total"]["errors"] = sum(s["errors"] for s in report["scenarios"].values())
+        return report
+
+def summarize(latencies: list, elapsed: float) -> dict:
+    return {
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99)
+    }
+
+def print_report(report: dict) -> None:
+    def ms(value):
+        return f"{value * 1000:9.1f}" if value is not None else "        -"
+
+    print(f"{'scenario':<12} {'requests':>8} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    rows = list(report["scenarios"].items()) + [("total", report["total"])]
+    for name, s in rows:
+        print(f"{name:<12} {s['requests']:>8} {s['rps']:>8.1f} {ms(s['p50'])} {ms(s['p95'])} {ms(s['p99'])} {s['errors']:>7}")
+
+# --- Main ---
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in ("chat", "history", "token_count"):
+            raise argparse.ArgumentTypeError(f"Unknown scenario: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the pAIr webapp.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to run")
+    parser.add_argument("--requests", type=int, help="Stop after this many requests")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("chat=1,history=2,token_count=2"))
+    parser.add_argument("--prompts", default=os.getenv("TRAINING_DATA_PATH", "sample-training-data.log"))
+    parser.add_argument("--files", default="*.py", help="Glob of files to upload as context")
+    parser.add_argument("--file-rate", type=float, default=0.3, help="Fraction of requests with file uploads")
+    parser.add_argument("--image-rate", type=float, default=0.1, help="Fraction of chat requests with an image")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--json", dest="json_path", help="Also write the report as JSON to this path")
+    parser.add_argument("--max-p95", type=float, help="Fail if the overall p95 latency (seconds) is higher")
+    parser.add_argument("--min-rps", type=float, help="Fail if overall throughput is lower")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="Fail if the error fraction is higher")
+    args = parser.parse_args()
+
+    test = LoadTest(
+        args.url, load_prompts(args.prompts), load_context_files(args.files),
+        args.mix, args.file_rate, args.image_rate, args.timeout
+    )
+    elapsed = test.run(args.concurrency, args.duration, args.requests)
+    report = test.report(elapsed)
+    print_report(report)
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    total = report["total"]
+    failures = []
+    if args.max_p95 is not None and (total["p95"] is None or total["p95"] > args.max_p95):
+        failures.append(f"p95 {total['p95']} s > {args.max_p95} s")
+    if args.min_rps is not None and total["rps"] < args.min_rps:
+        failures.append(f"throughput {total['rps']:.1f} rps < {args.min_rps} rps")
+    if total["requests"] and total["errors"] / total["requests"] > args.max_error_rate:
+        failures.append(f"error rate {total['errors'] / total['requests']:.2%} > {args.max_error_rate:.2%}")
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# message.py
+
+# --- Imports ---
+
+# Standard library imports
+import itertools
+import os
+import sys
+import uuid
+import zlib
+from typing import Iterable, Optional
+
+# --- Setup ---
+
+# Old message content is compressed when enabled; see `compress_old_messages`
+MESSAGE_COMPRESSION = os.getenv("MESSAGE_COMPRESSION", "0").lower() in ("1", "true", "yes", "on")
+MESSAGE_COMPRESS_AGE = int(os.getenv("MESSAGE_COMPRESS_AGE", "20"))
+MESSAGE_COMPRESS_MIN_SIZE = int(os.getenv("MESSAGE_COMPRESS_MIN_SIZE", "512"))
+
+# --- Message class ---
+
+class Message:
+    """
+    A compact chat history message.
+
+    Messages use `__slots__` instead of a per-instance dict, roles are interned
+    so every message shares one string per role, and content can be stored
+    zlib-compressed. `content` always reads as text; compression is invisible
+    to callers. Use `to_api` to build the upstream request format and `to_dict`
+    for storage, only where a dict is actually needed.
+
+    Attributes
+    ----------
+    id : str
+        A unique message id.
+
+    role : str
+        The (interned) role: `user` or `system`.
+
+    prompt : bool
+        Whether this is a system prompt; replies and summaries are `system` messages too.
+
+    tokens : int
+        The content's token count.
+
+    content : str
+        The message text.
+
+    compressed : bool
+        Whether the content is held compressed.
+    """
+
+    __slots__ = ("id", "role", "tokens", "prompt", "_data", "_packed")
+
+    # -- Constructor --
+
+    def __init__(self, role: str, content: str, tokens: int = 0, id: Optional[str] = None, prompt: bool = False):
+        self.id = id or uuid.uuid4().hex
+        self.role = sys.intern(role)
+        self.tokens = tokens
+        self.prompt = prompt
+        self._data = content
+        self._packed = None # None: not considered for compression yet, True: compressed, False: kept as text
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Message":
+        """Create a message from its stored form, see `to_dict`."""
+        return cls(data["role"], data["content"], data.get("tokens", 0), data.get("id"), data.get("prompt", False))
+
+    # -- Content --
+
+    @property
+    def content(self) -> str:
+        if self._packed:
+            return zlib.decompress(self._data).decode("utf-8")
+        return self._data
+
+    @content.setter
+    def content(self, value: str) -> None:
+        self._data = value
+        self._packed = None
+
+    @property
+    def compressed(self) -> bool:
+        return self._packed is True
+
+    def compress(self, min_size: int = MESSAGE_COMPRESS_MIN_SIZE) -> bool:
+        """
+        Compress the content if it is at least `min_size` bytes and compression pays off.
+
+        Parameters
+        ----------
+        min_size : int
+            Smallest UTF-8 size (bytes) worth compressing.
+
+        Returns
+        -------
+        bool
+            Whether the content is now compressed.
+        """
+        if self._packed is None:
+            self._packed = False
+            raw = self._data.encode("utf-8")
+            if len(raw) >= min_size:
+                packed = zlib.compress(raw)
+                if len(packed) < len(raw):
+                    self._data, self._packed = packed, True
+        return self._packed
+
+    # -- Conversion --
+
+    def to_api(self) -> dict:
+        """Return the upstream chat completions format: `role` and `content`."""
+        return {"role": self.role, "content": self.content}
+
+    def to_dict(self) -> dict:
+        """Return every field (`id`, `role`, `content`, `tokens`, and `prompt` if set), e.g. for a `SessionStore`."""
+        data = {"id": self.id, "role": self.role, "content": self.content, "tokens": self.tokens}
+        if self.prompt:
+            data["prompt"] = True
+        return data
+
+    def __repr__(self) -> str:
+        return f"Message(role={self.role!r}, tokens={self.tokens}, compressed={self.compressed})"
+
+# --- Helper functions ---
+
+def compress_old_messages(messages: Iterable[Message], age: int = MESSAGE_COMPRESS_AGE, min_size: int = MESSAGE_COMPRESS_MIN_SIZE) -> int:
+    """
+    Compress messages once they are `age` or more messages old.
+
+    Walks back from the newest message past the age boundary and stops at the
+    first one already considered, so calling this after every new message
+    only looks at the message that just crossed the boundary.
+
+    Args:
+        messages (Sequence[Message]): The history, oldest first (a deque or list).
+        age (int): Number of recent messages kept as plain text.
+        min_size (int): Smallest content size (bytes) worth compressing.
+
+    Returns:
+        int: Number of messages compressed.
+    """
+    count = 0
+    for message in itertools.islice(reversed(messages), age, None):
+        if message._packed is not None:
+            break
+        count += message.compress(min_size)
+    return count
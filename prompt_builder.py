@@ -0,0 +1,343 @@
+# prompt_builder.py
+
+# --- Imports ---
+
+# Standard library imports
+import json
+import os
+import threading
+import weakref
+import zlib
+from collections import OrderedDict
+from typing import Optional
+
+# Local application imports
+from message import Message
+
+# --- Setup ---
+
+# Smallest run of old serialized messages compressed as one block, see `PromptBuilder.compress_prefix`
+COMPRESS_BLOCK_SIZE = 16384
+
+# Budget of decompressed history kept between turns, across all prompt builders, see `PrefixCache`
+PREFIX_CACHE_BYTES = int(os.getenv("PROMPT_PREFIX_CACHE_BYTES", str(64 * 2**20)))
+
+# --- Prompt builder class ---
+
+class PromptBuilder:
+    """
+    Assembles chat completion request bodies from a pre-serialized history.
+
+    Every history message is JSON-encoded once, when it is appended, into an
+    append-only buffer of `"messages"` array items. Building a request then
+    only encodes what is new this turn (model, options and the final user
+    message) and splices it around the buffer, instead of copying and
+    re-serializing the whole conversation.
+
+    The buffer is rebuilt (from its own slices, without re-encoding) only
+    when messages are removed from the history, e.g. by trimming. It is the
+    only serialized copy of the history, so no per-message fragments are kept.
+
+    With message compression, the serialized old messages are moved out of
+    the buffer into zlib-compressed blocks (`compress_prefix`), which are
+    decompressed, not re-encoded, when a body is built. The decompressed
+    blocks are kept for the next turns while the builder stays within the
+    `PrefixCache` budget, and newly compressed blocks are added to them
+    without decompressing, so a turn of a recently used session costs no
+    decompression at all.
+
+    Attributes
+    ----------
+    message_count : int
+        Number of messages in the serialized history.
+
+    buffer_bytes : int
+        Size of the uncompressed part of the serialized history.
+
+    compressed_bytes : int
+        Size of the compressed blocks.
+    """
+
+    # -- Constructor --
+
+    def __init__(self, prefix_cache=None):
+        """
+        Parameters
+        ----------
+        prefix_cache : PrefixCache, optional
+            Budget for keeping decompressed blocks between builds (default: the process-wide one).
+        """
+        self.prefix_cache = prefix_cache or get_prefix_cache()
+        self._ids = []
+        self._roles = []
+        self._buffer = bytearray()
+        self._offsets = [] # Start of each message in the whole serialized history (blocks, then `_buffer`)
+        self._blocks = [] # Compressed serialized history that precedes `_buffer`
+        self._compressed_end = 0 # Uncompressed length of `_blocks`
+        self._plain = None # `_blocks` decompressed, while the prefix cache keeps them
+
+    @property
+    def message_count(self) -> int:
+        return len(self._ids)
+
+    @property
+    def buffer_bytes(self) -> int:
+        return len(self._buffer)
+
+    @property
+    def compressed_bytes(self) -> int:
+        return sum(len(block) for block in self._blocks)
+
+    # -- History maintenance --
+
+    def append(self, message: Message) -> None:
+        """
+        Serialize a message onto the end of the history.
+
+        Parameters
+        ----------
+        message : Message
+            A history message.
+        """
+        self._append(message.id, message.role, encode_json(message.to_api()))
+
+    def reset(self, messages) -> None:
+        """
+        Rebuild the history after messages were removed or reordered.
+
+        Messages that are still present are copied from the old buffer
+        instead of being encoded again.
+
+        Parameters
+        ----------
+        messages : Iterable[Message]
+            The full, current history.
+        """
+        buffer = b"".join(self._history()) if self._blocks else self._buffer
+        ends = [offset - 1 for offset in self._offsets[1:]] + [len(buffer)] # Each fragment ends before the next comma
+        spans = {message_id: (start, end) for message_id, start, end in zip(self._ids, self._offsets, ends)}
+        self._ids, self._roles, self._buffer, self._offsets = [], [], bytearray(), []
+        self._blocks, self._compressed_end, self._plain = [], 0, None
+        self.prefix_cache.discard(self)
+        for message in messages:
+            span = spans.get(message.id)
+            if span is None:
+                self.append(message)
+            else:
+                self._append(message.id, message.role, memoryview(buffer)[span[0]:span[1]])
+
+    def compress_prefix(self, count: int, block_size: int = COMPRESS_BLOCK_SIZE) -> bool:
+        """
+        Compress the serialized form of the first `count` messages, once enough of it is uncompressed.
+
+        Parameters
+        ----------
+        count : int
+            Number of old messages that may be held compressed (e.g. those older than `MESSAGE_COMPRESS_AGE`).
+
+        block_size : int
+            Smallest uncompressed run worth a block; shorter runs wait for more messages.
+
+        Returns
+        -------
+        bool
+            Whether a block was compressed.
+        """
+        if count <= 0 or count > len(self._ids):
+            return False
+        end = self._offsets[count] if count < len(self._ids) else self._compressed_end + len(self._buffer)
+        if end - self._compressed_end < block_size:
+            return False
+        cut = end - self._compressed_end
+        block = bytes(self._buffer[:cut])
+        self._blocks.append(zlib.compress(block))
+        plain = self._plain
+        if plain is not None:
+            plain.append(block) # Already decompressed; counted against the budget on the next build
+        del self._buffer[:cut]
+        self._compressed_end = end
+        return True
+
+    def _history(self) -> list:
+        """The parts of the whole serialized history: the decompressed blocks, then the buffer."""
+        if not self._blocks:
+            return [self._buffer]
+        plain = self._plain
+        if plain is None:
+            plain = [zlib.decompress(block) for block in self._blocks]
+        self._plain = plain if self.prefix_cache.keep(self, self._compressed_end) else None
+        return plain + [self._buffer]
+
+    def _drop_plain(self) -> None:
+        self._plain = None
+
+    def _append(self, message_id: str, role: str, fragment) -> None:
+        if self._ids:
+            self._buffer += b","
+        self._offsets.append(self._compressed_end + len(self._buffer))
+        self._buffer += fragment
+        self._ids.append(message_id)
+        self._roles.append(role)
+
+    # -- Request assembly --
+
+    def build_body(self, model: str, last_content=None, options: Optional[dict] = None) -> bytes:
+        """
+        Build the JSON body of a chat completion request.
+
+        Parameters
+        ----------
+        model : str
+            The upstream model name.
+
+        last_content : str or list, optional
+            Content that replaces the last history message's content in the
+            request only (e.g. with context files and images attached).
+
+        options : dict, optional
+            Further top-level request fields (e.g. `web_search_options`).
+
+        Returns
+        -------
+        bytes
+            The serialized request body.
+        """
+        head = b'{"model":' + encode_json(model)
+        for key, value in (options or {}).items():
+            head += b"," + encode_json(key) + b":" + encode_json(value)
+        head += b',"messages":['
+
+        parts = self._history()
+        if last_content is None or not self._ids:
+            return b"".join([head, *parts, b"]}"])
+
+        last = encode_json({"role": self._roles[-1], "content": last_content})
+        cut = self._offsets[-1]
+        if cut >= self._compressed_end:
+            parts[-1] = memoryview(self._buffer)[:cut - self._compressed_end]
+        else: # The last message is compressed too
+            parts = [b"".join(parts[:-1])[:cut]]
+        return b"".join([head, *parts, last, b"]}"])
+
+# --- Prefix cache class ---
+
+class PrefixCache:
+    """
+    Keeps the decompressed history of the most recently built prompts, within a byte budget.
+
+    Prompt builders report the size of their decompressed blocks on every
+    build; once the total exceeds the budget, the least recently built ones
+    drop their copy and decompress again on their next build. A builder
+    larger than the whole budget keeps nothing.
+
+    Attributes
+    ----------
+    max_bytes : int
+        Budget of decompressed bytes, across all builders.
+    """
+
+    # -- Constructor --
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        """
+        Parameters
+        ----------
+        max_bytes : int, optional
+            Budget of decompressed bytes (default: `PROMPT_PREFIX_CACHE_BYTES`).
+        """
+        self.max_bytes = max_bytes if max_bytes is not None else PREFIX_CACHE_BYTES
+        self._entries = OrderedDict() # id(builder) -> (weak reference, bytes), least recently built first
+        self._bytes = 0
+        self._lock = threading.RLock() # A collected builder's callback may run while it is held
+
+    # -- Accounting --
+
+    def keep(self, builder: PromptBuilder, size: int) -> bool:
+        """
+        Record a build; evict the least recently built others if over budget.
+
+        Parameters
+        ----------
+        builder : PromptBuilder
+            The builder that was just built.
+
+        size : int
+            Its decompressed bytes.
+
+        Returns
+        -------
+        bool
+            Whether the builder may keep its decompressed blocks.
+        """
+        evicted = []
+        with self._lock:
+            self._pop(id(builder))
+            if size > self.max_bytes:
+                return False
+            self._entries[id(builder)] = (weakref.ref(builder, self._forget), size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                key = next(iter(self._entries))
+                evicted.append(self._entries[key][0]())
+                self._pop(key)
+        for other in evicted:
+            if other is not None:
+                other._drop_plain()
+        return True
+
+    def discard(self, builder: PromptBuilder) -> None:
+        """Stop counting a builder's decompressed blocks (e.g. after it was reset)."""
+        with self._lock:
+            self._pop(id(builder))
+
+    def stats(self) -> dict:
+        """Return the number of builders and bytes currently kept."""
+        with self._lock:
+            return {"builders": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+    # -- Accounting utilities --
+
+    def _pop(self, key: int) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def _forget(self, ref) -> None:
+        # Called when a builder is garbage collected, before its id can be reused
+        with self._lock:
+            for key, (entry_ref, _) in self._entries.items():
+                if entry_ref is ref:
+                    self._pop(key)
+                    break
+
+# --- Helper functions ---
+
+def encode_json(value) -> bytes:
+    """
+    Serialize a value as compact UTF-8 JSON.
+
+    Args:
+        value: A JSON-serializable value.
+
+    Returns:
+        bytes: The encoded value.
+    """
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# --- Shared instance ---
+
+_prefix_cache = None
+_prefix_cache_lock = threading.Lock()
+
+def get_prefix_cache() -> PrefixCache:
+    """
+    Return the process-wide prefix cache.
+
+    Returns:
+        PrefixCache: The shared cache, with the `PROMPT_PREFIX_CACHE_BYTES` budget.
+    """
+    global _prefix_cache
+    with _prefix_cache_lock:
+        if _prefix_cache is None:
+            _prefix_cache = PrefixCache()
+        return _prefix_cache
@@ -0,0 +1,274 @@
+# retrieval.py
+
+# --- Imports ---
+
+# Standard library imports
+import hashlib
+import math
+import os
+from collections import Counter, OrderedDict, defaultdict
+from typing import Optional
+
+# Third party imports
+import regex
+
+# --- Setup ---
+
+# Terms used for scoring: words and numbers, case-folded
+TERM_PATTERN = regex.compile(r"[\p{L}\p{N}_]+")
+
+# Joins the selected chunks, see `ContextIndex.render`
+CHUNK_SEPARATOR = "\n"
+
+# --- Retrieval index class ---
+
+class ContextIndex:
+    """
+    An in-memory BM25 index over the context files of one chat session.
+
+    Files are split into chunks of about `chunk_tokens` tokens, cut at
+    pre-token boundaries of the project's `Tokenizer`, so every chunk decodes
+    cleanly and its token count is exact. Files are indexed once, by content
+    hash, and reused on later turns. Once the index holds more than
+    `max_chunks` chunks, the least recently attached files are dropped
+    (see `trim`).
+
+    Attributes
+    ----------
+    tokenizer : Tokenizer
+        The tokenizer used for chunking and token budgets.
+
+    chunk_tokens : int
+        Target chunk size in tokens.
+
+    k1 : float
+        BM25 term frequency saturation.
+
+    b : float
+        BM25 length normalization.
+
+    max_chunks : int
+        Chunks kept before the least recently attached files are dropped.
+    """
+
+    # -- Constructor --
+
+    def __init__(self, tokenizer, chunk_tokens: Optional[int] = None, k1: float = 1.5, b: float = 0.75, max_chunks: Optional[int] = None):
+        self.tokenizer = tokenizer
+        self.chunk_tokens = chunk_tokens or int(os.getenv("RETRIEVAL_CHUNK_TOKENS", "256"))
+        self.k1 = k1
+        self.b = b
+        self.max_chunks = max_chunks or int(os.getenv("RETRIEVAL_MAX_CHUNKS", "2048"))
+        # Chunk index -> dict with `file`, `text`, `tokens`, `header_tokens`, `length` (term count), `document` and `part`;
+        # indexes only grow, so they stay valid (and in document order) when files are dropped
+        self.chunks = {}
+        self._postings = defaultdict(list) # Term -> [(chunk index, term frequency)]
+        self._files = OrderedDict() # Content hash -> chunk indexes, least recently attached first
+        self._total_length = 0
+        self._next_chunk = 0
+        self._next_document = 0
+
+    # -- Indexing --
+
+    def add_file(self, content: str, name: Optional[str] = None) -> list[int]:
+        """
+        Chunk and index a file, unless identical content was indexed before.
+
+        Parameters
+        ----------
+        content : str
+            The file content.
+
+        name : str, optional
+            A display name included in the chunk header.
+
+        Returns
+        -------
+        list[int]
+            Indexes of the file's chunks.
+        """
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        if digest in self._files:
+            self._files.move_to_end(digest)
+            return self._files[digest]
+
+        # The `[name]` header and separator are sent with every chunk, so they count against budgets too
+        header_tokens = self.tokenizer.count(chunk_header(name) + CHUNK_SEPARATOR)
+        document = self._next_document
+        self._next_document += 1
+        indexes = []
+        for part, (text, tokens) in enumerate(self._chunk(content)):
+            index = self._next_chunk
+            self._next_chunk += 1
+            terms = Counter(term.casefold() for term in TERM_PATTERN.findall(text))
+            length = sum(terms.values())
+            self.chunks[index] = {"file": name, "text": text, "tokens": tokens, "header_tokens": header_tokens, "length": length, "document": document, "part": part}
+            for term, frequency in terms.items():
+                self._postings[term].append((index, frequency))
+            self._total_length += length
+            indexes.append(index)
+
+        self._files[digest] = indexes
+        return indexes
+
+    def trim(self, keep: Optional[set] = None) -> int:
+        """
+        Drop the least recently attached files while the index holds more than `max_chunks` chunks.
+
+        Parameters
+        ----------
+        keep : set, optional
+            Chunk indexes that must stay (e.g. the files attached this turn).
+
+        Returns
+        -------
+        int
+            Number of files dropped.
+        """
+        keep = keep or set()
+        dropped = 0
+        for digest in list(self._files):
+            if len(self.chunks) <= self.max_chunks:
+                break
+            indexes = self._files[digest]
+            if keep.intersection(indexes):
+                continue
+            del self._files[digest]
+            self._drop_chunks(indexes)
+            dropped += 1
+        return dropped
+
+    def _drop_chunks(self, indexes: list[int]) -> None:
+        """Remove chunks and their postings."""
+        removed, terms = set(indexes), set()
+        for index in indexes:
+            chunk = self.chunks.pop(index)
+            self._total_length -= chunk["length"]
+            terms.update(term.casefold() for term in TERM_PATTERN.findall(chunk["text"]))
+        for term in terms:
+            postings = [posting for posting in self._postings[term] if posting[0] not in removed]
+            if postings:
+                self._postings[term] = postings
+            else:
+                del self._postings[term]
+
+    def _chunk(self, content: str):
+        """Yield (text, token count) chunks of about `chunk_tokens` tokens, cut between pre-tokens."""
+        parts, tokens = [], 0
+        for word in self.tokenizer.pretokenize(content):
+            word_tokens = len(self.tokenizer.encode_word(word))
+            if parts and tokens + word_tokens > self.chunk_tokens:
+                yield "".join(parts), tokens
+                parts, tokens = [], 0
+            parts.append(word)
+            tokens += word_tokens
+        if parts:
+            yield "".join(parts), tokens
+
+    # -- Search --
+
+    def search(self, query: str, restrict_to: Optional[set] = None) -> list[tuple[float, int]]:
+        """
+        Rank chunks against a query with BM25.
+
+        Parameters
+        ----------
+        query : str
+            The user prompt.
+
+        restrict_to : set, optional
+            Only rank these chunk indexes (e.g. the files attached this turn).
+
+        Returns
+        -------
+        list[tuple[float, int]]
+            (score, chunk index) pairs, best first.
+        """
+        if not self.chunks:
+            return []
+
+        count = len(self.chunks)
+        average_length = self._total_length / count or 1
+        scores = defaultdict(float)
+        for term in set(t.casefold() for t in TERM_PATTERN.findall(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for index, frequency in postings:
+                if restrict_to is not None and index not in restrict_to:
+                    continue
+                length = self.chunks[index]["length"]
+                scores[index] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * (1 - self.b + self.b * length / average_length))
+
+        return sorted(((score, index) for index, score in scores.items()), reverse=True)
+
+    def select(self, query: str, token_budget: int, top_k: Optional[int] = None, restrict_to: Optional[set] = None) -> list[dict]:
+        """
+        Pick the best chunks that fit a token budget, in document order.
+
+        Each chunk costs its tokens plus those of its header and separator
+        (see `render`). If no chunk matches a query term (e.g. "summarize
+        this"), the leading chunks of each file are picked instead, in turn,
+        until the budget is used.
+
+        Parameters
+        ----------
+        query : str
+            The user prompt.
+
+        token_budget : int
+            Maximum total tokens of the rendered chunks.
+
+        top_k : int, optional
+            Maximum number of matching chunks.
+
+        restrict_to : set, optional
+            Only consider these chunk indexes.
+
+        Returns
+        -------
+        list[dict]
+            The selected chunks.
+        """
+        top_k = top_k or int(os.getenv("RETRIEVAL_TOP_K", "8"))
+        selected, used = [], 0
+        for _, index in self.search(query, restrict_to):
+            chunk = self.chunks[index]
+            cost = chunk["tokens"] + chunk["header_tokens"]
+            if used + cost > token_budget:
+                continue
+            selected.append(index)
+            used += cost
+            if len(selected) >= top_k:
+                break
+        if not selected:
+            selected = self._leading(token_budget, restrict_to)
+        return [self.chunks[index] for index in sorted(selected)]
+
+    @staticmethod
+    def render(chunks: list[dict]) -> str:
+        """Join chunks as they are sent to the model, each under a `[file]` header."""
+        return CHUNK_SEPARATOR.join(chunk_header(chunk["file"]) + chunk["text"] for chunk in chunks)
+
+    def _leading(self, token_budget: int, restrict_to: Optional[set] = None) -> list[int]:
+        """Take the first chunks of each file in turn, stopping at a file's first chunk that does not fit."""
+        candidates = self.chunks.keys() if restrict_to is None else restrict_to
+        selected, used, full = [], 0, set()
+        for index in sorted(candidates, key=lambda index: (self.chunks[index]["part"], self.chunks[index]["document"])):
+            chunk = self.chunks[index]
+            if chunk["document"] in full:
+                continue
+            cost = chunk["tokens"] + chunk["header_tokens"]
+            if used + cost > token_budget:
+                full.add(chunk["document"]) # Keep each file's excerpt contiguous
+                continue
+            selected.append(index)
+            used += cost
+        return selected
+
+# --- Helper functions ---
+
+def chunk_header(name: Optional[str]) -> str:
+    """The line that names a chunk's file, or nothing for unnamed files."""
+    return f"[{name}]\n" if name else ""
@@ -0,0 +1,352 @@
+# session_store.py
+
+# --- Imports ---
+
+# Standard library imports
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from typing import Optional
+
+# Local application imports
+from helpers import setup_logger
+
+# --- Setup ---
+error_logger = setup_logger('session_error_logger', 'session-error.log', logging.ERROR)
+
+# --- Session store classes ---
+
+class SessionStore:
+    """
+    Base class for durable chat session backends.
+
+    A session is stored as an ordered log of events: `add` events carry a
+    message (`id`, `role`, `content`, `tokens`), `remove` events carry the
+    ids of messages trimmed from the history, and `replace` events carry the
+    ids of a span of messages and the message (a summary) that takes its
+    place. Any process can replay the log,
+    and `load(after=...)` returns only the events it hasn't seen yet.
+
+    Writes are queued and committed in batches by a background thread, so
+    request handlers never wait on disk. `flush` commits the queue at once,
+    e.g. at the end of a turn, so the next request (possibly on another
+    worker) reads the turn; it raises if any batch failed since the last
+    flush, so a turn that was not persisted is never reported as saved.
+
+    Attributes
+    ----------
+    flush_interval : float
+        Seconds the writer waits to collect a batch.
+
+    batch_size : int
+        Maximum number of events committed together.
+    """
+
+    # -- Constructor --
+
+    def __init__(self, flush_interval: Optional[float] = None, batch_size: Optional[int] = None):
+        self.flush_interval = flush_interval if flush_interval is not None else float(os.getenv("SESSION_FLUSH_INTERVAL", "0.05"))
+        self.batch_size = batch_size or int(os.getenv("SESSION_BATCH_SIZE", "256"))
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="session-store-writer", daemon=True)
+        self._writer.start()
+
+    # -- Public methods --
+
+    def append(self, session_id: str, message: dict) -> None:
+        """Queue an `add` event for a message."""
+        self._queue.put((session_id, {"op": "add", "message": message}))
+
+    def remove(self, session_id: str, message_ids: list[str]) -> None:
+        """Queue a `remove` event for trimmed messages."""
+        if message_ids:
+            self._queue.put((session_id, {"op": "remove", "ids": list(message_ids)}))
+
+    def replace(self, session_id: str, message_ids: list[str], message: dict) -> None:
+        """Queue a `replace` event for a span of messages compacted into one."""
+        self._queue.put((session_id, {"op": "replace", "ids": list(message_ids), "message": message}))
+
+    def flush(self) -> None:
+        """Block until every queued event has been committed; re-raise the error if a write failed."""
+        done = FlushRequest()
+        self._queue.put(done)
+        done.wait()
+        if done.error is not None:
+            raise done.error
+
+    def load(self, session_id: str, after: int = 0) -> tuple[int, list[dict]]:
+        """
+        Read the events of a session recorded after a position.
+
+        Parameters
+        ----------
+        session_id : str
+            The session to read.
+
+        after : int
+            A position returned by a previous call, or 0 to read everything.
+
+        Returns
+        -------
+        tuple[int, list[dict]]
+            The new position and the events after `after`, oldest first.
+        """
+        raise NotImplementedError
+
+    # -- Session store utilities --
+
+    def _write_batch(self, batch: list[tuple[str, dict]]) -> None:
+        raise NotImplementedError
+
+    def _write_loop(self) -> None:
+        error = None # The last failed write, until a flush reports it
+        while True:
+            batch, waiters = [], []
+            item = self._queue.get()
+            while True:
+                if isinstance(item, FlushRequest):
+                    waiters.append(item)
+                    break # Someone waits for this batch; commit it without waiting for more
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    error_logger.error(f'Could not persist {len(batch)} session event(s): {e}')
+                    error = e
+            for waiter in waiters:
+                waiter.error = error
+                waiter.set()
+            if waiters:
+                error = None
+
+class FlushRequest(threading.Event):
+    """A `flush` waiting in the write queue; `error` is set if a write since the previous flush failed."""
+
+    def __init__(self):
+        super().__init__()
+        self.error = None
+
+class SQLiteSessionStore(SessionStore):
+    """
+    A session store in an embedded SQLite database in WAL mode.
+
+    WAL lets every uvicorn worker read while one of them writes, so any
+    worker can resume any session.
+
+    Attributes
+    ----------
+    path : str
+        Path to the database file.
+    """
+
+    def __init__(self, path: str, **kwargs):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS session_events (
+                    event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    op TEXT NOT NULL,
+                    message_id TEXT NOT NULL,
+                    role TEXT,
+                    content TEXT,
+                    tokens INTEGER,
+                    prompt INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            if "prompt" not in {row[1] for row in conn.execute("PRAGMA table_info(session_events)")}:
+                # Databases from before system prompts were marked
+                conn.execute("ALTER TABLE session_events ADD COLUMN prompt INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS session_events_by_session ON session_events (session_id, event_id)")
+        super().__init__(**kwargs)
+
+    def load(self, session_id: str, after: int = 0) -> tuple[int, list[dict]]:
+        rows = self._connect().execute(
+            "SELECT event_id, op, message_id, role, content, tokens, prompt FROM session_events WHERE session_id = ? AND event_id > ? ORDER BY event_id",
+            (session_id, after)
+        ).fetchall()
+
+        events, position = [], after
+        for event_id, op, message_id, role, content, tokens, prompt in rows:
+            position = event_id
+            if op == "add":
+                message = {"id": message_id, "role": role, "content": content, "tokens": tokens}
+                if prompt:
+                    message["prompt"] = True
+                events.append({"op": "add", "message": message})
+            elif op == "replace":
+                replaced = json.loads(content)
+                events.append({"op": "replace", "ids": replaced["ids"], "message": {"id": message_id, "role": role, "content": replaced["content"], "tokens": tokens}})
+            elif events and events[-1]["op"] == "remove":
+                events[-1]["ids"].append(message_id)
+            else:
+                events.append({"op": "remove", "ids": [message_id]})
+        return position, events
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _write_batch(self, batch: list[tuple[str, dict]]) -> None:
+        conn = self._connect()
+        with conn:
+            for session_id, event in batch:
+                if event["op"] == "add":
+                    message = event["message"]
+                    conn.execute(
+                        "INSERT INTO session_events (session_id, op, message_id, role, content, tokens, prompt) VALUES (?, 'add', ?, ?, ?, ?, ?)",
+                        (session_id, message["id"], message["role"], message["content"], message["tokens"], int(message.get("prompt", False)))
+                    )
+                elif event["op"] == "replace":
+                    self._write_replace(conn, session_id, event["ids"], event["message"])
+                else:
+                    # Drop the trimmed content, keeping a small tombstone for workers that already loaded it
+                    conn.executemany(
+                        "DELETE FROM session_events WHERE session_id = ? AND op = 'add' AND message_id = ?",
+                        [(session_id, message_id) for message_id in event["ids"]]
+                    )
+                    conn.executemany(
+                        "INSERT INTO session_events (session_id, op, message_id) VALUES (?, 'remove', ?)",
+                        [(session_id, message_id) for message_id in event["ids"]]
+                    )
+
+    def _write_replace(self, conn: sqlite3.Connection, session_id: str, message_ids: list[str], message: dict) -> None:
+        """
+        Replace a span of messages: sessions loaded from scratch find the new
+        message in the span's place, and workers that already loaded the span
+        get a `replace` event (span ids and content as JSON).
+        """
+        positions = [
+            row[0] for message_id in message_ids
+            for row in conn.execute("SELECT event_id FROM session_events WHERE session_id = ? AND op = 'add' AND message_id = ?", (session_id, message_id))
+        ]
+        if not positions:
+            return # Already trimmed
+        conn.executemany(
+            "DELETE FROM session_events WHERE session_id = ? AND op = 'add' AND message_id = ?",
+            [(session_id, message_id) for message_id in message_ids]
+        )
+        conn.execute(
+            "INSERT INTO session_events (event_id, session_id, op, message_id, role, content, tokens) VALUES (?, ?, 'add', ?, ?, ?, ?)",
+            (min(positions), session_id, message["id"], message["role"], message["content"], message["tokens"])
+        )
+        conn.execute(
+            "INSERT INTO session_events (session_id, op, message_id, role, content, tokens) VALUES (?, 'replace', ?, ?, ?, ?)",
+            (session_id, message["id"], message["role"], json.dumps({"ids": message_ids, "content": message["content"]}), message["tokens"])
+        )
+
+class AppendLogSessionStore(SessionStore):
+    """
+    A session store with one append-only JSON lines file per session.
+
+    Positions are byte offsets into the session's log, and appends are
+    serialized across processes with an advisory file lock.
+
+    Attributes
+    ----------
+    directory : str
+        Directory holding the `<session_id>.jsonl` files.
+    """
+
+    def __init__(self, directory: str, **kwargs):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(**kwargs)
+
+    def load(self, session_id: str, after: int = 0) -> tuple[int, list[dict]]:
+        try:
+            with open(self._path(session_id), "rb") as f:
+                f.seek(after)
+                data = f.read()
+        except FileNotFoundError:
+            return after, []
+
+        # Ignore a trailing line that is still being written
+        complete = data[:data.rfind(b"\n") + 1]
+        events = [json.loads(line) for line in complete.splitlines() if line]
+        return after + len(complete), events
+
+    def _path(self, session_id: str) -> str:
+        return os.path.join(self.directory, f"{os.path.basename(session_id)}.jsonl")
+
+    def _write_batch(self, batch: list[tuple[str, dict]]) -> None:
+        lines_by_session = {}
+        for session_id, event in batch:
+            lines_by_session.setdefault(session_id, []).append(json.dumps(event, separators=(",", ":")) + "\n")
+
+        for session_id, lines in lines_by_session.items():
+            with open(self._path(session_id), "a", encoding="utf-8") as f:
+                lock_file(f)
+                try:
+                    f.write("".join(lines))
+                    f.flush()
+                finally:
+                    unlock_file(f)
+
+# --- Helper functions ---
+
+def lock_file(f) -> None:
+    """Take an exclusive advisory lock on an open file, where supported."""
+    try:
+        import fcntl
+    except ImportError: # Not available on Windows; appends are then unsynchronized
+        return
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+def unlock_file(f) -> None:
+    try:
+        import fcntl
+    except ImportError:
+        return
+    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+# --- Shared instance ---
+
+_session_store = None
+_session_store_lock = threading.Lock()
+
+def get_session_store() -> Optional[SessionStore]:
+    """
+    Return the process-wide session store configured by `SESSION_STORE`.
+
+    `SESSION_STORE=sqlite` uses `SESSION_STORE_PATH` (default `sessions.db`),
+    `SESSION_STORE=log` uses it as a directory (default `sessions`). Unset
+    keeps sessions in memory only.
+
+    Returns
+    -------
+    SessionStore or None
+        The shared store.
+    """
+    global _session_store
+    backend = os.getenv("SESSION_STORE", "").lower()
+    if not backend:
+        return None
+    with _session_store_lock:
+        if _session_store is None:
+            if backend == "sqlite":
+                _session_store = SQLiteSessionStore(os.getenv("SESSION_STORE_PATH", "sessions.db"))
+            elif backend == "log":
+                _session_store = AppendLogSessionStore(os.getenv("SESSION_STORE_PATH", "sessions"))
+            else:
+                msg = f"Unknown SESSION_STORE backend: {backend}"
+                error_logger.error(msg)
+                raise ValueError(msg)
+        return _session_store
@@ -3,7 +3,14 @@
 class FrontendBPETokenizer {
     static _modelCache = null;
   
-    static async loadModel(url = '/shared/tokenizer_merged_ranks.json') {
+    // The page names the model by a URL fingerprinted with its hash (see static_assets.py),
+    // so the cached copy is reused until the model is retrained
+    static modelUrl() {
+      const meta = document.querySelector('meta[name="tokenizer-model"]');
+      return meta ? meta.content : '/shared/tokenizer.json';
+    }
+
+    static async loadModel(url = FrontendBPETokenizer.modelUrl()) {
       if (FrontendBPETokenizer._modelCache) return FrontendBPETokenizer._modelCache;
       const resp = await fetch(url, { cache: 'force-cache' });
       if (!resp.ok) throw new Error("Failed to load tokenizer model");
@@ -19,6 +26,9 @@ class FrontendBPETokenizer {
       this.patStr = model.pat_str;
       // JS RegExp: use Unicode flag for \w etc.
       this.pattern = new RegExp(this.patStr, 'gu');
+      // Pre-tokenizer version 2 models re-split words longer than max_word_length code points
+      this.maxWordLength = model.max_word_length || 0;
+      this.basePattern = model.base_pat_str ? new RegExp(model.base_pat_str, 'gu') : null;
     }
   
     static toBytes(str) {
@@ -33,7 +43,8 @@ class FrontendBPETokenizer {
   
     /** Split text into tokens by pattern, then BPE-encode each. */
     encode(text) {
-      const words = Array.from(text.matchAll(this.pattern)).map(m => m[0]);
+      let words = Array.from(text.matchAll(this.pattern)).map(m => m[0]);
+      if (this.maxWordLength) words = words.flatMap(word => this._splitLongWord(word));
       let tokens = [];
       for (const word of words) {
         tokens.push(...this._bpeEncodeWord(word));
@@ -41,6 +52,22 @@ class FrontendBPETokenizer {
       return tokens.filter(Number.isFinite);
     }
   
+    /** Re-split a word longer than maxWordLength, like the Python `pretokenize`. */
+    _splitLongWord(word) {
+      const chars = Array.from(word);
+      if (chars.length <= this.maxWordLength) return [word];
+      const pieces = this.basePattern ? Array.from(word.matchAll(this.basePattern)).map(m => m[0]) : [word];
+      return pieces.flatMap(piece => {
+        const pieceChars = Array.from(piece);
+        if (pieceChars.length <= this.maxWordLength) return [piece];
+        const chunks = [];
+        for (let i = 0; i < pieceChars.length; i += this.maxWordLength) {
+          chunks.push(pieceChars.slice(i, i + this.maxWordLength).join(''));
+        }
+        return chunks;
+      });
+    }
+
     /** BPE-encode one word (already split). */
     _bpeEncodeWord(word) {
       // Word to byte sequence
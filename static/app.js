@@ -112,10 +112,21 @@ async function ensureFrontendTokenizer() {
   return appState.get().frontendTokenizer;
 }
 
-// Count tokens locally
+// Count tokens locally, or on the server (counts only, no ids) until the local model is loaded
 async function fastLocalTokenCount(text) {
   if (!text) return 0;
-  return appState.get().frontendTokenizer.encode(text).length;
+  const tokenizer = appState.get().frontendTokenizer;
+  if (tokenizer) return tokenizer.encode(text).length;
+  const formData = new FormData();
+  formData.append('text', text);
+  return (await serverTokenCounts(formData)).text_token_count;
+}
+
+// Ask /token_count for counts only; the smallest response mode
+async function serverTokenCounts(formData) {
+  const res = await fetch('/token_count?mode=counts', { method: 'POST', body: formData });
+  if (!res.ok) throw new Error(`Token count failed: ${res.status}`);
+  return res.json();
 }
 
 /**
@@ -459,9 +470,17 @@ function readFileAsText(file) {
  */
 async function setTokenGroupCounts(tokenGroup) {
   if (tokenGroup === 'context_files') {
+    const textFiles = appState.get().selectedFiles.filter(f => !f.type.startsWith('image/'));
+    if (!appState.get().frontendTokenizer && textFiles.length) {
+      // One upload for all files; per-file counts without ids
+      const formData = new FormData();
+      textFiles.forEach(f => formData.append('files', f));
+      const result = await serverTokenCounts(formData);
+      appState.set({ filesTokenCounts: result.files.map(f => ({ filename: f.filename, token_count: f.token_count || 0 })) });
+      return;
+    }
     const counts = await Promise.all(
-      appState.get().selectedFiles
-        .filter(f => !f.type.startsWith('image/'))
+      textFiles
         .map(async (f) => {
           const content = await readFileAsText(f);
           const tokenCount = await fastLocalTokenCount(content);
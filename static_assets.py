@@ -0,0 +1,343 @@
+# static_assets.py
+
+# --- Imports ---
+
+# Standard library imports
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from typing import Callable, Iterable, Optional
+
+# Third party imports
+from starlette.requests import Request
+from starlette.responses import Response
+
+# Third party imports (optional)
+try:
+    import brotli
+except ImportError: # Brotli is optional; without it assets are precompressed with gzip only
+    brotli = None
+
+# --- Setup ---
+
+STATIC_COMPRESS_MIN_SIZE = int(os.getenv("STATIC_COMPRESS_MIN_SIZE", "512"))
+
+# Content types worth compressing; images other than icons are already compressed
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml", "image/x-icon", "image/vnd.microsoft.icon")
+
+# Preferred order when a client accepts several encodings
+ENCODINGS = ("br", "gzip", "identity")
+
+IMMUTABLE = "public, max-age=31536000, immutable" # Fingerprinted URLs never change content
+REVALIDATE = "no-cache" # Plain URLs are revalidated with their ETag on every use
+
+# `name.<fingerprint>.ext`, see `Asset.url`
+FINGERPRINTED = re.compile(r"^(?P<stem>.+)\.(?P<fingerprint>[0-9a-f]{12})(?P<ext>\.[^./]+)$")
+
+# Quoted /static/ and /shared/ URLs in HTML, rewritten to their fingerprinted form
+ASSET_REFERENCE = re.compile(r"""(?P<quote>["'])(?P<url>/(?:static|shared)/[^"'?#]+)(?P=quote)""")
+
+# --- Asset class ---
+
+class Asset:
+    """
+    The content of one static asset, precompressed once.
+
+    Attributes
+    ----------
+    path : str
+        The plain URL path, e.g. `/static/app.js`.
+
+    content_type : str
+        The media type.
+
+    digest : str
+        SHA-256 of the content (hex).
+
+    variants : dict[str, bytes]
+        The content by encoding: `identity`, and `gzip`/`br` when they are smaller.
+
+    version : tuple
+        What the asset was built from (file size and mtime, or source mtimes), to detect changes.
+    """
+
+    # -- Constructor --
+
+    def __init__(self, path: str, data: bytes, content_type: Optional[str] = None, version: tuple = ()):
+        self.path = path
+        self.content_type = content_type or mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.version = version
+        self.variants = {"identity": data}
+        if self.content_type.startswith(COMPRESSIBLE_TYPES) and len(data) >= STATIC_COMPRESS_MIN_SIZE:
+            compressed = gzip.compress(data, compresslevel=9, mtime=0) # No timestamp, so rebuilds are byte-identical
+            if len(compressed) < len(data):
+                self.variants["gzip"] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data):
+                    self.variants["br"] = compressed
+
+    @property
+    def fingerprint(self) -> str:
+        return self.digest[:12]
+
+    @property
+    def url(self) -> str:
+        """The fingerprinted URL, e.g. `/static/app.3f2a9c1b7d04.js`."""
+        directory, name = self.path.rsplit("/", 1)
+        stem, ext = os.path.splitext(name)
+        return f"{directory}/{stem}.{self.fingerprint}{ext}"
+
+    def etag(self, encoding: str) -> str:
+        """A strong ETag per encoding, since each encoding is a different byte sequence."""
+        return f'"{self.fingerprint}"' if encoding == "identity" else f'"{self.fingerprint}-{encoding}"'
+
+    # -- Responses --
+
+    def response(self, request: Request, immutable: bool = False) -> Response:
+        """
+        Build the response for a request: negotiated encoding, ETag and caching headers, or 304.
+
+        Parameters
+        ----------
+        request : Request
+            The request (`Accept-Encoding`, `If-None-Match`, method).
+
+        immutable : bool
+            Whether the URL was fingerprinted with this content, so it can be cached forever.
+
+        Returns
+        -------
+        Response
+            The asset response.
+        """
+        encoding = negotiate_encoding(request.headers.get("accept-encoding", ""), self.variants)
+        headers = {
+            "ETag": self.etag(encoding),
+            "Cache-Control": IMMUTABLE if immutable else REVALIDATE,
+            "Vary": "Accept-Encoding"
+        }
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in tags or tags & {self.etag(name) for name in self.variants}:
+                return Response(status_code=304, headers=headers)
+
+        body = self.variants[encoding]
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            body = b""
+        return Response(body, media_type=self.content_type, headers=headers)
+
+# --- Static assets class ---
+
+class StaticAssets:
+    """
+    Serves static files precompressed (gzip, and Brotli when installed), with
+    ETags and fingerprinted URLs.
+
+    Files under the mounted directories are read and compressed once at
+    startup, and again only when they change on disk. Generated assets (e.g.
+    the frontend tokenizer model) are built on first use and rebuilt when one
+    of their source files changes. `url_for` returns the fingerprinted URL of
+    an asset, which browsers may cache forever; plain URLs are served with
+    `no-cache`, so they are revalidated with their ETag.
+
+    Attributes
+    ----------
+    mounts : dict[str, str]
+        URL prefix (e.g. `/static`) -> directory.
+    """
+
+    # -- Constructor --
+
+    def __init__(self, mounts: dict[str, str]):
+        self.mounts = mounts
+        self._assets: dict[str, Asset] = {}
+        self._generated: dict[str, tuple[Callable[[], bytes], Optional[str], tuple[str, ...]]] = {}
+        self._pages: dict[str, Asset] = {}
+        self._lock = threading.Lock()
+
+        # Precompress everything up front, so requests never wait on compression
+        for prefix, directory in mounts.items():
+            for root, _, files in os.walk(directory):
+                for name in files:
+                    relative = os.path.relpath(os.path.join(root, name), directory).replace(os.sep, "/")
+                    self.get(f"{prefix}/{relative}")
+
+    def add_generated(self, path: str, build: Callable[[], bytes], content_type: Optional[str] = None, sources: Iterable[str] = ()) -> None:
+        """
+        Register an asset produced by code instead of read from a file.
+
+        Parameters
+        ----------
+        path : str
+            Its plain URL path.
+
+        build : Callable[[], bytes]
+            Produces the content.
+
+        content_type : str, optional
+            The media type (default: guessed from `path`).
+
+        sources : Iterable[str]
+            Files the content is derived from; it is rebuilt when any of them changes.
+        """
+        with self._lock:
+            self._generated[path] = (build, content_type, tuple(sources))
+            self._assets.pop(path, None)
+
+    # -- Lookup --
+
+    def get(self, path: str) -> Optional[Asset]:
+        """Return the current asset for a plain URL path, (re)building it if needed, or None."""
+        if path in self._generated:
+            build, content_type, sources = self._generated[path]
+            version = tuple(file_version(source) for source in sources)
+            asset = self._assets.get(path)
+            if asset is None or asset.version != version:
+                with self._lock:
+                    asset = self._assets.get(path)
+                    if asset is None or asset.version != version:
+                        asset = self._assets[path] = Asset(path, build(), content_type, version)
+            return asset
+
+        file_path = self._file_path(path)
+        if file_path is None:
+            return None
+        version = file_version(file_path)
+        if version is None:
+            self._assets.pop(path, None)
+            return None
+        asset = self._assets.get(path)
+        if asset is None or asset.version != version:
+            with open(file_path, "rb") as f:
+                data = f.read()
+            asset = self._assets[path] = Asset(path, data, version=version)
+        return asset
+
+    def url_for(self, path: str) -> str:
+        """Return the fingerprinted URL of an asset, or `path` unchanged if it is unknown."""
+        asset = self.get(path)
+        return asset.url if asset is not None else path
+
+    # -- Responses --
+
+    def response(self, request: Request, path: str) -> Response:
+        """
+        Serve a plain or fingerprinted URL path.
+
+        A fingerprint that does not match the current content (an old page
+        asking for a replaced asset) gets the current content, revalidated
+        like a plain URL.
+
+        Parameters
+        ----------
+        request : Request
+            The request.
+
+        path : str
+            The requested URL path.
+
+        Returns
+        -------
+        Response
+            The asset, a 304, or a 404.
+        """
+        asset = self.get(path)
+        fingerprint = None
+        if asset is None:
+            directory, name = path.rsplit("/", 1)
+            match = FINGERPRINTED.match(name)
+            if match:
+                asset = self.get(f"{directory}/{match['stem']}{match['ext']}")
+                fingerprint = match["fingerprint"]
+        if asset is None:
+            return Response("Not Found", status_code=404, media_type="text/plain")
+        return asset.response(request, immutable=fingerprint is not None and fingerprint == asset.fingerprint)
+
+    def page_response(self, request: Request, path: str) -> Response:
+        """
+        Serve an HTML page with its /static/ and /shared/ references rewritten to fingerprinted URLs.
+
+        The page itself is revalidated on every load (its ETag changes when
+        it, or any asset it references, changes), while the assets it
+        references are cached forever.
+        """
+        source = self.get(path)
+        if source is None:
+            return Response("Not Found", status_code=404, media_type="text/plain")
+        html = ASSET_REFERENCE.sub(
+            lambda match: f"{match['quote']}{self.url_for(match['url'])}{match['quote']}",
+            source.variants["identity"].decode("utf-8")
+        ).encode("utf-8")
+        page = self._pages.get(path)
+        if page is None or page.variants["identity"] != html:
+            page = self._pages[path] = Asset(path, html, "text/html; charset=utf-8")
+        return page.response(request)
+
+    def stats(self) -> dict:
+        """Return the number of assets and their identity and smallest encoded sizes (bytes)."""
+        assets = list(self._assets.values())
+        return {
+            "assets": len(assets),
+            "bytes": sum(len(asset.variants["identity"]) for asset in assets),
+            "compressed_bytes": sum(min(len(data) for data in asset.variants.values()) for asset in assets),
+            "brotli": brotli is not None
+        }
+
+    # -- Static asset utilities --
+
+    def _file_path(self, path: str) -> Optional[str]:
+        """Map a URL path to a file under its mount, refusing paths that escape it."""
+        for prefix, directory in self.mounts.items():
+            if path.startswith(prefix + "/"):
+                root = os.path.realpath(directory)
+                file_path = os.path.realpath(os.path.join(root, path[len(prefix) + 1:]))
+                if file_path.startswith(root + os.sep):
+                    return file_path
+        return None
+
+# --- Helper functions ---
+
+def negotiate_encoding(accept_encoding: str, available: Iterable[str]) -> str:
+    """
+    Pick the preferred available encoding that an `Accept-Encoding` header allows.
+
+    Args:
+        accept_encoding (str): The request header, e.g. `gzip, deflate, br;q=0.9`.
+        available (Iterable[str]): Encodings the asset has (always including `identity`).
+
+    Returns:
+        str: `br`, `gzip` or `identity`.
+    """
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name] = quality
+    wildcard = accepted.get("*", 0.0)
+    candidates = [(accepted.get(encoding, wildcard), -rank, encoding) for rank, encoding in enumerate(ENCODINGS) if encoding != "identity" and encoding in available]
+    quality, _, encoding = max(candidates, default=(0.0, 0, "identity"))
+    return encoding if quality > 0 else "identity"
+
+def file_version(path: str) -> Optional[tuple]:
+    """Return a file's size and modification time, or None if it is missing."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
@@ -0,0 +1,173 @@
+# stub_server.py
+#
+# A local, OpenAI-compatible chat completions stub for offline load testing.
+#
+#   python stub_server.py --port 8001 --latency 0.3 --token-rate 80 --error-rate 0.02
+#   OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=stub uvicorn app:app
+
+# --- Imports ---
+
+# Standard library imports
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+# Third party imports
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# --- Setup ---
+
+class StubConfig:
+    """
+    Runtime behaviour of the stub, read from `STUB_*` environment variables.
+
+    Attributes
+    ----------
+    latency : float
+        Seconds before the first byte of every response.
+
+    jitter : float
+        Extra random latency, uniformly drawn from [0, jitter] seconds.
+
+    token_rate : float
+        Generated tokens per second; 0 sends the whole reply at once.
+
+    reply_tokens : int
+        Number of tokens (words) in every reply.
+
+    error_rate : float
+        Fraction of requests answered with an injected error.
+
+    error_status : int
+        HTTP status used for injected errors (e.g. 429 or 503).
+    """
+
+    def __init__(self):
+        self.latency = float(os.getenv("STUB_LATENCY", "0.2"))
+        self.jitter = float(os.getenv("STUB_JITTER", "0.05"))
+        self.token_rate = float(os.getenv("STUB_TOKEN_RATE", "0"))
+        self.reply_tokens = int(os.getenv("STUB_REPLY_TOKENS", "64"))
+        self.error_rate = float(os.getenv("STUB_ERROR_RATE", "0"))
+        self.error_status = int(os.getenv("STUB_ERROR_STATUS", "503"))
+
+config = StubConfig()
+app = FastAPI()
+
+# --- Reply generation ---
+
+def build_reply(messages: list) -> list[str]:
+    """
+    Build a deterministic reply from the words of the last user message.
+
+    Args:
+        messages (list): The request messages.
+
+    Returns:
+        list[str]: The reply, one word (token) per item.
+    """
+    content = messages[-1].get("content", "") if messages else ""
+    if isinstance(content, list): # Vision requests send content parts
+        content = " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+    words = content.split() or ["stub"]
+    return [("" if i == 0 else " ") + words[i % len(words)] for i in range(config.reply_tokens)]
+
+def usage(messages: list, completion_tokens: int) -> dict:
+    prompt_tokens = sum(len(json.dumps(m.get("content", ""))) // 4 for m in messages)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+
+# --- Endpoints ---
+
+@app.post("/v1/chat/completions")
+@app.post("/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    messages = body.get("messages", [])
+    model = body.get("model", "stub")
+
+    await asyncio.sleep(config.latency + random.uniform(0, config.jitter))
+
+    if random.random() < config.error_rate:
+        return JSONResponse(
+            {"error": {"message": "Injected stub error", "type": "server_error", "code": None}},
+            status_code=config.error_status,
+            headers={"retry-after": "0"} if config.error_status == 429 else None
+        )
+
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    reply = build_reply(messages)
+
+    if not body.get("stream"):
+        if config.token_rate > 0:
+            await asyncio.sleep(len(reply) / config.token_rate)
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(reply)},
+                "finish_reason": "stop"
+            }],
+            "usage": usage(messages, len(reply))
+        }
+
+    def chunk(delta: dict, finish_reason=None) -> str:
+        data = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+        return f"data: {json.dumps(data)}\n\n"
+
+    async def stream():
+        yield chunk({"role": "assistant", "content": ""})
+        for token in reply:
+            if config.token_rate > 0:
+                await asyncio.sleep(1 / config.token_rate)
+            yield chunk({"content": token})
+        yield chunk({}, "stop")
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+@app.get("/v1/models")
+async def models():
+    return {"object": "list", "data": [{"id": "stub", "object": "model", "created": 0, "owned_by": "stub"}]}
+
+# --- Main ---
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stub server for load testing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, help="Seconds before the first byte")
+    parser.add_argument("--jitter", type=float, help="Random extra latency, in seconds")
+    parser.add_argument("--token-rate", type=float, help="Tokens per second (0 = instant)")
+    parser.add_argument("--reply-tokens", type=int, help="Tokens per reply")
+    parser.add_argument("--error-rate", type=float, help="Fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, help="HTTP status of injected errors")
+    args = parser.parse_args()
+
+    for name in ("latency", "jitter", "token_rate", "reply_tokens", "error_rate", "error_status"):
+        value = getattr(args, name)
+        if value is not None:
+            setattr(config, name, value)
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,548 @@
+# tokenizer_daemon.py
+#
+# A tokenizer process shared by every uvicorn worker and CLI process on a host:
+# one model, one warm-up and one encode cache instead of one per process.
+# Start it once per host, then set TOKENIZER_SOCKET to the same path:
+#
+#   python tokenizer_daemon.py --socket /tmp/pair-tokenizer.sock
+#
+# `TokenizerService` then encodes, counts and decodes through the daemon, and
+# falls back to its own in-process model while the daemon is unreachable.
+
+# --- Imports ---
+
+# Standard library imports
+import argparse
+import hashlib
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+# Local application imports
+from helpers import setup_logger
+from SimpleBytePairEncoding import Tokenizer, TokenizerService, pack_token_ids, token_id_width, unpack_token_ids
+
+# --- Setup ---
+
+error_logger = setup_logger('tokenizer_daemon_error_logger', 'tokenizer-error.log', logging.ERROR)
+
+DEFAULT_SOCKET = "/tmp/pair-tokenizer.sock"
+TOKENIZER_DAEMON_TIMEOUT = float(os.getenv("TOKENIZER_DAEMON_TIMEOUT", "5"))
+TOKENIZER_DAEMON_RETRY = float(os.getenv("TOKENIZER_DAEMON_RETRY", "5"))
+MAX_FRAME_SIZE = int(os.getenv("TOKENIZER_DAEMON_MAX_FRAME", str(64 * 2**20)))
+TOKENIZER_DAEMON_WORKERS = int(os.getenv("TOKENIZER_DAEMON_WORKERS", "1")) # Serving processes; each extra one has its own cache
+
+# -- Protocol --
+# Requests and responses are frames: a little-endian header, then `count` items,
+# each a uint32 length followed by its bytes. The header is the uint32 size of
+# the rest of the frame, a code (the op in requests, the status in responses),
+# the token id width of id items (2 or 4, see `token_id_width`) and `count`.
+#
+#   ENCODE  items: UTF-8 texts     -> items: packed ids, one per text
+#   COUNT   items: UTF-8 texts     -> one item: packed uint32 counts
+#   DECODE  items: packed ids      -> items: decoded bytes
+#   INFO    no items               -> one item: JSON (model id, cache size, counters)
+#
+# An ERROR response carries one UTF-8 message item.
+FRAME_HEADER = struct.Struct("<IBBI")
+ITEM_HEADER = struct.Struct("<I")
+OP_ENCODE, OP_COUNT, OP_DECODE, OP_INFO = 1, 2, 3, 4
+STATUS_OK, STATUS_ERROR = 0, 1
+
+# --- Exceptions ---
+
+class TokenizerDaemonError(Exception):
+    """Raised for malformed frames and for errors reported by the daemon."""
+
+# --- Protocol functions ---
+
+def pack_frame(code: int, items: Iterable[bytes], width: int = 0) -> bytes:
+    """
+    Build a frame.
+
+    Args:
+        code (int): The op (requests) or status (responses).
+        items (Iterable[bytes]): The items.
+        width (int): Token id width of id items, or 0.
+
+    Returns:
+        bytes: The frame, ready to send.
+    """
+    parts = [b""]
+    count = 0
+    for item in items:
+        parts.append(ITEM_HEADER.pack(len(item)))
+        parts.append(item)
+        count += 1
+    body = b"".join(parts)
+    parts[0] = FRAME_HEADER.pack(FRAME_HEADER.size - 4 + len(body), code, width, count)
+    return parts[0] + body
+
+def read_frame(stream) -> Optional[tuple[int, int, list[bytes]]]:
+    """
+    Read one frame from a buffered binary stream (e.g. `socket.makefile("rb")`).
+
+    Args:
+        stream (BinaryIO): The stream.
+
+    Returns:
+        tuple or None: The code, width and items, or None at end of stream.
+
+    Raises:
+        TokenizerDaemonError: If the frame is truncated, too large or malformed.
+    """
+    header = stream.read(FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) < FRAME_HEADER.size:
+        raise TokenizerDaemonError("Truncated frame header")
+    size, code, width, count = FRAME_HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise TokenizerDaemonError(f"Frame of {size} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    body = stream.read(size - (FRAME_HEADER.size - 4))
+    if len(body) < size - (FRAME_HEADER.size - 4):
+        raise TokenizerDaemonError("Truncated frame")
+
+    items = []
+    offset = 0
+    for _ in range(count):
+        if offset + ITEM_HEADER.size > len(body):
+            raise TokenizerDaemonError("Malformed frame")
+        (length,) = ITEM_HEADER.unpack_from(body, offset)
+        offset += ITEM_HEADER.size
+        items.append(body[offset:offset + length])
+        offset += length
+    if offset != len(body):
+        raise TokenizerDaemonError("Malformed frame")
+    return code, width, items
+
+def model_id(path: str, pat_str: Optional[str] = None) -> str:
+    """Identify a model file by its content (SHA-256), plus the rank file pattern if any, so copies at other paths match."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    model = f"sha256:{digest.hexdigest()}"
+    return f"{model}|{pat_str}" if pat_str else model
+
+# --- Daemon ---
+
+class TokenizerRequestHandler(socketserver.StreamRequestHandler):
+    """Serves the frames of one client connection, in order, until it closes."""
+
+    def handle(self):
+        while True:
+            try:
+                frame = read_frame(self.rfile)
+                if frame is None:
+                    return
+                code, items = self.server.execute(*frame)
+            except TokenizerDaemonError as e:
+                # The stream can no longer be trusted: report and drop the connection
+                self.wfile.write(pack_frame(STATUS_ERROR, [str(e).encode("utf-8")]))
+                return
+            self.wfile.write(pack_frame(code, *items))
+
+class TokenizerDaemon(socketserver.ThreadingUnixStreamServer):
+    """
+    A Unix domain socket server that tokenizes for other processes.
+
+    Each connection is served by its own thread, and the threads share the
+    tokenizer and its word cache without a lock, so by default one process
+    serves every client from one cache. Optionally, `serve` pre-forks worker
+    processes that accept on the same socket to use several cores; each has
+    its own copy of the tokenizer and its own word cache, so cache hits drop
+    and cache memory grows with their number.
+
+    Attributes
+    ----------
+    tokenizer : Tokenizer
+        The shared tokenizer.
+
+    model_id : str
+        Identifies the served model, see `model_id`; clients compare it with their own.
+    """
+
+    daemon_threads = True
+
+    # -- Constructor --
+
+    def __init__(self, socket_path: str, tokenizer: Tokenizer, model_id: str = ""):
+        self.tokenizer = tokenizer
+        self.model_id = model_id
+        self.started = time.time()
+        self._counters = {"requests": 0, "items": 0, "errors": 0}
+
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                os.unlink(socket_path) # Left behind by a daemon that did not shut down cleanly
+            else:
+                raise OSError(f"A tokenizer daemon is already listening on {socket_path}")
+            finally:
+                probe.close()
+        super().__init__(socket_path, TokenizerRequestHandler)
+        os.chmod(socket_path, 0o600)
+        self._owner = os.getpid() # Only the process that bound the socket removes it
+
+    def server_close(self):
+        super().server_close()
+        if os.getpid() == self._owner and os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+    def serve(self, workers: int = 1) -> None:
+        """
+        Serve until interrupted, in this process and `workers - 1` forked ones.
+
+        The workers accept connections on the already bound socket, so the
+        kernel spreads clients over them; each runs its own threads and
+        tokenizer copy (shared copy-on-write after the fork), and fills its own
+        word cache.
+
+        Args:
+            workers (int): Number of serving processes.
+        """
+        children = []
+        for _ in range(max(1, workers) - 1):
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_IGN) # The parent stops the workers
+                try:
+                    self.serve_forever()
+                finally:
+                    os._exit(0)
+            children.append(pid)
+        try:
+            self.serve_forever()
+        finally:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+
+    # -- Requests --
+
+    def execute(self, op: int, width: int, items: list[bytes]) -> tuple[int, tuple[list[bytes], int]]:
+        """
+        Run one request.
+
+        Args:
+            op (int): The request op.
+            width (int): Token id width of DECODE items.
+            items (list[bytes]): The request items.
+
+        Returns:
+            tuple: The status and the response items with their id width.
+        """
+        self._counters["requests"] += 1
+        self._counters["items"] += len(items)
+        try:
+            return self._execute(op, width, items)
+        except Exception as e:
+            self._counters["errors"] += 1
+            error_logger.error(f"Tokenizer daemon request failed: {e}")
+            return STATUS_ERROR, ([str(e).encode("utf-8")], 0)
+
+    def _execute(self, op: int, width: int, items: list[bytes]) -> tuple[int, tuple[list[bytes], int]]:
+        if op == OP_ENCODE:
+            sequences = [self.tokenizer.encode(item.decode("utf-8")) for item in items]
+            width = token_id_width([max(tokens) for tokens in sequences if tokens])
+            return STATUS_OK, ([pack_token_ids(tokens, width) for tokens in sequences], width)
+        if op == OP_COUNT:
+            counts = [self.tokenizer.count(item.decode("utf-8")) for item in items]
+            return STATUS_OK, ([pack_token_ids(counts, 4)], 4)
+        if op == OP_DECODE:
+            return STATUS_OK, ([self.tokenizer.decode_bytes(unpack_token_ids(item, width)) for item in items], 0)
+        if op == OP_INFO:
+            return STATUS_OK, ([json.dumps(self.info()).encode("utf-8")], 0)
+        raise ValueError(f"Unknown op: {op}")
+
+    def info(self) -> dict:
+        """Return the model id, vocabulary and cache sizes, uptime and request counters."""
+        info = dict(self._counters)
+        info.update({
+            "model_id": self.model_id,
+            "vocab_size": len(self.tokenizer.mergeable_ranks),
+            "pretokenizer_version": self.tokenizer.pretokenizer_version,
+            "cache_size": len(self.tokenizer._cache),
+            "uptime": time.time() - self.started,
+            "pid": os.getpid()
+        })
+        return info
+
+# --- Client ---
+
+class TokenizerClient:
+    """
+    A connection to a tokenizer daemon.
+
+    Each thread keeps its own persistent connection, so concurrent callers
+    never interleave frames. Connection errors raise `OSError` and daemon
+    errors `TokenizerDaemonError`; the broken connection is dropped and the
+    next call reconnects.
+
+    Attributes
+    ----------
+    socket_path : str
+        The daemon socket.
+
+    timeout : float
+        Seconds to wait for a connection or a response.
+    """
+
+    # -- Constructor --
+
+    def __init__(self, socket_path: str, timeout: float = TOKENIZER_DAEMON_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    # -- Requests --
+
+    def encode_batch(self, texts: list[str]) -> list[list[int]]:
+        """Encode texts; returns the token ids of each."""
+        width, items = self.call(OP_ENCODE, [text.encode("utf-8") for text in texts])
+        return [unpack_token_ids(item, width) for item in items]
+
+    def count_batch(self, texts: list[str]) -> list[int]:
+        """Count the tokens of each text."""
+        width, items = self.call(OP_COUNT, [text.encode("utf-8") for text in texts])
+        return unpack_token_ids(items[0], width)
+
+    def decode_bytes_batch(self, sequences: Iterable) -> list[bytes]:
+        """Decode token id sequences to bytes; ids outside the vocabulary decode to nothing."""
+        sequences = [tokens if isinstance(tokens, list) else list(tokens) for tokens in sequences]
+        width = token_id_width([max(tokens) for tokens in sequences if tokens])
+        try:
+            items = [pack_token_ids(tokens, width) for tokens in sequences]
+        except OverflowError: # Negative or huge ids, which are unknown anyway
+            items = [pack_token_ids([token for token in tokens if 0 <= token < 1 << 32], width) for tokens in sequences]
+        _, items = self.call(OP_DECODE, items, width)
+        return items
+
+    def info(self) -> dict:
+        """Return the daemon's `TokenizerDaemon.info`."""
+        _, items = self.call(OP_INFO, [])
+        return json.loads(items[0])
+
+    def call(self, op: int, items: list[bytes], width: int = 0) -> tuple[int, list[bytes]]:
+        """
+        Send one request and wait for its response.
+
+        Args:
+            op (int): The request op.
+            items (list[bytes]): The request items.
+            width (int): Token id width of id items.
+
+        Returns:
+            tuple: The response id width and items.
+        """
+        request = pack_frame(op, items, width)
+        reused = getattr(self._local, "connection", None) is not None
+        while True:
+            connection, stream = self._connect()
+            try:
+                connection.sendall(request)
+                frame = read_frame(stream)
+                if frame is None:
+                    raise ConnectionError("The tokenizer daemon closed the connection")
+                break
+            except (OSError, TokenizerDaemonError) as e:
+                self.close()
+                if not (reused and isinstance(e, OSError)):
+                    raise
+                reused = False # Kept from before a daemon restart: reconnect once
+        status, width, items = frame
+        if status != STATUS_OK:
+            raise TokenizerDaemonError(items[0].decode("utf-8", errors="replace") if items else "Unknown error")
+        return width, items
+
+    # -- Connection --
+
+    def _connect(self) -> tuple[socket.socket, object]:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            connection = self._local.connection = (sock, sock.makefile("rb"))
+        return connection
+
+    def close(self) -> None:
+        """Close this thread's connection."""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            self._local.connection = None
+            connection[1].close()
+            connection[0].close()
+
+# --- Sidecar tokenizer ---
+
+class SidecarTokenizer:
+    """
+    A `Tokenizer` stand-in that encodes, counts and decodes through a tokenizer daemon.
+
+    When the daemon is unreachable, fails, or serves another model (e.g. it
+    was started before `pair.pkl` was retrained), calls fall back to an
+    in-process tokenizer, loaded on first use, and the daemon is tried again
+    after `retry_interval` seconds. Every other attribute (`pretokenize`,
+    `encode_word`, `mergeable_ranks`, ...) is the in-process tokenizer's.
+
+    Attributes
+    ----------
+    client : TokenizerClient
+        The daemon connection.
+
+    model_id : str
+        The expected `TokenizerDaemon.model_id`; None accepts any model.
+
+    retry_interval : float
+        Seconds to use the in-process tokenizer after a daemon failure.
+    """
+
+    # Instance attributes of `Tokenizer` that are read from the in-process tokenizer
+    LOCAL_ATTRIBUTES = frozenset(["mergeable_ranks", "pat_str", "max_word_length", "base_pat_str", "pretokenizer_version"])
+
+    # -- Constructor --
+
+    def __init__(self, client: TokenizerClient, load_local: Callable[[], Tokenizer], model_id: Optional[str] = None, retry_interval: float = TOKENIZER_DAEMON_RETRY):
+        self._local = None
+        self._load_local = load_local
+        self._local_lock = threading.Lock()
+        self.client = client
+        self.model_id = model_id
+        self.retry_interval = retry_interval
+        self._checked = False # Whether the daemon's model was compared with `model_id`
+        self._retry_at = 0.0
+        self._counters = {"daemon_calls": 0, "local_calls": 0, "daemon_failures": 0}
+
+    @property
+    def local(self) -> Tokenizer:
+        """The in-process tokenizer, loaded on first use."""
+        if self._local is None:
+            with self._local_lock:
+                if self._local is None:
+                    self._local = self._load_local()
+        return self._local
+
+    def __getattr__(self, name):
+        # Only `Tokenizer` attributes, so probes like `hasattr(tokenizer, "token_limit")` do not load the model
+        if name.startswith("_") or not (name in self.LOCAL_ATTRIBUTES or hasattr(Tokenizer, name)):
+            raise AttributeError(name)
+        return getattr(self.local, name)
+
+    # -- Encoding and decoding methods --
+
+    def encode(self, text: str) -> list[int]:
+        return self._call(lambda: self.client.encode_batch([text])[0], lambda: self.local.encode(text))
+
+    def count(self, text: str) -> int:
+        return self._call(lambda: self.client.count_batch([text])[0], lambda: self.local.count(text))
+
+    def encode_batch(self, texts: list[str]) -> list[list[int]]:
+        """Encode many texts in one round trip."""
+        return self._call(lambda: self.client.encode_batch(texts), lambda: [self.local.encode(text) for text in texts])
+
+    def count_batch(self, texts: list[str]) -> list[int]:
+        """Count the tokens of many texts in one round trip."""
+        return self._call(lambda: self.client.count_batch(texts), lambda: [self.local.count(text) for text in texts])
+
+    def decode(self, tokens: list[int]) -> str:
+        return self.decode_bytes(tokens).decode("utf-8", errors="replace")
+
+    def decode_bytes(self, tokens: list[int]) -> bytes:
+        return self._call(lambda: self.client.decode_bytes_batch([tokens])[0], lambda: self.local.decode_bytes(tokens))
+
+    def decode_batch(self, sequences) -> list[str]:
+        sequences = list(sequences)
+        return self._call(
+            lambda: [data.decode("utf-8", errors="replace") for data in self.client.decode_bytes_batch(sequences)],
+            lambda: self.local.decode_batch(sequences)
+        )
+
+    # -- Daemon utilities --
+
+    def stats(self) -> dict:
+        """Return call counters, the socket and whether the in-process fallback is loaded."""
+        stats = dict(self._counters)
+        stats.update({"socket": self.client.socket_path, "local_loaded": self._local is not None})
+        return stats
+
+    def _call(self, remote: Callable, local: Callable):
+        """Run `remote`, or `local` while the daemon is unavailable."""
+        if time.monotonic() >= self._retry_at:
+            try:
+                if not self._checked:
+                    self._check_model()
+                result = remote()
+                self._counters["daemon_calls"] += 1
+                return result
+            except (OSError, TokenizerDaemonError) as e:
+                self._checked = False
+                self._retry_at = time.monotonic() + self.retry_interval
+                self._counters["daemon_failures"] += 1
+                error_logger.error(f"Tokenizer daemon at {self.client.socket_path} unavailable, using the in-process tokenizer: {e}")
+        self._counters["local_calls"] += 1
+        return local()
+
+    def _check_model(self) -> None:
+        if self.model_id is not None:
+            served = self.client.info().get("model_id")
+            if served != self.model_id:
+                raise TokenizerDaemonError(f"The daemon serves {served!r}, expected {self.model_id!r}")
+        self._checked = True
+
+# --- Main ---
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Serve one shared tokenizer to every pAIr process on this host.")
+    parser.add_argument("--socket", default=os.getenv("TOKENIZER_SOCKET") or DEFAULT_SOCKET, help="Unix domain socket path (default: TOKENIZER_SOCKET)")
+    parser.add_argument("--model", help="Trained model (default: MODEL_PATH, trained from TRAINING_DATA_PATH if missing, like the webapp)")
+    parser.add_argument("--ranks", default=os.getenv("TOKEN_COUNT_RANKS_PATH"), help="Serve a tiktoken-format rank file instead (default: TOKEN_COUNT_RANKS_PATH)")
+    parser.add_argument("--pat-str", default=os.getenv("TOKEN_COUNT_PAT_STR"), help="Pattern for --ranks (default: TOKEN_COUNT_PAT_STR)")
+    parser.add_argument("--workers", type=int, default=TOKENIZER_DAEMON_WORKERS, help="Serving processes; more than 1 uses more cores, but each has its own word cache (default: TOKENIZER_DAEMON_WORKERS, 1)")
+    args = parser.parse_args()
+
+    if args.ranks:
+        service = TokenizerService.from_rank_file(args.ranks, args.pat_str, socket_path="")
+        served = model_id(args.ranks, args.pat_str)
+    else:
+        if args.model is None:
+            from tokenizer_init import initialize_tokenizer
+            initialize_tokenizer()
+            args.model = os.getenv("MODEL_PATH", "pair.pkl")
+        service = TokenizerService(args.model, socket_path="")
+        served = model_id(args.model)
+
+    server = TokenizerDaemon(args.socket, service.tokenizer, served)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"Serving {served} on {args.socket} with {args.workers} worker(s)")
+    try:
+        server.serve(args.workers)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
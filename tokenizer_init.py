@@ -4,10 +4,29 @@ import os
 import regex
 from SimpleBytePairEncoding import TokenizerService
 
+DEFAULT_PAT_STR = r"""('s|'t|'re|'ve|'m|'ll|'d| ?[\p{L}]+| ?[\p{N}]+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+)|(```[\s\S]*?```)|(`[^`]*`)|(\[[^\]]*\]\([^)]*\))"""
+
+def heuristic_vocab_size(training_data, pat_str):
+    """Twice the number of pattern matches, rounded to the nearest multiple of 256."""
+    vocab_size = len(regex.findall(pat_str, training_data)) * 2
+
+    # Round to the nearest multiple of 256
+    if vocab_size % 256 < 128:
+        vocab_size -= vocab_size % 256
+    else:
+        vocab_size += 256 - vocab_size % 256
+    return vocab_size
+
+def get_vocab_size(training_data, pat_str):
+    """The VOCAB_SIZE environment variable (e.g. chosen with vocab_sweep.py), or the heuristic."""
+    if os.getenv("VOCAB_SIZE"):
+        return int(os.environ["VOCAB_SIZE"])
+    return heuristic_vocab_size(training_data, pat_str)
+
 def initialize_tokenizer():
     model_path = os.getenv("MODEL_PATH", "pair.pkl")
     training_data_path = os.getenv("TRAINING_DATA_PATH", "sample-training-data.log")
-    pat_str = os.getenv("PAT_STR", r"""('s|'t|'re|'ve|'m|'ll|'d| ?[\p{L}]+| ?[\p{N}]+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+)|(```[\s\S]*?```)|(`[^`]*`)|(\[[^\]]*\]\([^)]*\))""")
+    pat_str = os.getenv("PAT_STR", DEFAULT_PAT_STR)
 
     if not os.path.exists(model_path):
         training_data = "Hello world!"
@@ -15,13 +34,7 @@ def initialize_tokenizer():
             with open(training_data_path, "r") as file:
                 training_data = file.read()
 
-        vocab_size = len(regex.findall(pat_str, training_data)) * 2
-
-        # Round to the nearest multiple of 256
-        if vocab_size % 256 < 128:
-            vocab_size -= vocab_size % 256
-        else:
-            vocab_size += 256 - vocab_size % 256
+        vocab_size = get_vocab_size(training_data, pat_str)
 
         # This will train and save the model
-        TokenizerService(model_path, training_data, vocab_size, pat_str)
\ No newline at end of file
+        TokenizerService(model_path, training_data, vocab_size, pat_str)
@@ -0,0 +1,427 @@
+# upstream_client.py
+
+# --- Imports ---
+
+# Standard library imports
+import logging
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, wait
+from typing import Optional
+
+# Third party imports
+import openai
+from openai import OpenAI
+from openai.types.chat import ChatCompletion
+
+# Local application imports
+from helpers import setup_logger
+
+# --- Setup ---
+error_logger = setup_logger('upstream_error_logger', 'upstream-error.log', logging.ERROR)
+audit_logger = setup_logger('upstream_audit_logger', 'upstream-audit.log', logging.INFO)
+
+# --- Upstream client class ---
+
+class UpstreamClient:
+    """
+    A shared, connection-pooled wrapper around the OpenAI client.
+
+    One instance is shared by every chat session (see `get_upstream_client`),
+    so HTTP connections are reused. Calls are capped in concurrency, retried
+    with jittered exponential backoff on 429/5xx and connection errors,
+    optionally hedged when the first attempt is slow, and timed.
+
+    Attributes
+    ----------
+    client : OpenAI
+        The underlying OpenAI client (SDK retries disabled).
+
+    max_retries : int
+        Retries after the first attempt.
+
+    backoff_base : float
+        Backoff in seconds before the first retry; doubles per retry.
+
+    backoff_max : float
+        Upper bound for a single backoff sleep.
+
+    max_concurrency : int
+        Maximum number of upstream calls in flight.
+
+    hedge_delay : float
+        Seconds to wait for the first chunk of a stream before sending a
+        duplicate request, and the least a completion waits; 0 disables hedging.
+
+    hedge_percentile : float
+        A completion is hedged once it is slower than this percentile of
+        recent completions of a comparable request size.
+
+    hedge_min_samples : int
+        Completions of a size that must be recorded before those are hedged.
+    """
+
+    # -- Constructor --
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, timeout: Optional[float] = None, connect_timeout: Optional[float] = None, max_retries: Optional[int] = None, backoff_base: Optional[float] = None, backoff_max: Optional[float] = None, max_concurrency: Optional[int] = None, hedge_delay: Optional[float] = None, hedge_percentile: Optional[float] = None, hedge_min_samples: Optional[int] = None, latency_window: Optional[int] = None):
+        timeout = timeout if timeout is not None else float(os.getenv("UPSTREAM_TIMEOUT", "600"))
+        connect_timeout = connect_timeout if connect_timeout is not None else float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10"))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("UPSTREAM_MAX_RETRIES", "3"))
+        self.backoff_base = backoff_base if backoff_base is not None else float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5"))
+        self.backoff_max = backoff_max if backoff_max is not None else float(os.getenv("UPSTREAM_BACKOFF_MAX", "20"))
+        self.max_concurrency = max_concurrency or int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "16"))
+        self.hedge_delay = hedge_delay if hedge_delay is not None else float(os.getenv("UPSTREAM_HEDGE_DELAY", "0"))
+        self.hedge_percentile = hedge_percentile if hedge_percentile is not None else float(os.getenv("UPSTREAM_HEDGE_PERCENTILE", "95"))
+        self.hedge_min_samples = hedge_min_samples if hedge_min_samples is not None else int(os.getenv("UPSTREAM_HEDGE_MIN_SAMPLES", "20"))
+
+        # Retries are handled here, so the SDK's own retry loop is turned off
+        self.client = OpenAI(
+            api_key=api_key,
+            base_url=base_url or os.getenv("OPENAI_BASE_URL") or None,
+            timeout=openai.Timeout(timeout, connect=connect_timeout),
+            max_retries=0
+        )
+
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency * 2, thread_name_prefix="upstream") if self.hedge_delay > 0 else None
+        self._latency_window = latency_window or int(os.getenv("UPSTREAM_LATENCY_WINDOW", "1000"))
+        self._latencies = deque(maxlen=self._latency_window)
+        self._size_latencies = {} # Request size class -> recent completion latencies, see `_hedge_delay_for`
+        self._lock = threading.Lock()
+        # `hedges_wasted`: the first attempt answered first, so the duplicate only added upstream load
+        self._counters = {"calls": 0, "attempts": 0, "retries": 0, "errors": 0, "hedges": 0, "hedges_won": 0, "hedges_wasted": 0}
+
+    # -- Public methods --
+
+    def chat_completion(self, **kwargs):
+        """
+        Create a chat completion through the shared client.
+
+        Parameters
+        ----------
+        **kwargs
+            Arguments for `client.chat.completions.create` (model, messages, ...).
+
+        Returns
+        -------
+        ChatCompletion
+            The upstream response.
+        """
+        size = sum(len(str(message.get("content", ""))) for message in kwargs.get("messages", []))
+        return self._call(self.client.chat.completions.create, kwargs, size_class(size))
+
+    def chat_completion_body(self, body: bytes):
+        """
+        Create a chat completion from an already serialized request body.
+
+        Parameters
+        ----------
+        body : bytes
+            The JSON request body, see `PromptBuilder.build_body`.
+
+        Returns
+        -------
+        ChatCompletion
+            The upstream response.
+        """
+        return self._call(self._post_body, {"body": body}, size_class(len(body)))
+
+    def stream_chat_completion(self, **kwargs):
+        """
+        Stream a chat completion through the shared client.
+
+        Retries and hedging apply until the first chunk arrives (latency is
+        recorded as time to first chunk); after that, chunks are passed through.
+        The stream holds its concurrency slot until it is closed, so
+        `max_concurrency` also bounds long-lived streams.
+
+        Parameters
+        ----------
+        **kwargs
+            Arguments for `client.chat.completions.create`, without `stream`.
+
+        Yields
+        ------
+        ChatCompletionChunk
+            The streamed chunks.
+        """
+        stream = self._call(self._open_stream, kwargs)
+        try:
+            if stream.first_chunk is not None:
+                yield stream.first_chunk
+            yield from stream.chunks
+        finally:
+            stream.close() # Also frees its concurrency slot
+
+    def stats(self) -> dict:
+        """Return call counters and latency percentiles (seconds) for monitoring."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = dict(self._counters)
+        stats["latency"] = {
+            "count": len(latencies),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99)
+        }
+        return stats
+
+    # -- Upstream client utilities --
+
+    def _call(self, create, kwargs, size: Optional[int] = None):
+        """
+        Run one logical call with retries, recording its end-to-end latency.
+
+        `size` is the size class of a completion request, whose latency is
+        recorded per class; streams (None) are hedged on their first chunk.
+        """
+        start = time.perf_counter()
+        self._count("calls")
+        attempt = 0
+        while True:
+            try:
+                attempt_start = time.perf_counter()
+                hedge_delay = self._hedge_delay_for(size) if self._executor is not None else None
+                if hedge_delay is not None:
+                    result = self._send_hedged(create, kwargs, hedge_delay)
+                else:
+                    result = self._send(create, kwargs)
+                self._record_latency(time.perf_counter() - start, size, time.perf_counter() - attempt_start)
+                return result
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    self._count("errors")
+                    error_logger.error(f'Upstream call failed after {attempt + 1} attempt(s): {e}')
+                    raise
+                delay = self._backoff(attempt, e)
+                audit_logger.info(f'Retrying upstream call in {delay:.2f}s after: {e}')
+                self._count("retries")
+                attempt += 1
+                time.sleep(delay)
+
+    def _send(self, create, kwargs, slot_acquired: bool = False):
+        """Run one attempt in a concurrency slot, held until it returns, or until an opened stream is closed."""
+        if not slot_acquired:
+            self._slots.acquire()
+        try:
+            self._count("attempts")
+            result = create(**kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        if isinstance(result, UpstreamStream):
+            result.on_close = self._slots.release
+        else:
+            self._slots.release()
+        return result
+
+    def _hedge_delay_for(self, size: Optional[int]) -> Optional[float]:
+        """
+        How long to wait before hedging a call, or None not to hedge it.
+
+        A stream is hedged when its first chunk takes `hedge_delay`. A
+        completion only answers once it is fully generated, so a fixed delay
+        would duplicate every long reply; it is hedged only when slower than
+        `hedge_percentile` of recent completions of the same size class.
+        """
+        if size is None:
+            return self.hedge_delay
+        with self._lock:
+            latencies = sorted(self._size_latencies.get(size, ()))
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_delay, percentile(latencies, self.hedge_percentile))
+
+    def _send_hedged(self, create, kwargs, hedge_delay: float):
+        """
+        Send the request and, if it hasn't answered within `hedge_delay`, a duplicate.
+
+        The first successful response wins. A hedge is only sent when a
+        concurrency slot is free, so hedging never queues behind real traffic.
+        """
+        primary = self._executor.submit(self._send, create, kwargs)
+        try:
+            return primary.result(timeout=hedge_delay)
+        except FuturesTimeoutError:
+            pass
+
+        if not self._slots.acquire(blocking=False):
+            return primary.result()
+
+        self._count("hedges")
+        hedge = self._executor.submit(self._send, create, kwargs, True)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self._count("hedges_won" if future is hedge else "hedges_wasted")
+                    for loser in pending:
+                        loser.add_done_callback(discard_result)
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _open_stream(self, **kwargs):
+        """Open a stream and wait for its first chunk, so slow first bytes can be retried or hedged."""
+        stream = self.client.chat.completions.create(stream=True, **kwargs)
+        try:
+            return UpstreamStream(stream, next(iter(stream), None))
+        except BaseException:
+            stream.close()
+            raise
+
+    def _post_body(self, body: bytes):
+        return self.client.post(
+            "/chat/completions",
+            cast_to=ChatCompletion,
+            content=body,
+            options={"headers": {"Content-Type": "application/json"}}
+        )
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        """Full-jitter exponential backoff, honouring a Retry-After header when present."""
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                retry_after = None
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def _record_latency(self, seconds: float, size: Optional[int] = None, attempt_seconds: Optional[float] = None) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+            if size is not None:
+                latencies = self._size_latencies.get(size)
+                if latencies is None:
+                    latencies = self._size_latencies[size] = deque(maxlen=self._latency_window)
+                latencies.append(attempt_seconds if attempt_seconds is not None else seconds)
+
+# --- Upstream stream class ---
+
+class UpstreamStream:
+    """
+    An open upstream stream, with its first chunk already read.
+
+    Closing it closes the connection and then calls `on_close` once (the
+    client sets it to free the stream's concurrency slot).
+
+    Attributes
+    ----------
+    chunks : Stream
+        The SDK stream, positioned after the first chunk.
+
+    first_chunk : ChatCompletionChunk or None
+        The first chunk, or None if the stream was empty.
+
+    on_close : Callable or None
+        Called once when the stream is closed.
+    """
+
+    # -- Constructor --
+
+    def __init__(self, chunks, first_chunk):
+        self.chunks = chunks
+        self.first_chunk = first_chunk
+        self.on_close = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        """Close the connection and free what the stream holds; later calls do nothing."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        try:
+            self.chunks.close()
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+
+# --- Helper functions ---
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Whether an upstream error is worth retrying.
+
+    Args:
+        error (Exception): The raised error.
+
+    Returns:
+        bool: True for rate limits, server errors, timeouts and connection errors.
+    """
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, openai.APIConnectionError)
+
+def size_class(size: int) -> int:
+    """
+    Group request sizes whose completions take comparably long: powers of two.
+
+    Args:
+        size (int): The request size (body bytes, or characters of message content).
+
+    Returns:
+        int: The size class.
+    """
+    return max(0, size).bit_length()
+
+def discard_result(future) -> None:
+    """Close the result of a losing hedged attempt (e.g. an open stream)."""
+    if future.exception() is not None:
+        return
+    result = future.result()
+    if hasattr(result, "close"):
+        result.close()
+
+def percentile(sorted_values: list, pct: float) -> Optional[float]:
+    """
+    Nearest-rank percentile of an already sorted list.
+
+    Args:
+        sorted_values (list): Values in ascending order.
+        pct (float): The percentile, 0-100.
+
+    Returns:
+        float: The percentile value, or None for an empty list.
+    """
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values), math.ceil(pct / 100 * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+# --- Shared instance ---
+
+_upstream_clients: dict[Optional[str], UpstreamClient] = {}
+_upstream_clients_lock = threading.Lock()
+
+def get_upstream_client(api_key: Optional[str] = None) -> UpstreamClient:
+    """
+    Return the process-wide upstream client for an API key.
+
+    Args:
+        api_key (str, optional): The OpenAI API key; defaults to `OPENAI_API_KEY`.
+
+    Returns:
+        UpstreamClient: The shared client.
+    """
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    with _upstream_clients_lock:
+        client = _upstream_clients.get(api_key)
+        if client is None:
+            client = _upstream_clients[api_key] = UpstreamClient(api_key=api_key)
+        return client
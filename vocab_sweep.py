@@ -0,0 +1,199 @@
+# vocab_sweep.py
+#
+# Measures candidate vocabulary sizes on a held-out split of the training logs
+# and recommends one. Run it before the first start (i.e. before `pair.pkl` is
+# trained), then set VOCAB_SIZE in .env:
+#
+#   python vocab_sweep.py --max-model-bytes 2000000 --max-ms-per-message 5
+
+# --- Imports ---
+
+# Standard library imports
+import argparse
+import json
+import os
+import pickle
+import random
+import time
+from typing import Optional
+
+# Third party imports
+import regex
+
+# Local application imports
+from SimpleBytePairEncoding import WORD_MAX_LENGTH, Tokenizer, bpe_train
+from tokenizer_init import DEFAULT_PAT_STR, heuristic_vocab_size
+
+# --- Setup ---
+
+# Chat logs (see `ChatBotClass.log_message`) start user messages with "> " and replies with ">> "
+MESSAGE_START = regex.compile(r"^>>? ", regex.MULTILINE)
+
+DEFAULT_SIZES = [256, 512, 768, 1024, 1536, 2048, 3072, 4096, 6144, 8192]
+
+# --- Data ---
+
+def split_messages(text: str) -> list[str]:
+    """
+    Split a chat log into messages, or into paragraphs if it has no message markers.
+
+    Args:
+        text (str): The log contents.
+
+    Returns:
+        list[str]: The non-empty messages, in order.
+    """
+    starts = [match.start() for match in MESSAGE_START.finditer(text)]
+    if starts:
+        if starts[0] > 0:
+            starts.insert(0, 0)
+        parts = [text[start:end] for start, end in zip(starts, starts[1:] + [len(text)])]
+    else:
+        parts = regex.split(r"\n\s*\n", text)
+    return [part for part in parts if part.strip()]
+
+def holdout_split(messages: list[str], holdout: float, seed: int = 0) -> tuple[list[str], list[str]]:
+    """
+    Shuffle messages deterministically and split off a held-out share.
+
+    Args:
+        messages (list[str]): All messages.
+        holdout (float): Share of messages held out for evaluation (0-1).
+        seed (int): Shuffle seed.
+
+    Returns:
+        tuple[list[str], list[str]]: Training and held-out messages.
+    """
+    shuffled = list(messages)
+    random.Random(seed).shuffle(shuffled)
+    count = max(1, round(len(shuffled) * holdout)) if len(shuffled) > 1 else 0
+    return shuffled[count:], shuffled[:count]
+
+# --- Sweep ---
+
+def evaluate(tokenizer: Tokenizer, messages: list[str]) -> dict:
+    """
+    Encode held-out messages with a fresh (cold cache) tokenizer and measure it.
+
+    Args:
+        tokenizer (Tokenizer): The candidate tokenizer.
+        messages (list[str]): Held-out messages.
+
+    Returns:
+        dict: `bytes_per_token`, `tokens_per_message`, `mib_per_second`, `ms_per_message` and `roundtrip` (all messages decode back unchanged).
+    """
+    total_bytes = sum(len(message.encode("utf-8")) for message in messages)
+    start = time.perf_counter()
+    encoded = [tokenizer.encode(message) for message in messages]
+    seconds = time.perf_counter() - start
+    total_tokens = sum(len(tokens) for tokens in encoded)
+    return {
+        "bytes_per_token": total_bytes / total_tokens if total_tokens else 0.0,
+        "tokens_per_message": total_tokens / len(messages) if messages else 0.0,
+        "mib_per_second": total_bytes / seconds / 2**20 if seconds else 0.0,
+        "ms_per_message": seconds * 1000 / len(messages) if messages else 0.0,
+        "roundtrip": all(tokenizer.decode(tokens) == message for tokens, message in zip(encoded, messages))
+    }
+
+def sweep(training_data: str, sizes: list[int], pat_str: str = DEFAULT_PAT_STR, holdout: float = 0.2, seed: int = 0, max_word_length: Optional[int] = WORD_MAX_LENGTH) -> list[dict]:
+    """
+    Train on the training split once and evaluate every candidate size on the held-out split.
+
+    BPE training adds one merge at a time, so the model for a smaller size is
+    exactly the first ranks of a larger one: training to the largest size
+    yields every candidate.
+
+    Args:
+        training_data (str): The chat logs.
+        sizes (list[int]): Candidate vocabulary sizes (at least 256).
+        pat_str (str): The pre-tokenization pattern.
+        holdout (float): Share of messages held out for evaluation.
+        seed (int): Split seed.
+        max_word_length (int, optional): Longest pre-token, as for `Tokenizer.train`.
+
+    Returns:
+        list[dict]: One result per distinct size: `vocab_size`, `model_bytes` and the `evaluate` metrics.
+    """
+    train, held_out = holdout_split(split_messages(training_data), holdout, seed)
+    if not held_out:
+        raise ValueError("Not enough messages for a held-out split")
+
+    ranks = bpe_train("".join(train), max(sizes), pat_str, max_word_length)
+    results = []
+    for size in sorted(set(min(size, len(ranks)) for size in sizes)):
+        tokenizer = Tokenizer(pat_str=pat_str, mergeable_ranks={token: rank for token, rank in ranks.items() if rank < size}, max_word_length=max_word_length)
+        result = {"vocab_size": size, "model_bytes": len(pickle.dumps(tokenizer))}
+        result.update(evaluate(tokenizer, held_out))
+        results.append(result)
+    return results
+
+def pick(results: list[dict], max_model_bytes: Optional[int] = None, max_ms_per_message: Optional[float] = None, tolerance: float = 0.01) -> Optional[dict]:
+    """
+    Pick the smallest vocabulary whose compression is within `tolerance` of the best one that fits the budget.
+
+    Args:
+        results (list[dict]): Sweep results.
+        max_model_bytes (int, optional): Largest acceptable pickled model.
+        max_ms_per_message (float, optional): Slowest acceptable mean encode time per message.
+        tolerance (float): Accepted relative loss in bytes/token, in exchange for a smaller vocabulary.
+
+    Returns:
+        dict or None: The chosen result, or None if no candidate fits.
+    """
+    fits = [
+        result for result in results
+        if result["roundtrip"]
+        and (max_model_bytes is None or result["model_bytes"] <= max_model_bytes)
+        and (max_ms_per_message is None or result["ms_per_message"] <= max_ms_per_message)
+    ]
+    if not fits:
+        return None
+    best = max(result["bytes_per_token"] for result in fits)
+    return min((result for result in fits if result["bytes_per_token"] >= best * (1 - tolerance)), key=lambda result: result["vocab_size"])
+
+# --- Main ---
+
+def parse_sizes(value: str) -> list[int]:
+    """Parse `256,512,1024` or a `start:stop:step` range (inclusive)."""
+    if ":" in value:
+        start, stop, step = (int(part) for part in value.split(":"))
+        return list(range(start, stop + 1, step))
+    return [int(part) for part in value.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep tokenizer vocabulary sizes on held-out chat logs.")
+    parser.add_argument("--data", default=os.getenv("TRAINING_DATA_PATH", "sample-training-data.log"), help="Training logs")
+    parser.add_argument("--pat-str", default=os.getenv("PAT_STR", DEFAULT_PAT_STR), help="Pre-tokenization pattern")
+    parser.add_argument("--sizes", type=parse_sizes, help="Candidate sizes: 256,512,1024 or start:stop:step (default: 256 to 8192, plus the current heuristic if smaller)")
+    parser.add_argument("--max-word-length", type=int, default=WORD_MAX_LENGTH, help="Longest pre-token before re-splitting; 0 keeps whole matches (default: PRETOKENIZER_MAX_LENGTH)")
+    parser.add_argument("--holdout", type=float, default=0.2, help="Share of messages held out for evaluation")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-model-bytes", type=int, help="Memory budget: largest pickled model")
+    parser.add_argument("--max-ms-per-message", type=float, help="Latency budget: slowest mean encode time per message")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="Accepted relative loss in bytes/token for a smaller vocabulary")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    with open(args.data, "r", encoding="utf-8") as f:
+        training_data = f.read()
+
+    heuristic = heuristic_vocab_size(training_data, args.pat_str)
+    sizes = args.sizes or sorted(set(DEFAULT_SIZES + ([heuristic] if 256 <= heuristic <= DEFAULT_SIZES[-1] else [])))
+    results = sweep(training_data, sizes, args.pat_str, args.holdout, args.seed, args.max_word_length or None)
+    chosen = pick(results, args.max_model_bytes, args.max_ms_per_message, args.tolerance)
+
+    if args.json:
+        print(json.dumps({"heuristic": heuristic, "results": results, "chosen": chosen}, indent=2))
+        return
+
+    print(f"{'vocab':>7} {'bytes/token':>11} {'tokens/msg':>10} {'MiB/s':>7} {'ms/msg':>7} {'model KiB':>9}")
+    for result in results:
+        marks = (" <- heuristic" if result["vocab_size"] == heuristic else "") + (" <- chosen" if result is chosen else "") + ("" if result["roundtrip"] else " (roundtrip failed)")
+        print(f"{result['vocab_size']:>7} {result['bytes_per_token']:>11.2f} {result['tokens_per_message']:>10.1f} {result['mib_per_second']:>7.2f} {result['ms_per_message']:>7.2f} {result['model_bytes'] / 1024:>9.1f}{marks}")
+    if chosen is None:
+        print("No candidate fits the budget.")
+    else:
+        print(f"\nRecommended: VOCAB_SIZE={chosen['vocab_size']} (current heuristic: {heuristic})")
+
+if __name__ == "__main__":
+    main()